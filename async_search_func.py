@@ -0,0 +1,88 @@
+import json
+import time
+import asyncio
+from search_func import HYBRID_SEARCH_PIPELINE, HYBRID_DENSE_K, MAX_TOKEN_SCORE, CASCADE_CANDIDATES, build_search_url, apply_source, build_strategy_body, get_query_vector, get_query_tokens, build_bm25_body, build_dense_body, build_sparse_search, build_dense_sparse_body, build_dense_bm25_body, build_cascade_body
+from setup_model_and_pipeline import get_async_aos_client
+from instrumentation import InstrumentedClient
+
+# asyncio counterparts of search_func.py, aos_client is an AsyncOpenSearch (see get_async_aos_client)
+# fill an embedding_cache with get_embeddings(queries) beforehand, a cache miss blocks the event loop
+
+async def _async_search(aos_client, index_name, request_body, search_pipeline=None, source=None):
+    apply_source(request_body, source)
+    response = await aos_client.transport.perform_request(
+        method="GET",
+        url=build_search_url(index_name, search_pipeline),
+        body=json.dumps(request_body)
+    )
+
+    return response["hits"]["hits"]
+
+async def async_search_by_bm25(aos_client, index_name, query, topk=4, source=None):
+    request_body = build_bm25_body(query, topk)
+    return await _async_search(aos_client, index_name, request_body, source=source)
+
+async def async_search_by_dense(aos_client, index_name, query, dense_model_id, topk=4, embedding_cache=None, source=None):
+    request_body = build_dense_body(query, dense_model_id, topk, get_query_vector(query, embedding_cache))
+    return await _async_search(aos_client, index_name, request_body, source=source)
+
+async def async_search_by_sparse(aos_client, index_name, query, sparse_model_id, topk=4, sparse_encoder=None, source=None, max_token_score=MAX_TOKEN_SCORE, two_phase=None):
+    request_body, search_pipeline = build_sparse_search(query, sparse_model_id, topk, get_query_tokens(query, sparse_encoder), max_token_score, two_phase)
+    return await _async_search(aos_client, index_name, request_body, search_pipeline, source)
+
+async def async_search_by_dense_sparse(aos_client, index_name, query, sparse_model_id, dense_model_id, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                                       hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE):
+    request_body = build_dense_sparse_body(query, sparse_model_id, dense_model_id, topk, get_query_vector(query, embedding_cache), get_query_tokens(query, sparse_encoder), hybrid_k, max_token_score)
+    return await _async_search(aos_client, index_name, request_body, hybrid_pipeline, source)
+
+async def async_search_by_dense_bm25(aos_client, index_name, query, dense_model_id, topk=4, embedding_cache=None, source=None, hybrid_k=HYBRID_DENSE_K, hybrid_pipeline=HYBRID_SEARCH_PIPELINE):
+    request_body = build_dense_bm25_body(query, dense_model_id, topk, get_query_vector(query, embedding_cache), hybrid_k)
+    return await _async_search(aos_client, index_name, request_body, hybrid_pipeline, source)
+
+async def async_search_by_cascade(aos_client, index_name, query, stage="sparse", sparse_model_id=None, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                                  candidates=CASCADE_CANDIDATES, max_token_score=MAX_TOKEN_SCORE):
+    request_body = build_cascade_body(query, stage, sparse_model_id, topk, get_query_vector(query, embedding_cache), get_query_tokens(query, sparse_encoder), candidates, max_token_score)
+    return await _async_search(aos_client, index_name, request_body, source=source)
+
+async def async_search_by_strategy(aos_client, index_name, query, strategy, sparse_model_id=None, dense_model_id=None, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                                   hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE, two_phase=None, result_cache=None,
+                                   cascade_candidates=CASCADE_CANDIDATES):
+    # the generation check of a result_cache is a blocking _stats call, at most once per check_interval
+    if result_cache is not None:
+        key = result_cache.key(index_name, strategy, query, sparse_model_id, dense_model_id, topk, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase, cascade_candidates)
+        hits, generation = result_cache.get(index_name, key)
+        if hits is not None:
+            return hits
+        start = time.perf_counter()
+    request_body, search_pipeline = build_strategy_body(strategy, query, sparse_model_id, dense_model_id, topk, embedding_cache, sparse_encoder, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase,
+                                                        cascade_candidates)
+    hits = await _async_search(aos_client, index_name, request_body, search_pipeline, source)
+    if result_cache is not None:
+        result_cache.put(index_name, key, hits, generation, time.perf_counter() - start)
+    return hits
+
+async def gather_search(aos_client, index_name, queries, async_search_fn, *search_args, concurrency=8, **search_kwargs):
+    # at most `concurrency` requests in flight, results keep the order of `queries`
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def search_one(query):
+        async with semaphore:
+            return await async_search_fn(aos_client, index_name, query, *search_args, **search_kwargs)
+
+    return await asyncio.gather(*[search_one(query) for query in queries])
+
+def search_concurrently(aos_endpoint, index_name, queries, async_search_fn, *search_args, concurrency=8, recorder=None, label=None, client_options=None, **search_kwargs):
+    '''
+    Usage : search_concurrently(aos_endpoint, index_name, queries, async_search_by_dense, dense_model_id, topk, concurrency=16)
+    Pass an instrumentation.Recorder as `recorder` to record every request under `label`.
+    client_options (http_compress, sniff) go to get_async_aos_client, the pool holds one connection per concurrent query.
+    '''
+    async def run():
+        aos_client = get_async_aos_client(aos_endpoint, pool_maxsize=concurrency, **(client_options or {}))
+        search_client = InstrumentedClient(aos_client, recorder, label or async_search_fn.__name__) if recorder is not None else aos_client
+        try:
+            return await gather_search(search_client, index_name, queries, async_search_fn, *search_args, concurrency=concurrency, **search_kwargs)
+        finally:
+            await aos_client.close()
+
+    return asyncio.run(run())
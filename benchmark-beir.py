@@ -1,38 +1,207 @@
 import time
+import json
 import argparse
 from tqdm import tqdm
 from datasets import load_dataset
-from setup_model_and_pipeline import get_aos_client
-from search_func import search_by_bm25, search_by_dense, search_by_sparse, search_by_dense_sparse, search_by_dense_bm25
+from setup_model_and_pipeline import get_aos_client, CONNECTION_CLASSES, get_index_stats, get_max_token_score, create_index, create_pruned_ingest_pipeline, create_batched_ingest_pipeline
+from index_profiles import INDEX_PROFILES, train_knn_model, warmup_knn_index, get_knn_stats, profile_embedding_type
+from dense_quantization import QuantizedQueryEmbeddings
+from search_func import STRATEGIES
+from instrumentation import Recorder, InstrumentedClient
+from bulk_ingest import BulkIngester, IngestCheckpoint, docs_per_second, ingest_resumable
+from embedding_cache import QueryEmbeddingCache
+from sparse_query_encoder import SparseQueryEncoder
+from hybrid_fusion import FUSION_TECHNIQUES
+from strategy_runner import run_strategies, register_strategy, client_fusion_runner, two_phase_sparse_runner, rescored_dense_runner, cascade_runner, partitioned_runner
+from parameter_sweep import DEFAULT_GRID, grid_points, sample_points, run_sweep
+from embedding_store import EmbeddingStore, precompute_embeddings
+from sparse_pruning import parse_prune_setting
+from client_benchmark import compare_clients, print_client_comparison
+from ingest_benchmark import compare_batch_sizes, print_batch_size_comparison
+from result_cache import SearchResultCache
+from metrics import evaluate_runs, format_metrics
+from partitioned_search import create_partitioned_index, ingest_partitioned
 from datasets import load_dataset
 from beir import LoggingHandler, util
 from beir.datasets.data_loader import GenericDataLoader
-from beir.retrieval.evaluation import EvaluateRetrieval
 
 data_root_dir = "beir_data"
 
-def ingest_dataset(corpus, aos_client,index_name, bulk_size=50):
-    i=0
-    bulk_body=[]
-    for _id , body in tqdm(corpus.items()):
-        text=body["title"]+" "+body["text"]
-        bulk_body.append({ "index" : { "_index" : index_name, "_id" : _id } })
-        bulk_body.append({ "content" : text })
-        i+=1
-        if i % bulk_size==0:
-            response=aos_client.bulk(bulk_body,request_timeout=100)
-            try:
-                assert response["errors"]==False
-            except:
-                print("there is errors")
-                print(response)
-                time.sleep(1)
-                response = aos_client.bulk(bulk_body,request_timeout=100)
-            bulk_body=[]
-        
-    response=aos_client.bulk(bulk_body,request_timeout=100)
-    assert response["errors"]==False
+def ingest_dataset(corpus, aos_client,index_name, bulk_size=50, max_workers=8, checkpoint=None, pipeline=None):
+    with tqdm(total=len(corpus)) as progress:
+        ingester = BulkIngester(aos_client, index_name, bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline=pipeline, progress=progress.update)
+        stats = ingest_resumable(
+            ingester,
+            corpus.items(),
+            lambda item: (item[0], { "content" : item[1]["title"]+" "+item[1]["text"] }),
+            checkpoint=checkpoint,
+            key="corpus"
+        )
+    print(f"indexed:{stats['indexed']}, failed:{stats['failed']}, already committed:{stats['skipped']}, retried batches:{stats['retries']}, final concurrency:{stats['final_concurrency']}")
+    if stats["failed"] > 0:
+        print("there is errors")
+        print(stats["errors"])
+    aos_client.indices.refresh(index=index_name)
+    return stats
+
+def ingest_precomputed(corpus, aos_client, index_name, sparse_model_id, store_path, bulk_size=50, max_workers=8, checkpoint=None, recorder=None,
+                       prune_type=None, prune_ratio=None, embedding_type="float"):
+    # embeddings are computed once into store_path, re-ingesting from the store needs no model inference
+    # _predict calls are reported as "precompute" so they do not skew the _bulk latency of "ingest"
+    precompute_client = InstrumentedClient(aos_client, recorder, "precompute") if recorder is not None else aos_client
+    ingest_client = InstrumentedClient(aos_client, recorder, "ingest") if recorder is not None else aos_client
+    if not EmbeddingStore.exists(store_path):
+        docs = ((doc_id, doc["title"]+" "+doc["text"]) for doc_id, doc in corpus.items())
+        with tqdm(total=len(corpus), desc="precompute") as progress:
+            precompute_embeddings(precompute_client, sparse_model_id, docs, store_path, max_workers=max_workers, progress=progress.update)
+    store = EmbeddingStore(store_path)
+    with tqdm(total=len(store), desc="ingest") as progress:
+        # _none skips the default_pipeline of an index created for inference at ingest
+        ingester = BulkIngester(ingest_client, index_name, bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline="_none", progress=progress.update)
+        stats = ingest_resumable(ingester, store.iter_docs(prune_type, prune_ratio, embedding_type), lambda doc: doc, checkpoint=checkpoint, key="embedding_store")
+    print(f"indexed:{stats['indexed']}, failed:{stats['failed']}, already committed:{stats['skipped']}, retried batches:{stats['retries']}, final concurrency:{stats['final_concurrency']}")
+    if stats["failed"] > 0:
+        print("there is errors")
+        print(stats["errors"])
     aos_client.indices.refresh(index=index_name)
+    return stats
+
+def evaluate_strategies(aos_client, aos_endpoint, index_name, queries, qrels, strategies, search_kwargs, recorder, k=10, run_dir="runs", concurrency=1, msearch_size=0):
+    # {<strategy>_ndcg@k, <strategy>_recall@k, <strategy>_p90_ms, <strategy>_p99_ms} of fresh runs against index_name
+    runs = run_strategies(aos_client, aos_endpoint, index_name, queries, strategies, search_kwargs, run_dir, concurrency, msearch_size, recorder, reuse=False)
+    report = recorder.report()
+    results = evaluate_runs(qrels, runs, [k], metrics=["ndcg", "recall"])
+    metrics = {}
+    for strategy in runs:
+        metrics[f"{strategy}_ndcg@{k}"] = results[strategy][f"ndcg@{k}"]
+        metrics[f"{strategy}_recall@{k}"] = results[strategy][f"recall@{k}"]
+        metrics[f"{strategy}_p90_ms"] = report[strategy]["latency_ms"].get("p90")
+        metrics[f"{strategy}_p99_ms"] = report[strategy]["latency_ms"].get("p99")
+    return metrics
+
+def benchmark_index_profiles(aos_client, aos_endpoint, index_name, profiles, corpus, queries, qrels, strategies, search_kwargs, sparse_model_id, k=10,
+                             bulk_size=50, max_workers=8, store_path='', concurrency=1, msearch_size=0, run_dir="runs", rescore_oversample=4):
+    # one index <index_name>-<profile> per profile: ingest time, size, knn graph memory, quality and latency of the strategies
+    # int8 / binary profiles quantize the float vectors of the embedding store and the query embeddings on the client,
+    # and also run dense_rescored: topk x rescore_oversample quantized candidates re-ranked with the float vectors
+    summary = []
+    for profile in profiles:
+        profile_index = f"{index_name}-{profile.replace('_', '-')}"
+        embedding_type = profile_embedding_type(profile)
+        if embedding_type != "float" and not store_path:
+            raise ValueError(f"index profile {profile} stores {embedding_type} vectors, benchmark it with --embedding_store")
+        profile_kwargs = dict(search_kwargs)
+        profile_strategies = list(strategies)
+        if embedding_type != "float":
+            profile_kwargs["embedding_cache"] = QuantizedQueryEmbeddings(search_kwargs.get("embedding_cache") or QueryEmbeddingCache(), embedding_type)
+            register_strategy("dense_rescored", rescored_dense_runner(EmbeddingStore(store_path), rescore_oversample))
+            profile_strategies.append("dense_rescored")
+        recorder = Recorder()
+        if aos_client.indices.exists(index=profile_index):
+            aos_client.indices.delete(index=profile_index)
+        knn_model_id = None
+        if "train" in INDEX_PROFILES[profile]:
+            # trained on the vectors of the already ingested main index
+            knn_model_id = train_knn_model(aos_client, f"{index_name}-{profile.replace('_', '-')}-model", index_name, profile)
+        create_index(aos_client, profile_index, default_pipeline=None if store_path else "neural-sparse-pipeline", profile=profile, knn_model_id=knn_model_id)
+
+        start = time.time()
+        if store_path:
+            stats = ingest_precomputed(corpus, aos_client, profile_index, sparse_model_id, store_path, bulk_size=bulk_size, max_workers=max_workers, recorder=recorder,
+                               embedding_type=embedding_type)
+        else:
+            stats = ingest_dataset(corpus, aos_client=InstrumentedClient(aos_client, recorder, "ingest"), index_name=profile_index, bulk_size=bulk_size, max_workers=max_workers)
+        ingest_s = time.time() - start
+        warmup_knn_index(aos_client, profile_index)
+
+        knn_stats = get_knn_stats(aos_client, profile_index)
+        row = {"profile": profile, "index": profile_index, "embedding_type": embedding_type, "ingest_s": ingest_s, "docs_per_s": docs_per_second(stats["indexed"], ingest_s)}
+        row.update(get_index_stats(aos_client, profile_index))
+        row.update({"graph_memory_kb": knn_stats["index_graph_memory_kb"], "graph_count": knn_stats["index_graph_count"], "cache_capacity_reached": knn_stats["cache_capacity_reached"]})
+
+        row.update(evaluate_strategies(aos_client, aos_endpoint, profile_index, queries, qrels, profile_strategies, profile_kwargs, recorder, k, f"{run_dir}/{profile_index}",
+                                       concurrency, msearch_size))
+        print(f"[profile] {json.dumps(row)}")
+        summary.append(row)
+    return summary
+
+def benchmark_sparse_pruning(aos_client, aos_endpoint, index_name, prune_settings, corpus, queries, qrels, strategies, search_kwargs, sparse_model_id, k=10,
+                             bulk_size=50, max_workers=8, store_path='', concurrency=1, msearch_size=0, run_dir="runs"):
+    # one index <index_name>-prune-<prune_type>-<prune_ratio> per setting ("none", "max_ratio:0.1", ...): size, ingest time, quality and latency
+    summary = []
+    for setting in prune_settings:
+        prune_type, prune_ratio = parse_prune_setting(setting)
+        prune_index = f"{index_name}-prune-{prune_type.replace('_', '-')}" + (f"-{prune_ratio:g}" if prune_ratio is not None else "")
+        recorder = Recorder()
+        if aos_client.indices.exists(index=prune_index):
+            aos_client.indices.delete(index=prune_index)
+
+        start = time.time()
+        if store_path:
+            # pruned on the client, the same store serves every setting
+            create_index(aos_client, prune_index, default_pipeline=None)
+            stats = ingest_precomputed(corpus, aos_client, prune_index, sparse_model_id, store_path, bulk_size=bulk_size, max_workers=max_workers, recorder=recorder,
+                               prune_type=prune_type, prune_ratio=prune_ratio)
+        else:
+            # pruned by the sparse_encoding processor
+            pipeline = create_pruned_ingest_pipeline(aos_client, prune_type, prune_ratio) if prune_type != "none" else "neural-sparse-pipeline"
+            create_index(aos_client, prune_index, default_pipeline=pipeline)
+            stats = ingest_dataset(corpus, aos_client=InstrumentedClient(aos_client, recorder, "ingest"), index_name=prune_index, bulk_size=bulk_size, max_workers=max_workers)
+        ingest_s = time.time() - start
+
+        row = {"prune": setting, "index": prune_index, "ingest_s": ingest_s, "docs_per_s": docs_per_second(stats["indexed"], ingest_s)}
+        row.update(get_index_stats(aos_client, prune_index))
+        row.update(evaluate_strategies(aos_client, aos_endpoint, prune_index, queries, qrels, strategies, search_kwargs, recorder, k, f"{run_dir}/{prune_index}",
+                                       concurrency, msearch_size))
+        print(f"[prune] {json.dumps(row)}")
+        summary.append(row)
+    return summary
+
+def benchmark_partitions(aos_client, aos_endpoint, index_name, partition_counts, corpus, queries, qrels, strategies, search_kwargs, k=10, layout="indices",
+                         bulk_size=50, max_workers=8, store_path='', concurrency=1, run_dir="runs", normalization="l2", weights=None):
+    # one layout <index_name>-parts-<n> per partition count: ingest docs/s, then quality and latency of the strategies
+    # indices: n single shard indices <index_name>-parts-<n>-p<i>, docs hash routed and ingested into all of them at once,
+    #          searched by partitioned_search.search_partitioned as <strategy>_p<n>
+    # shards:  one index of n shards, OpenSearch routes the docs and merges the shards itself
+    summary = []
+    for partitions in partition_counts:
+        partition_index = f"{index_name}-parts-{partitions}"
+        recorder = Recorder()
+        ingest_client = InstrumentedClient(aos_client, recorder, "ingest")
+        default_pipeline = None if store_path else "neural-sparse-pipeline"
+        # a fresh lazy pass over the store / corpus per partition count, only the docs in flight are in memory
+        docs = EmbeddingStore(store_path).iter_docs() if store_path else ((doc_id, {"content": doc["title"]+" "+doc["text"]}) for doc_id, doc in corpus.items())
+        # precomputed embeddings skip the default_pipeline of an index created for inference at ingest
+        pipeline = "_none" if store_path else None
+
+        start = time.time()
+        if layout == "indices":
+            create_partitioned_index(aos_client, partition_index, partitions, default_pipeline=default_pipeline)
+            with tqdm(total=len(corpus), desc=f"ingest p{partitions}") as progress:
+                stats = ingest_partitioned(ingest_client, partition_index, docs, partitions, bulk_size=bulk_size, max_workers=max_workers, pipeline=pipeline, progress=progress.update)
+            partition_strategies = []
+            for strategy in strategies:
+                name = f"{strategy}_p{partitions}"
+                register_strategy(name, partitioned_runner(strategy, partitions, normalization, weights, name))
+                partition_strategies.append(name)
+        else:
+            if aos_client.indices.exists(index=partition_index):
+                aos_client.indices.delete(index=partition_index)
+            create_index(aos_client, partition_index, default_pipeline=default_pipeline, shards=partitions)
+            with tqdm(total=len(corpus), desc=f"ingest {partitions} shards") as progress:
+                ingester = BulkIngester(ingest_client, partition_index, bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline=pipeline, progress=progress.update)
+                stats = ingester.ingest(docs)
+            aos_client.indices.refresh(index=partition_index)
+            partition_strategies = strategies
+        ingest_s = time.time() - start
+
+        row = {"partitions": partitions, "layout": layout, "index": partition_index, "ingest_s": ingest_s, "docs_per_s": docs_per_second(stats["indexed"], ingest_s),
+               "failed": stats["failed"], "partition_docs": stats.get("partition_docs")}
+        row.update(evaluate_strategies(aos_client, aos_endpoint, partition_index, queries, qrels, partition_strategies, search_kwargs, recorder, k,
+                                       f"{run_dir}/{partition_index}", concurrency))
+        print(f"[partitions] {json.dumps(row)}")
+        summary.append(row)
+    return summary
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -45,6 +214,55 @@ if __name__ == '__main__':
     parser.add_argument('--sparse_model_id', type=str, default='', help='sparse_model_id')
     parser.add_argument("--ingest", action="store_true", help="is ingest or search")
     parser.add_argument("--dataset_name", type=str, default='fiqa', help='specify the dataset')
+    parser.add_argument("--concurrency", type=int, default=1, help='number of in-flight search requests, >1 uses AsyncOpenSearch')
+    parser.add_argument("--msearch_size", type=int, default=0, help='queries packed into one _msearch request, 0 sends one _search per query')
+    parser.add_argument("--bulk_size", type=int, default=50, help='documents per _bulk request')
+    parser.add_argument("--checkpoint", type=str, default='', help='json file of committed ingest offsets, a restarted ingest continues from it')
+    parser.add_argument("--embedding_store", type=str, default='', help='directory of precomputed embeddings, created on first ingest, documents are then indexed without ingest pipeline')
+    parser.add_argument("--ingest_workers", type=int, default=8, help='max number of in-flight _bulk requests')
+    parser.add_argument("--embedding_cache", type=str, default='', help='sqlite file caching query embeddings, dense legs then send knn queries with the cached vector')
+    parser.add_argument("--sparse_tokenizer", type=str, default='', help='tokenizer.json of the doc-only sparse model, with --sparse_idf encodes sparse queries client side')
+    parser.add_argument("--sparse_idf", type=str, default='', help='idf.json of the doc-only sparse model')
+    parser.add_argument("--sparse_top_n", type=int, default=None, help='keep the n heaviest query tokens')
+    parser.add_argument("--sparse_min_weight", type=float, default=0.0, help='drop query tokens lighter than this')
+    parser.add_argument("--fusion_technique", type=str, default='', choices=['']+FUSION_TECHNIQUES, help='also run client-side fusion of --fusion_legs with this technique')
+    parser.add_argument("--fusion_legs", type=str, default='sparse,dense', help='comma separated legs of the client-side fusion: sparse, dense, bm25')
+    parser.add_argument("--fusion_weights", type=str, default='', help='comma separated weight per fusion leg, equal weights by default')
+    parser.add_argument("--two_phase", type=str, default='', choices=['', 'pipeline', 'client'], help='also run sparse_two_phase: two-phase sparse search by neural-sparse-two-phase-pipeline or as a client-side rescore (needs --sparse_tokenizer / --sparse_idf)')
+    parser.add_argument("--cascade", type=str, default='', help='comma separated first stages (bm25, sparse) of cascade runs: the stage ranks, exact dense similarity rescores its top --cascade_candidates (needs --embedding_cache); dense_sparse and dense_bm25 run next to them, use --refresh_runs for their latency')
+    parser.add_argument("--cascade_candidates", type=str, default='100', help='comma separated candidate counts, one cascade_<stage>_<n> run per stage and count')
+    parser.add_argument("--cascade_rescore", type=str, default='script', choices=['script', 'client'], help='rescore by the knn_score script on the cluster, or on the client against the vectors of --embedding_store')
+    parser.add_argument("--max_token_score", type=str, default='', help='max_token_score of neural_sparse queries (ignored by OpenSearch 2.12+), a number or auto for the largest token weight in the index (in --embedding_store if given)')
+    parser.add_argument("--strategies", type=str, default=','.join(STRATEGIES), help='comma separated strategies to run, all of them run at the same time')
+    parser.add_argument("--k_values", type=str, default='1,4,10', help='comma separated cutoffs of the evaluation')
+    parser.add_argument("--bootstrap", type=int, default=0, help='bootstrap resamples of the queries for 95%% confidence intervals of every metric, 0 for none')
+    parser.add_argument("--run_dir", type=str, default='', help='directory of the TREC run files, runs/<dataset>_<index> by default')
+    parser.add_argument("--refresh_runs", action="store_true", help='query the cluster again even if a matching run file exists')
+    parser.add_argument("--sweep", action="store_true", help='sweep ef_search / hybrid k / max_token_score / pipeline normalization and weights instead of the benchmark')
+    parser.add_argument("--sweep_strategy", type=str, default='dense_sparse', help='strategy measured at every point of the sweep')
+    parser.add_argument("--sweep_grid", type=str, default='', help='json object {param: [values]} replacing the default grid of parameter_sweep.py')
+    parser.add_argument("--sweep_samples", type=int, default=0, help='random search over this many points of the grid, 0 runs the full grid')
+    parser.add_argument("--sweep_output", type=str, default='sweep.jsonl', help='every measured point is appended to this file')
+    parser.add_argument("--index_profiles", type=str, default='', help='comma separated index profiles (index_profiles.py) to build and benchmark one after the other as <index_name>-<profile>')
+    parser.add_argument("--rescore_oversample", type=int, default=4, help='candidates per result of dense_rescored for the int8 / binary --index_profiles')
+    parser.add_argument("--sparse_prune", type=str, default='', help='prune sparse vectors at ingest, <prune_type>:<prune_ratio> e.g. max_ratio:0.1, top_k:64, abs_value:0.05, alpha_mass:0.9')
+    parser.add_argument("--prune_settings", type=str, default='', help='comma separated pruning settings (none, max_ratio:0.1, ...) to build and benchmark one after the other as <index_name>-prune-<setting>')
+    parser.add_argument("--partitions", type=str, default='', help='comma separated partition counts (1,2,4,8) to build and benchmark one after the other as <index_name>-parts-<n>: ingest docs/s and quality / latency of the strategies, size --pool_maxsize to --concurrency x partitions x 2')
+    parser.add_argument("--partition_layout", type=str, default='indices', choices=['indices', 'shards'], help='n hash routed indices searched by client-side scatter-gather, or one index of n shards')
+    parser.add_argument("--partition_normalization", type=str, default='l2', choices=['l2', 'min_max'], help='normalization of the hybrid legs merged over the partitions, that of hybird-search-pipeline')
+    parser.add_argument("--pool_maxsize", type=int, default=10, help='connections kept alive per host, size it to the threads sharing the client (--ingest_workers)')
+    parser.add_argument("--http_compress", action="store_true", help='gzip request bodies (_bulk, _msearch, query vectors) and accept gzip responses')
+    parser.add_argument("--connection", type=str, default='requests', choices=list(CONNECTION_CLASSES), help='http connection class of the client, urllib3 skips the requests layer')
+    parser.add_argument("--sniff", action="store_true", help='discover the cluster nodes, self-managed clusters only (not Amazon OpenSearch Service); several comma separated --aos_endpoint are used round-robin')
+    parser.add_argument("--compare_clients", action="store_true", help='instead of the benchmark, send testset_size queries and documents through the baseline and the tuned clients of client_benchmark.py and report the throughput gain')
+    parser.add_argument("--ingest_batch_size", type=int, default=None, help='with --ingest, docs per model call of the ingest pipeline processors (OpenSearch 2.16+), through a batched copy of neural-sparse-pipeline')
+    parser.add_argument("--batch_sizes", type=str, default='', help='with --ingest, instead of the ingest, push testset_size documents through the ingest pipeline once per comma separated batch size (1,8,32,96) into scratch indices and report docs/s of each, sizes above --bulk_size behave like it')
+    parser.add_argument("--result_cache", action="store_true", help='cache search results (result_cache.py), a repeated query skips embedding and search until the index changes')
+    parser.add_argument("--result_cache_passes", type=int, default=1, help='with --result_cache, send the queries this many times, the later passes hit the cache')
+    parser.add_argument("--result_cache_ttl", type=float, default=300, help='seconds a cached result is served at most')
+    parser.add_argument("--result_cache_items", type=int, default=10000, help='max number of cached results')
+    parser.add_argument("--result_cache_mb", type=float, default=64, help='max size of the cached results in MB')
+    parser.add_argument("--report_json", type=str, default='', help='write the latency/throughput report to this json file')
     args = parser.parse_args()
     aos_endpoint = args.aos_endpoint
     aos_domain = '-'.join(aos_endpoint.split('-')[1:3])
@@ -55,76 +273,217 @@ if __name__ == '__main__':
     dense_model_id = args.dense_model_id
     sparse_model_id = args.sparse_model_id
     dataset_name = args.dataset_name
+    concurrency = args.concurrency
+    msearch_size = args.msearch_size
+    search_kwargs = {"sparse_model_id": sparse_model_id, "dense_model_id": dense_model_id, "topk": topk}
+    report_json = args.report_json
+    fusion_legs = args.fusion_legs.split(',')
+    fusion_weights = [float(weight) for weight in args.fusion_weights.split(',')] if args.fusion_weights else None
+    k_values = [int(k) for k in args.k_values.split(',')]
+    # everything besides index / queries / topk / model ids that changes the hits, a run file is only reused if these match
+    run_params = {"sparse_tokenizer": args.sparse_tokenizer, "sparse_idf": args.sparse_idf, "sparse_top_n": args.sparse_top_n, "sparse_min_weight": args.sparse_min_weight,
+                  "embedding_cache": bool(args.embedding_cache), "fusion_legs": fusion_legs, "fusion_weights": fusion_weights, "fusion_technique": args.fusion_technique,
+                  "two_phase": args.two_phase}
+    if args.sparse_tokenizer and args.sparse_idf:
+        search_kwargs["sparse_encoder"] = SparseQueryEncoder(args.sparse_tokenizer, args.sparse_idf, top_n=args.sparse_top_n, min_weight=args.sparse_min_weight)
+    bulk_size = args.bulk_size
+    ingest_workers = args.ingest_workers
+    recorder = Recorder()
+
+    aos_client = get_aos_client(aos_endpoint, pool_maxsize=args.pool_maxsize, http_compress=args.http_compress, sniff=args.sniff, connection=args.connection)
+    # the AsyncOpenSearch of --concurrency > 1 gets the same options, its pool holds one connection per in-flight query
+    search_kwargs["client_options"] = {"http_compress": args.http_compress, "sniff": args.sniff}
+    result_cache = None
+    if args.result_cache:
+        # the generation check goes through the plain client, cache hits are recorded as "result_cache"
+        result_cache = SearchResultCache(aos_client, max_items=args.result_cache_items, ttl=args.result_cache_ttl, max_bytes=int(args.result_cache_mb * 1024 * 1024), recorder=recorder)
+        search_kwargs["result_cache"] = result_cache
+
+    if args.max_token_score and not ingest:
+        if args.max_token_score != "auto":
+            max_token_score = float(args.max_token_score)
+        elif args.embedding_store and EmbeddingStore.exists(args.embedding_store):
+            max_token_score = EmbeddingStore(args.embedding_store).max_sparse_weight()
+        else:
+            # largest token weight of a sample of the indexed docs: tighter bound for the pruning than the constant
+            # (OpenSearch < 2.12 only, later versions ignore max_token_score); a lean index keeps the constant
+            try:
+                max_token_score = get_max_token_score(aos_client, index_name)
+            except ValueError as e:
+                print(f"max_token_score auto: {e}")
+                max_token_score = None
+        if max_token_score is not None:
+            search_kwargs["max_token_score"] = max_token_score
+            run_params["max_token_score"] = max_token_score
+        print(f"max_token_score:{max_token_score}")
 
-    aos_client = get_aos_client(aos_endpoint)
     url = f"https://public.ukp.informatik.tu-darmstadt.de/thakur/BEIR/datasets/{dataset_name}.zip"
     data_path = util.download_and_unzip(url, data_root_dir)
     corpus, queries, qrels = GenericDataLoader(data_folder=data_path).load(split="test")
     
+    if args.index_profiles:
+        search_kwargs["source"] = False
+        if args.embedding_cache:
+            search_kwargs["embedding_cache"] = QueryEmbeddingCache(args.embedding_cache)
+        strategies = args.strategies.split(',')
+        summary = benchmark_index_profiles(aos_client, aos_endpoint, index_name, args.index_profiles.split(','), corpus, queries, qrels, strategies, search_kwargs,
+                                           sparse_model_id, k=max(k_values), bulk_size=bulk_size, max_workers=ingest_workers, store_path=args.embedding_store,
+                                           concurrency=concurrency, msearch_size=msearch_size, run_dir=args.run_dir or "runs", rescore_oversample=args.rescore_oversample)
+        print("index profiles:")
+        for row in summary:
+            print(json.dumps(row))
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(summary, f, indent=2)
+        exit()
+
+    if args.prune_settings:
+        search_kwargs["source"] = False
+        strategies = args.strategies.split(',')
+        summary = benchmark_sparse_pruning(aos_client, aos_endpoint, index_name, args.prune_settings.split(','), corpus, queries, qrels, strategies, search_kwargs,
+                                           sparse_model_id, k=max(k_values), bulk_size=bulk_size, max_workers=ingest_workers, store_path=args.embedding_store,
+                                           concurrency=concurrency, msearch_size=msearch_size, run_dir=args.run_dir or "runs")
+        print("sparse pruning:")
+        for row in summary:
+            print(json.dumps(row))
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(summary, f, indent=2)
+        exit()
+
+    if args.partitions:
+        search_kwargs["source"] = False
+        if args.embedding_cache:
+            # embedded once, not once per partition
+            search_kwargs["embedding_cache"] = QueryEmbeddingCache(args.embedding_cache)
+        strategies = args.strategies.split(',')
+        summary = benchmark_partitions(aos_client, aos_endpoint, index_name, [int(partitions) for partitions in args.partitions.split(',')], corpus, queries, qrels, strategies,
+                                       search_kwargs, k=max(k_values), layout=args.partition_layout, bulk_size=bulk_size, max_workers=ingest_workers,
+                                       store_path=args.embedding_store, concurrency=concurrency, run_dir=args.run_dir or "runs",
+                                       normalization=args.partition_normalization)
+        print("partitions:")
+        for row in summary:
+            print(json.dumps(row))
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(summary, f, indent=2)
+        exit()
+
+    if args.compare_clients:
+        # same queries and documents through every client config of client_benchmark.CLIENT_CONFIGS, baseline first
+        search_kwargs["source"] = False
+        if args.embedding_cache:
+            search_kwargs["embedding_cache"] = QueryEmbeddingCache(args.embedding_cache)
+        query_texts = list(queries.values())[:testset_size]
+        if args.embedding_store and EmbeddingStore.exists(args.embedding_store):
+            docs = [doc for doc, _ in zip(EmbeddingStore(args.embedding_store).iter_docs(), range(testset_size))]
+        else:
+            docs = [(doc_id, {"content": doc["title"]+" "+doc["text"]}) for doc_id, doc in list(corpus.items())[:testset_size]]
+        results = compare_clients(aos_endpoint, index_name, query_texts, args.strategies.split(',')[0], search_kwargs, docs=docs,
+                                  concurrency=max(concurrency, ingest_workers), bulk_size=bulk_size)
+        print_client_comparison(results)
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(results, f, indent=2)
+        exit()
+
+    if ingest and args.batch_sizes:
+        # same documents through a batched copy of the ingest pipeline per batch size, the index itself is not touched
+        prune_type, prune_ratio = parse_prune_setting(args.sparse_prune) if args.sparse_prune else (None, None)
+        base_pipeline = create_pruned_ingest_pipeline(aos_client, prune_type, prune_ratio) if prune_type not in (None, "none") else "neural-sparse-pipeline"
+        docs = [(doc_id, {"content": doc["title"]+" "+doc["text"]}) for doc_id, doc in list(corpus.items())[:testset_size]]
+        results = compare_batch_sizes(aos_client, index_name, docs, [int(batch_size) for batch_size in args.batch_sizes.split(',')], base_pipeline,
+                                      bulk_size=bulk_size, max_workers=ingest_workers)
+        print_batch_size_comparison(results)
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(results, f, indent=2)
+        exit()
+
     if ingest is True:
         start = time.time()
-        ingest_dataset(corpus, aos_client=aos_client, index_name=index_name)
+        checkpoint = IngestCheckpoint(args.checkpoint) if args.checkpoint else None
+        prune_type, prune_ratio = parse_prune_setting(args.sparse_prune) if args.sparse_prune else (None, None)
+        if args.embedding_store:
+            stats = ingest_precomputed(corpus, aos_client, index_name, sparse_model_id, args.embedding_store, bulk_size=bulk_size, max_workers=ingest_workers, checkpoint=checkpoint, recorder=recorder,
+                               prune_type=prune_type, prune_ratio=prune_ratio)
+        else:
+            # pruning happens in a copy of neural-sparse-pipeline, the default_pipeline of the index is left alone
+            pipeline = create_pruned_ingest_pipeline(aos_client, prune_type, prune_ratio) if prune_type not in (None, "none") else None
+            if args.ingest_batch_size:
+                pipeline = create_batched_ingest_pipeline(aos_client, args.ingest_batch_size, base_pipeline=pipeline or "neural-sparse-pipeline")
+            stats = ingest_dataset(corpus, aos_client=InstrumentedClient(aos_client, recorder, "ingest"), index_name=index_name, bulk_size=bulk_size, max_workers=ingest_workers, checkpoint=checkpoint, pipeline=pipeline)
         elpase_time = time.time() - start
-        throughput = float(testset_size)/elpase_time
+        # docs actually indexed, not testset_size; 0 when a checkpoint says everything was indexed already
+        throughput = docs_per_second(stats["indexed"], elpase_time)
         print(f"[ingest] throughput/s:{throughput}")
+        print(f"[ingest] index stats:{get_index_stats(aos_client, index_name)}")
     else:
-        
-        run_res={}
-        for _id, query in tqdm(queries.items()):
-            hits = search_by_bm25(aos_client, index_name, query, topk)
-            run_res[_id]={item["_id"]:item["_score"] for item in hits}
-            
-        for query_id, doc_dict in tqdm(run_res.items()):
-            if query_id in doc_dict:
-                doc_dict.pop(query_id)
-        res = EvaluateRetrieval.evaluate(qrels, run_res, [1, 4,10])
-        print("search_by_bm25:")
-        print(res)
-        
-        run_res={}
-        for _id, query in tqdm(queries.items()):
-            hits = search_by_dense(aos_client, index_name, query, dense_model_id, topk)
-            run_res[_id]={item["_id"]:item["_score"] for item in hits}
-            
-        for query_id, doc_dict in tqdm(run_res.items()):
-            if query_id in doc_dict:
-                doc_dict.pop(query_id)
-        res = EvaluateRetrieval.evaluate(qrels, run_res, [1, 4,10])
-        print("search_by_dense:")
-        print(res)
-        
-        run_res={}
-        for _id, query in tqdm(queries.items()):
-            hits = search_by_sparse(aos_client, index_name, query, sparse_model_id, topk)
-            run_res[_id]={item["_id"]:item["_score"] for item in hits}
-            
-        for query_id, doc_dict in tqdm(run_res.items()):
-            if query_id in doc_dict:
-                doc_dict.pop(query_id)
-        res = EvaluateRetrieval.evaluate(qrels, run_res, [1, 4,10])
-        print("search_by_sparse:")
-        print(res)
-        
-        run_res={}
-        for _id, query in tqdm(queries.items()):
-            hits = search_by_dense_sparse(aos_client, index_name, query, sparse_model_id, dense_model_id, topk)
-            run_res[_id]={item["_id"]:item["_score"] for item in hits}
-            
-        for query_id, doc_dict in tqdm(run_res.items()):
-            if query_id in doc_dict:
-                doc_dict.pop(query_id)
-        res = EvaluateRetrieval.evaluate(qrels, run_res, [1, 4,10])
-        print("search_by_dense_sparse:")
-        print(res)
-        
-        run_res={}
-        for _id, query in tqdm(queries.items()):
-            hits = search_by_dense_bm25(aos_client, index_name, query, dense_model_id, topk)
-            run_res[_id]={item["_id"]:item["_score"] for item in hits}
-            
-        for query_id, doc_dict in tqdm(run_res.items()):
-            if query_id in doc_dict:
-                doc_dict.pop(query_id)
-        res = EvaluateRetrieval.evaluate(qrels, run_res, [1, 4,10])
-        print("search_by_dense_bm25:")
-        print(res)
\ No newline at end of file
+        # BEIR docs are indexed under their corpus id, hits are matched on _id only
+        search_kwargs["source"] = False
+        if args.embedding_cache:
+            embedding_cache = QueryEmbeddingCache(args.embedding_cache)
+            embedding_cache.get_embeddings(list(queries.values()))
+            print(f"query embeddings cached:{embedding_cache.hits}, newly embedded:{embedding_cache.misses}")
+            search_kwargs["embedding_cache"] = embedding_cache
+
+        if args.sweep:
+            grid = json.loads(args.sweep_grid) if args.sweep_grid else DEFAULT_GRID
+            points = sample_points(grid, args.sweep_samples) if args.sweep_samples > 0 else grid_points(grid)
+            sweep_queries = dict(list(queries.items())[:testset_size])
+            print(f"sweep of {len(points)} points x {len(sweep_queries)} queries, strategy:{args.sweep_strategy}")
+            results, frontier = run_sweep(aos_client, aos_endpoint, index_name, sweep_queries, qrels, args.sweep_strategy, search_kwargs, points,
+                                          k=max(k_values), concurrency=concurrency, msearch_size=msearch_size, output=args.sweep_output)
+            print(f"pareto frontier (ndcg@{max(k_values)} vs p90 latency):")
+            for result in frontier:
+                print(json.dumps(result))
+        else:
+            strategies = args.strategies.split(',')
+            if args.fusion_technique:
+                register_strategy("client_fusion", client_fusion_runner(fusion_legs, fusion_weights, args.fusion_technique))
+                strategies.append("client_fusion")
+            if args.two_phase:
+                register_strategy("sparse_two_phase", two_phase_sparse_runner(args.two_phase))
+                strategies.append("sparse_two_phase")
+            if args.cascade:
+                if not args.embedding_cache:
+                    parser.error("--cascade rescores with the query vectors of --embedding_cache")
+                cascade_store = None
+                if args.cascade_rescore == "client":
+                    if not (args.embedding_store and EmbeddingStore.exists(args.embedding_store)):
+                        parser.error("--cascade_rescore client compares against the document vectors of --embedding_store")
+                    cascade_store = EmbeddingStore(args.embedding_store)
+                run_params["cascade_rescore"] = args.cascade_rescore
+                for stage in args.cascade.split(','):
+                    for candidates in [int(candidates) for candidates in args.cascade_candidates.split(',')]:
+                        name = f"cascade_{stage}_{candidates}"
+                        register_strategy(name, cascade_runner(stage, candidates, cascade_store, name))
+                        strategies.append(name)
+                # the hybrid queries the cascades are meant to replace
+                strategies += [strategy for strategy in ["dense_sparse", "dense_bm25"] if strategy not in strategies]
+            run_dir = args.run_dir or f"runs/{dataset_name}_{index_name}"
+            for number in range(args.result_cache_passes if result_cache is not None else 1):
+                # later passes skip the run files, their queries have to go through the cache
+                runs = run_strategies(aos_client, aos_endpoint, index_name, queries, strategies, search_kwargs, run_dir,
+                                      concurrency, msearch_size, recorder, run_params, reuse=not args.refresh_runs and number == 0)
+            if result_cache is not None:
+                print(f"result cache:{json.dumps(result_cache.report())}")
+
+            # a doc with the id of the query does not count (BEIR convention)
+            results = evaluate_runs(qrels, runs, k_values, bootstrap=args.bootstrap)
+            for strategy, result in results.items():
+                print(f"search_by_{strategy}: {result['queries']} queries, {result['queries_without_hits']} without hits (not averaged)")
+                print(format_metrics(result, k_values))
+            if args.cascade:
+                # latency / quality trade-off of the cascades against the hybrid queries, at the largest cutoff
+                report = recorder.report()
+                k = max(k_values)
+                for strategy in [strategy for strategy in strategies if strategy.startswith("cascade_") or strategy in ("dense_sparse", "dense_bm25")]:
+                    latency = report.get(strategy, {}).get("latency_ms", {})
+                    print(f"[cascade] {strategy}: ndcg@{k}:{results[strategy][f'ndcg@{k}']:.4f} recall@{k}:{results[strategy][f'recall@{k}']:.4f} p50(ms):{latency.get('p50')} p99(ms):{latency.get('p99')}")
+
+    # store_bytes and mean_response_bytes are the numbers to compare between a lean and a regular index
+    print(f"index stats:{get_index_stats(aos_client, index_name)}")
+    recorder.print_report()
+    if report_json:
+        recorder.to_json(report_json)
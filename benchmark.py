@@ -1,55 +1,68 @@
 import time
+import json
 import argparse
+from itertools import islice
 from tqdm import tqdm
 from datasets import load_dataset
-from setup_model_and_pipeline import get_aos_client
-from search_func import search_by_bm25, search_by_dense, search_by_sparse, search_by_dense_sparse, search_by_dense_bm25
+from setup_model_and_pipeline import get_aos_client, CONNECTION_CLASSES, get_index_stats, get_max_token_score, create_pruned_ingest_pipeline, create_batched_ingest_pipeline
+from search_func import STRATEGIES
+from instrumentation import Recorder, InstrumentedClient
+from bulk_ingest import BulkIngester, IngestCheckpoint, content_doc_id, docs_per_second, ingest_resumable
+from embedding_cache import QueryEmbeddingCache
+from sparse_query_encoder import SparseQueryEncoder
+from hybrid_fusion import FUSION_TECHNIQUES
+from strategy_runner import run_strategies, register_strategy, client_fusion_runner, two_phase_sparse_runner, cascade_runner
+from embedding_store import EmbeddingStore, precompute_embeddings
+from sparse_pruning import parse_prune_setting
+from client_benchmark import compare_clients, print_client_comparison
+from ingest_benchmark import compare_batch_sizes, print_batch_size_comparison
+from result_cache import SearchResultCache
+from metrics import evaluate_runs, format_metrics
 from datasets import load_dataset
 
-def deduplicate_dataset(dataset):
-    context_list = [row["context"] for row in dataset]
-    context_set = set(context_list)
-    return list(context_set)
-
-def build_bulk_body(index_name,sources_list):
-    bulk_body = []
-    for source in sources_list:
-        bulk_body.append({ "index" : { "_index" : index_name} })
-        bulk_body.append(source)
-    return bulk_body
-
-def ingest_dataset(dataset,aos_client,index_name, bulk_size=50):
-    print("Deduplicating dataset...")
-    context_list = deduplicate_dataset(dataset)
-    # 19029 for train, 1204 for validation
-    print(f"Finished deduplication. Total number of passages: {len(context_list)}")
-
-    for start_idx in tqdm(range(0,len(context_list),bulk_size)):
-        contexts = context_list[start_idx:start_idx+bulk_size]
-        response = aos_client.bulk(
-            build_bulk_body(index_name, [{"content":context} for context in contexts]),
-            # set a large timeout because a new sparse encoding endpoint need warm up
-            request_timeout=100
+def ingest_dataset(dataset,aos_client,index_name, bulk_size=50, max_workers=8, checkpoint=None, split="train", pipeline=None):
+    # rows are read lazily and deduplicated on a digest of the context
+    # 19029 passages for train, 1204 for validation
+    with tqdm(unit="doc") as progress:
+        # set a large timeout because a new sparse encoding endpoint need warm up
+        ingester = BulkIngester(aos_client, index_name, bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline=pipeline, progress=progress.update)
+        stats = ingest_resumable(
+            ingester,
+            dataset,
+            lambda row: (content_doc_id(row["context"]), {"content":row["context"]}),
+            checkpoint=checkpoint,
+            key=split,
+            dedup_key=lambda row: row["context"]
         )
-        assert response["errors"]==False
+    print(f"[{split}] indexed:{stats['indexed']}, failed:{stats['failed']}, duplicates:{stats['duplicates']}, already committed:{stats['skipped']}, retried batches:{stats['retries']}, final concurrency:{stats['final_concurrency']}")
+    assert stats["failed"]==0, stats["errors"]
 
     aos_client.indices.refresh(index=index_name,request_timeout=100)
+    return stats
 
-def calc_recall(metric, answer, results):
-    if answer in results[:1]:
-        metric['hit_1'] += 1
-    else:
-        metric['miss_1'] += 1
+def ingest_precomputed(dataset, aos_client, index_name, sparse_model_id, store_path, bulk_size=50, max_workers=8, checkpoint=None, recorder=None,
+                       prune_type=None, prune_ratio=None):
+    # embeddings are computed once into store_path, re-ingesting from the store needs no model inference
+    # _predict calls are reported as "precompute" so they do not skew the _bulk latency of "ingest"
+    precompute_client = InstrumentedClient(aos_client, recorder, "precompute") if recorder is not None else aos_client
+    ingest_client = InstrumentedClient(aos_client, recorder, "ingest") if recorder is not None else aos_client
+    if not EmbeddingStore.exists(store_path):
+        passages = {}
+        for split in ["train", "validation"]:
+            for row in dataset[split]:
+                passages.setdefault(content_doc_id(row["context"]), row["context"])
+        with tqdm(total=len(passages), desc="precompute") as progress:
+            precompute_embeddings(precompute_client, sparse_model_id, passages.items(), store_path, max_workers=max_workers, progress=progress.update)
+    store = EmbeddingStore(store_path)
+    with tqdm(total=len(store), desc="ingest") as progress:
+        # _none skips the default_pipeline of an index created for inference at ingest
+        ingester = BulkIngester(ingest_client, index_name, bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline="_none", progress=progress.update)
+        stats = ingest_resumable(ingester, store.iter_docs(prune_type, prune_ratio), lambda doc: doc, checkpoint=checkpoint, key="embedding_store")
+    print(f"[embedding_store] indexed:{stats['indexed']}, failed:{stats['failed']}, already committed:{stats['skipped']}, retried batches:{stats['retries']}, final concurrency:{stats['final_concurrency']}")
+    assert stats["failed"]==0, stats["errors"]
 
-    if answer in results[:4]:
-        metric['hit_4'] += 1
-    else:
-        metric['miss_4'] += 1
-
-    if answer in results[:10]:
-        metric['hit_10'] += 1
-    else:
-        metric['miss_10'] += 1
+    aos_client.indices.refresh(index=index_name,request_timeout=100)
+    return stats
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -63,6 +76,45 @@ if __name__ == '__main__':
     parser.add_argument("--ingest", action="store_true", help="is ingest or search")
     parser.add_argument("--query_dataset_type", type=str, default='validation', help='use validation set or train set to query')
     parser.add_argument("--dataset_name", type=str, default='squad_v2', help='specify the dataset')
+    parser.add_argument("--concurrency", type=int, default=1, help='number of in-flight search requests, >1 uses AsyncOpenSearch')
+    parser.add_argument("--msearch_size", type=int, default=0, help='queries packed into one _msearch request, 0 sends one _search per query')
+    parser.add_argument("--bulk_size", type=int, default=50, help='documents per _bulk request')
+    parser.add_argument("--checkpoint", type=str, default='', help='json file of committed ingest offsets, a restarted ingest continues from it')
+    parser.add_argument("--streaming", action="store_true", help='stream the dataset instead of downloading it before ingest')
+    parser.add_argument("--embedding_store", type=str, default='', help='directory of precomputed embeddings, created on first ingest, documents are then indexed without ingest pipeline')
+    parser.add_argument("--sparse_prune", type=str, default='', help='prune sparse vectors at ingest, <prune_type>:<prune_ratio> e.g. max_ratio:0.1, top_k:64, abs_value:0.05, alpha_mass:0.9')
+    parser.add_argument("--ingest_workers", type=int, default=8, help='max number of in-flight _bulk requests')
+    parser.add_argument("--embedding_cache", type=str, default='', help='sqlite file caching query embeddings, dense legs then send knn queries with the cached vector')
+    parser.add_argument("--sparse_tokenizer", type=str, default='', help='tokenizer.json of the doc-only sparse model, with --sparse_idf encodes sparse queries client side')
+    parser.add_argument("--sparse_idf", type=str, default='', help='idf.json of the doc-only sparse model')
+    parser.add_argument("--sparse_top_n", type=int, default=None, help='keep the n heaviest query tokens')
+    parser.add_argument("--sparse_min_weight", type=float, default=0.0, help='drop query tokens lighter than this')
+    parser.add_argument("--fusion_technique", type=str, default='', choices=['']+FUSION_TECHNIQUES, help='also run client-side fusion of --fusion_legs with this technique')
+    parser.add_argument("--fusion_legs", type=str, default='sparse,dense', help='comma separated legs of the client-side fusion: sparse, dense, bm25')
+    parser.add_argument("--fusion_weights", type=str, default='', help='comma separated weight per fusion leg, equal weights by default')
+    parser.add_argument("--two_phase", type=str, default='', choices=['', 'pipeline', 'client'], help='also run sparse_two_phase: two-phase sparse search by neural-sparse-two-phase-pipeline or as a client-side rescore (needs --sparse_tokenizer / --sparse_idf)')
+    parser.add_argument("--cascade", type=str, default='', help='comma separated first stages (bm25, sparse) of cascade runs: the stage ranks, exact dense similarity rescores its top --cascade_candidates (needs --embedding_cache); dense_sparse and dense_bm25 run next to them, use --refresh_runs for their latency')
+    parser.add_argument("--cascade_candidates", type=str, default='100', help='comma separated candidate counts, one cascade_<stage>_<n> run per stage and count')
+    parser.add_argument("--cascade_rescore", type=str, default='script', choices=['script', 'client'], help='rescore by the knn_score script on the cluster, or on the client against the vectors of --embedding_store')
+    parser.add_argument("--max_token_score", type=str, default='', help='max_token_score of neural_sparse queries (ignored by OpenSearch 2.12+), a number or auto for the largest token weight in the index (in --embedding_store if given)')
+    parser.add_argument("--strategies", type=str, default=','.join(STRATEGIES), help='comma separated strategies to run, all of them run at the same time')
+    parser.add_argument("--k_values", type=str, default='1,4,10', help='comma separated cutoffs of the recall / mrr / ndcg report')
+    parser.add_argument("--bootstrap", type=int, default=0, help='bootstrap resamples of the questions for 95%% confidence intervals of every metric, 0 for none')
+    parser.add_argument("--run_dir", type=str, default='', help='directory of the TREC run files, runs/<dataset>_<split>_<index> by default')
+    parser.add_argument("--refresh_runs", action="store_true", help='query the cluster again even if a matching run file exists')
+    parser.add_argument("--pool_maxsize", type=int, default=10, help='connections kept alive per host, size it to the threads sharing the client (--ingest_workers)')
+    parser.add_argument("--http_compress", action="store_true", help='gzip request bodies (_bulk, _msearch, query vectors) and accept gzip responses')
+    parser.add_argument("--connection", type=str, default='requests', choices=list(CONNECTION_CLASSES), help='http connection class of the client, urllib3 skips the requests layer')
+    parser.add_argument("--sniff", action="store_true", help='discover the cluster nodes, self-managed clusters only (not Amazon OpenSearch Service); several comma separated --aos_endpoint are used round-robin')
+    parser.add_argument("--compare_clients", action="store_true", help='instead of the benchmark, send testset_size queries and documents through the baseline and the tuned clients of client_benchmark.py and report the throughput gain')
+    parser.add_argument("--ingest_batch_size", type=int, default=None, help='with --ingest, docs per model call of the ingest pipeline processors (OpenSearch 2.16+), through a batched copy of neural-sparse-pipeline')
+    parser.add_argument("--batch_sizes", type=str, default='', help='with --ingest, instead of the ingest, push testset_size passages through the ingest pipeline once per comma separated batch size (1,8,32,96) into scratch indices and report docs/s of each, sizes above --bulk_size behave like it')
+    parser.add_argument("--result_cache", action="store_true", help='cache search results (result_cache.py), a repeated query skips embedding and search until the index changes')
+    parser.add_argument("--result_cache_passes", type=int, default=1, help='with --result_cache, send the queries this many times, the later passes hit the cache')
+    parser.add_argument("--result_cache_ttl", type=float, default=300, help='seconds a cached result is served at most')
+    parser.add_argument("--result_cache_items", type=int, default=10000, help='max number of cached results')
+    parser.add_argument("--result_cache_mb", type=float, default=64, help='max size of the cached results in MB')
+    parser.add_argument("--report_json", type=str, default='', help='write the latency/throughput report to this json file')
     args = parser.parse_args()
     aos_endpoint = args.aos_endpoint
     aos_domain = '-'.join(aos_endpoint.split('-')[1:3])
@@ -73,117 +125,170 @@ if __name__ == '__main__':
     dense_model_id = args.dense_model_id
     sparse_model_id = args.sparse_model_id
     query_dataset_type = args.query_dataset_type
+    concurrency = args.concurrency
+    msearch_size = args.msearch_size
+    search_kwargs = {"sparse_model_id": sparse_model_id, "dense_model_id": dense_model_id, "topk": topk}
+    report_json = args.report_json
+    fusion_legs = args.fusion_legs.split(',')
+    fusion_weights = [float(weight) for weight in args.fusion_weights.split(',')] if args.fusion_weights else None
+    k_values = [int(k) for k in args.k_values.split(',')]
+    # everything besides index / queries / topk / model ids that changes the hits, a run file is only reused if these match
+    run_params = {"sparse_tokenizer": args.sparse_tokenizer, "sparse_idf": args.sparse_idf, "sparse_top_n": args.sparse_top_n, "sparse_min_weight": args.sparse_min_weight,
+                  "embedding_cache": bool(args.embedding_cache), "fusion_legs": fusion_legs, "fusion_weights": fusion_weights, "fusion_technique": args.fusion_technique,
+                  "two_phase": args.two_phase}
+    if args.sparse_tokenizer and args.sparse_idf:
+        search_kwargs["sparse_encoder"] = SparseQueryEncoder(args.sparse_tokenizer, args.sparse_idf, top_n=args.sparse_top_n, min_weight=args.sparse_min_weight)
+    bulk_size = args.bulk_size
+    ingest_workers = args.ingest_workers
+    recorder = Recorder()
 
     dataset_name = args.dataset_name
-    dataset = load_dataset(dataset_name)
+    # streaming only makes sense for ingest, search needs dataset.select
+    dataset = load_dataset(dataset_name, streaming=args.streaming and ingest)
+
+    aos_client = get_aos_client(aos_endpoint, pool_maxsize=args.pool_maxsize, http_compress=args.http_compress, sniff=args.sniff, connection=args.connection)
+    # the AsyncOpenSearch of --concurrency > 1 gets the same options, its pool holds one connection per in-flight query
+    search_kwargs["client_options"] = {"http_compress": args.http_compress, "sniff": args.sniff}
+    result_cache = None
+    if args.result_cache:
+        # the generation check goes through the plain client, cache hits are recorded as "result_cache"
+        result_cache = SearchResultCache(aos_client, max_items=args.result_cache_items, ttl=args.result_cache_ttl, max_bytes=int(args.result_cache_mb * 1024 * 1024), recorder=recorder)
+        search_kwargs["result_cache"] = result_cache
 
-    aos_client = get_aos_client(aos_endpoint)
+    if args.max_token_score and not ingest:
+        if args.max_token_score != "auto":
+            max_token_score = float(args.max_token_score)
+        elif args.embedding_store and EmbeddingStore.exists(args.embedding_store):
+            max_token_score = EmbeddingStore(args.embedding_store).max_sparse_weight()
+        else:
+            # largest token weight of a sample of the indexed docs: tighter bound for the pruning than the constant
+            # (OpenSearch < 2.12 only, later versions ignore max_token_score); a lean index keeps the constant
+            try:
+                max_token_score = get_max_token_score(aos_client, index_name)
+            except ValueError as e:
+                print(f"max_token_score auto: {e}")
+                max_token_score = None
+        if max_token_score is not None:
+            search_kwargs["max_token_score"] = max_token_score
+            run_params["max_token_score"] = max_token_score
+        print(f"max_token_score:{max_token_score}")
+
+    if args.compare_clients:
+        # same queries and passages through every client config of client_benchmark.CLIENT_CONFIGS, baseline first
+        items = dataset[query_dataset_type].select(range(testset_size))
+        search_kwargs["source"] = False
+        if args.embedding_cache:
+            search_kwargs["embedding_cache"] = QueryEmbeddingCache(args.embedding_cache)
+        if args.embedding_store and EmbeddingStore.exists(args.embedding_store):
+            docs = [doc for doc, _ in zip(EmbeddingStore(args.embedding_store).iter_docs(), range(testset_size))]
+        else:
+            docs = list({content_doc_id(item['context']): {"content": item['context']} for item in items}.items())
+        results = compare_clients(aos_endpoint, index_name, [item['question'] for item in items], args.strategies.split(',')[0], search_kwargs, docs=docs,
+                                  concurrency=max(concurrency, ingest_workers), bulk_size=bulk_size)
+        print_client_comparison(results)
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(results, f, indent=2)
+        exit()
+
+    if ingest and args.batch_sizes:
+        # same documents through a batched copy of the ingest pipeline per batch size, the index itself is not touched
+        prune_type, prune_ratio = parse_prune_setting(args.sparse_prune) if args.sparse_prune else (None, None)
+        base_pipeline = create_pruned_ingest_pipeline(aos_client, prune_type, prune_ratio) if prune_type not in (None, "none") else "neural-sparse-pipeline"
+        # passages of the first testset_size train questions, iterating works on a streamed dataset too
+        docs = list({content_doc_id(item['context']): {"content": item['context']} for item in islice(dataset["train"], testset_size)}.items())
+        results = compare_batch_sizes(aos_client, index_name, docs, [int(batch_size) for batch_size in args.batch_sizes.split(',')], base_pipeline,
+                                      bulk_size=bulk_size, max_workers=ingest_workers)
+        print_batch_size_comparison(results)
+        if report_json:
+            with open(report_json, "w") as f:
+                json.dump(results, f, indent=2)
+        exit()
 
     if ingest is True:
         start = time.time()
-        ingest_dataset(dataset=dataset["train"],aos_client=aos_client,index_name=index_name)
-        ingest_dataset(dataset=dataset["validation"],aos_client=aos_client,index_name=index_name)
+        ingest_client = InstrumentedClient(aos_client, recorder, "ingest")
+        checkpoint = IngestCheckpoint(args.checkpoint) if args.checkpoint else None
+        prune_type, prune_ratio = parse_prune_setting(args.sparse_prune) if args.sparse_prune else (None, None)
+        if args.embedding_store:
+            indexed = ingest_precomputed(dataset, aos_client, index_name, sparse_model_id, args.embedding_store, bulk_size=bulk_size, max_workers=ingest_workers, checkpoint=checkpoint, recorder=recorder,
+                               prune_type=prune_type, prune_ratio=prune_ratio)["indexed"]
+        else:
+            # pruning happens in a copy of neural-sparse-pipeline, the default_pipeline of the index is left alone
+            pipeline = create_pruned_ingest_pipeline(aos_client, prune_type, prune_ratio) if prune_type not in (None, "none") else None
+            if args.ingest_batch_size:
+                pipeline = create_batched_ingest_pipeline(aos_client, args.ingest_batch_size, base_pipeline=pipeline or "neural-sparse-pipeline")
+            indexed = ingest_dataset(dataset=dataset["train"],aos_client=ingest_client,index_name=index_name,bulk_size=bulk_size,max_workers=ingest_workers,checkpoint=checkpoint,split="train",pipeline=pipeline)["indexed"]
+            indexed += ingest_dataset(dataset=dataset["validation"],aos_client=ingest_client,index_name=index_name,bulk_size=bulk_size,max_workers=ingest_workers,checkpoint=checkpoint,split="validation",pipeline=pipeline)["indexed"]
         elpase_time = time.time() - start
-        throughput = float(testset_size)/elpase_time
+        # docs actually indexed, not testset_size; 0 when a checkpoint says everything was indexed already
+        throughput = docs_per_second(indexed, elpase_time)
         print(f"[ingest] throughput/s:{throughput}")
+        print(f"[ingest] index stats:{get_index_stats(aos_client, index_name)}")
     else:
         dataset = dataset[query_dataset_type]
-        print("start search by bm25")
-        metric = {
-            "hit_1" : 0,
-            "miss_1" : 0,
-            "hit_4" : 0,
-            "miss_4" : 0,
-            "hit_10" : 0,
-            "miss_10" : 0
-        }
-        for idx, item in tqdm(enumerate(dataset.select(range(testset_size)))):
-            query = item['question']
-            content = item['context']
-            response = search_by_bm25(aos_client, index_name, query, topk)
-            results = [hit["_source"]['content'] for hit in response ]
-            calc_recall(metric, content, results)
-
-        print(f"hit_1:{metric['hit_1']}, miss_1:{metric['miss_1']}, recall@1:{metric['hit_1']/(metric['hit_1']+metric['miss_1'])}")
-        print(f"hit_4:{metric['hit_4']}, miss_1:{metric['miss_4']}, recall@4:{metric['hit_4']/(metric['hit_4']+metric['miss_4'])}")
-        print(f"hit_10:{metric['hit_10']}, miss_10:{metric['miss_10']}, recall@10:{metric['hit_10']/(metric['hit_10']+metric['miss_10'])}")
-
-        print("start search by dense")
-        metric = {
-            "hit_1" : 0,
-            "miss_1" : 0,
-            "hit_4" : 0,
-            "miss_4" : 0,
-            "hit_10" : 0,
-            "miss_10" : 0
-        }
-        for idx, item in tqdm(enumerate(dataset.select(range(testset_size)))):
-            query = item['question']
-            content = item['context']
-            response = search_by_dense(aos_client, index_name, query, dense_model_id, topk)
-            results = [hit["_source"]['content'] for hit in response ]
-            calc_recall(metric, content, results)
-
-        print(f"hit_1:{metric['hit_1']}, miss_1:{metric['miss_1']}, recall@1:{metric['hit_1']/(metric['hit_1']+metric['miss_1'])}")
-        print(f"hit_4:{metric['hit_4']}, miss_1:{metric['miss_4']}, recall@4:{metric['hit_4']/(metric['hit_4']+metric['miss_4'])}")
-        print(f"hit_10:{metric['hit_10']}, miss_10:{metric['miss_10']}, recall@10:{metric['hit_10']/(metric['hit_10']+metric['miss_10'])}")
-
-        print("start search by sparse")
-        metric = {
-            "hit_1" : 0,
-            "miss_1" : 0,
-            "hit_4" : 0,
-            "miss_4" : 0,
-            "hit_10" : 0,
-            "miss_10" : 0
-        }
-        for idx, item in tqdm(enumerate(dataset.select(range(testset_size)))):
-            query = item['question']
-            content = item['context']
-            response = search_by_sparse(aos_client, index_name, query, sparse_model_id, topk)
-            results = [hit["_source"]['content'] for hit in response ]
-            calc_recall(metric, content, results)
-
-        print(f"hit_1:{metric['hit_1']}, miss_1:{metric['miss_1']}, recall@1:{metric['hit_1']/(metric['hit_1']+metric['miss_1'])}")
-        print(f"hit_4:{metric['hit_4']}, miss_1:{metric['miss_4']}, recall@4:{metric['hit_4']/(metric['hit_4']+metric['miss_4'])}")
-        print(f"hit_10:{metric['hit_10']}, miss_10:{metric['miss_10']}, recall@10:{metric['hit_10']/(metric['hit_10']+metric['miss_10'])}")
-
-        print("start search by dense-sparse")
-        metric = {
-            "hit_1" : 0,
-            "miss_1" : 0,
-            "hit_4" : 0,
-            "miss_4" : 0,
-            "hit_10" : 0,
-            "miss_10" : 0
-        }
-        for idx, item in tqdm(enumerate(dataset.select(range(testset_size)))):
-            query = item['question']
-            content = item['context']
-            response = search_by_dense_sparse(aos_client, index_name, query, sparse_model_id, dense_model_id, topk)
-            results = [hit["_source"]['content'] for hit in response ]
-            calc_recall(metric, content, results)
+        items = dataset.select(range(testset_size))
+        queries = [item['question'] for item in items]
+        contexts = [item['context'] for item in items]
+        # passages are indexed under content_doc_id, so hits are matched on _id and searches skip _source
+        passage_to_id = {context: content_doc_id(context) for context in set(contexts)}
+        answer_ids = [passage_to_id[context] for context in contexts]
+        search_kwargs["source"] = False
+        if args.embedding_cache:
+            embedding_cache = QueryEmbeddingCache(args.embedding_cache)
+            embedding_cache.get_embeddings(queries)
+            print(f"query embeddings cached:{embedding_cache.hits}, newly embedded:{embedding_cache.misses}")
+            search_kwargs["embedding_cache"] = embedding_cache
 
-        print(f"hit_1:{metric['hit_1']}, miss_1:{metric['miss_1']}, recall@1:{metric['hit_1']/(metric['hit_1']+metric['miss_1'])}")
-        print(f"hit_4:{metric['hit_4']}, miss_1:{metric['miss_4']}, recall@4:{metric['hit_4']/(metric['hit_4']+metric['miss_4'])}")
-        print(f"hit_10:{metric['hit_10']}, miss_10:{metric['miss_10']}, recall@10:{metric['hit_10']/(metric['hit_10']+metric['miss_10'])}")
+        strategies = args.strategies.split(',')
+        if args.fusion_technique:
+            register_strategy("client_fusion", client_fusion_runner(fusion_legs, fusion_weights, args.fusion_technique))
+            strategies.append("client_fusion")
+        if args.two_phase:
+            register_strategy("sparse_two_phase", two_phase_sparse_runner(args.two_phase))
+            strategies.append("sparse_two_phase")
+        if args.cascade:
+            if not args.embedding_cache:
+                parser.error("--cascade rescores with the query vectors of --embedding_cache")
+            cascade_store = None
+            if args.cascade_rescore == "client":
+                if not (args.embedding_store and EmbeddingStore.exists(args.embedding_store)):
+                    parser.error("--cascade_rescore client compares against the document vectors of --embedding_store")
+                cascade_store = EmbeddingStore(args.embedding_store)
+            run_params["cascade_rescore"] = args.cascade_rescore
+            for stage in args.cascade.split(','):
+                for candidates in [int(candidates) for candidates in args.cascade_candidates.split(',')]:
+                    name = f"cascade_{stage}_{candidates}"
+                    register_strategy(name, cascade_runner(stage, candidates, cascade_store, name))
+                    strategies.append(name)
+            # the hybrid queries the cascades are meant to replace
+            strategies += [strategy for strategy in ["dense_sparse", "dense_bm25"] if strategy not in strategies]
+        query_ids = [item['id'] for item in items]
+        answers = dict(zip(query_ids, answer_ids))
+        run_dir = args.run_dir or f"runs/{dataset_name}_{query_dataset_type}_{index_name}"
+        for number in range(args.result_cache_passes if result_cache is not None else 1):
+            # later passes skip the run files, their queries have to go through the cache
+            runs = run_strategies(aos_client, aos_endpoint, index_name, dict(zip(query_ids, queries)), strategies, search_kwargs, run_dir,
+                                  concurrency, msearch_size, recorder, run_params, reuse=not args.refresh_runs and number == 0)
+        if result_cache is not None:
+            print(f"result cache:{json.dumps(result_cache.report())}")
 
-        print("start search by dense-bm25")
-        metric = {
-            "hit_1" : 0,
-            "miss_1" : 0,
-            "hit_4" : 0,
-            "miss_4" : 0,
-            "hit_10" : 0,
-            "miss_10" : 0
-        }
-        for idx, item in tqdm(enumerate(dataset.select(range(testset_size)))):
-            query = item['question']
-            content = item['context']
-            response = search_by_dense_bm25(aos_client, index_name, query, dense_model_id, topk)
-            results = [hit["_source"]['content'] for hit in response ]
-            calc_recall(metric, content, results)
+        # one relevant passage per question, so recall@k is the hit rate at k and mrr@k its reciprocal rank
+        qrels = {query_id: {answer_id: 1} for query_id, answer_id in answers.items()}
+        results = evaluate_runs(qrels, runs, k_values, metrics=["recall", "mrr", "ndcg"], bootstrap=args.bootstrap)
+        for strategy, result in results.items():
+            print(f"search by {strategy}: {result['queries']} queries, {result['queries_without_hits']} without hits (not averaged)")
+            print(format_metrics(result, k_values, metrics=["recall", "mrr", "ndcg"]))
+        if args.cascade:
+            # latency / quality trade-off of the cascades against the hybrid queries, at the largest cutoff
+            report = recorder.report()
+            k = max(k_values)
+            for strategy in [strategy for strategy in strategies if strategy.startswith("cascade_") or strategy in ("dense_sparse", "dense_bm25")]:
+                latency = report.get(strategy, {}).get("latency_ms", {})
+                print(f"[cascade] {strategy}: mrr@{k}:{results[strategy][f'mrr@{k}']:.4f} recall@{k}:{results[strategy][f'recall@{k}']:.4f} p50(ms):{latency.get('p50')} p99(ms):{latency.get('p99')}")
 
-        print(f"hit_1:{metric['hit_1']}, miss_1:{metric['miss_1']}, recall@1:{metric['hit_1']/(metric['hit_1']+metric['miss_1'])}")
-        print(f"hit_4:{metric['hit_4']}, miss_1:{metric['miss_4']}, recall@4:{metric['hit_4']/(metric['hit_4']+metric['miss_4'])}")
-        print(f"hit_10:{metric['hit_10']}, miss_10:{metric['miss_10']}, recall@10:{metric['hit_10']/(metric['hit_10']+metric['miss_10'])}")
+    # store_bytes and mean_response_bytes are the numbers to compare between a lean and a regular index
+    print(f"index stats:{get_index_stats(aos_client, index_name)}")
+    recorder.print_report()
+    if report_json:
+        recorder.to_json(report_json)
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from opensearchpy.exceptions import TransportError, ConnectionError, ConnectionTimeout
+
+RETRYABLE_STATUS = {429, 502, 503, 504}
+REJECTED_ERROR_TYPE = "es_rejected_execution_exception"
+
+class ConcurrencyLimiter:
+    '''
+    Bounds the number of in-flight bulk requests. The limit moves by AIMD:
+    +1 after a fast, clean batch, halved after a rejection or when latency climbs above
+    `latency_tolerance` x the fastest batch seen so far (the no-queueing latency of the domain).
+    Latency is compared per doc and only for batches of at least `min_docs` docs: a retry resending a few
+    rejected docs or the partial last batch is fast and would otherwise become the reference for good.
+    The reference drifts back up by `min_decay` of the gap on every full batch, so it follows the domain.
+    '''
+    def __init__(self, initial_limit, min_limit=1, max_limit=16, latency_tolerance=2.0, smoothing=0.2, min_docs=1, min_decay=0.02):
+        self.limit = max(min(initial_limit, max_limit), min_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.min_docs = min_docs
+        self.min_decay = min_decay
+        self.in_flight = 0
+        self.min_latency = None
+        self.avg_latency = None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_result(self, latency, rejected, docs=1):
+        with self._condition:
+            if not rejected and docs < self.min_docs:
+                # too small to say anything about queueing, leave the limit alone
+                self._condition.notify_all()
+                return
+            if docs >= self.min_docs:
+                latency = latency / docs
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                else:
+                    self.min_latency += self.min_decay * (latency - self.min_latency)
+                self.avg_latency = latency if self.avg_latency is None else (1 - self.smoothing) * self.avg_latency + self.smoothing * latency
+            if rejected or (self.avg_latency is not None and self.avg_latency > self.latency_tolerance * self.min_latency):
+                self.limit = max(self.limit // 2, self.min_limit)
+                # forget the congested history so the limit can grow again once the domain recovers
+                self.avg_latency = self.min_latency
+            elif self.limit < self.max_limit:
+                self.limit += 1
+            self._condition.notify_all()
+
+def _is_retryable_item(result):
+    if result.get("status") in RETRYABLE_STATUS:
+        return True
+    error = result.get("error")
+    return isinstance(error, dict) and error.get("type") == REJECTED_ERROR_TYPE
+
+def content_doc_id(content):
+    # stable id from the passage text, re-ingesting the same passage overwrites instead of duplicating
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+def build_bulk_actions(index_name, docs):
+    # docs: list of (doc_id or None, source, ...), anything after source is bookkeeping of the caller
+    bulk_body = []
+    for doc in docs:
+        doc_id, source = doc[0], doc[1]
+        action = {"_index": index_name}
+        if doc_id is not None:
+            action["_id"] = doc_id
+        bulk_body.append({"index": action})
+        bulk_body.append(source)
+    return bulk_body
+
+class BulkIngester:
+    '''
+    Usage :
+        ingester = BulkIngester(aos_client, index_name, bulk_size=50, max_workers=8)
+        stats = ingester.ingest((doc_id, {"content": text}) for doc_id, text in corpus)
+
+    Keeps up to max_workers _bulk requests in flight, resends only the documents that were rejected
+    (429 / es_rejected_execution_exception / 5xx) with exponential backoff and full jitter,
+    and lets ConcurrencyLimiter pick the number of in-flight requests from the observed latency.
+    '''
+    def __init__(self, aos_client, index_name, bulk_size=50, max_workers=8, initial_workers=2, max_retries=8,
+                 initial_backoff=0.5, max_backoff=30.0, request_timeout=100, pipeline=None, progress=None, on_batch_done=None):
+        self.aos_client = aos_client
+        self.index_name = index_name
+        self.bulk_size = bulk_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.pipeline = pipeline
+        self.progress = progress
+        # on_batch_done(batch_number, batch, failed_count), batch numbers follow the input order
+        self.on_batch_done = on_batch_done
+        self.limiter = ConcurrencyLimiter(initial_workers, max_limit=max_workers, min_docs=bulk_size)
+        self._lock = threading.Lock()
+        self.stats = {"indexed": 0, "failed": 0, "retries": 0, "batches": 0, "errors": []}
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * (2 ** attempt)))
+
+    def _send(self, docs):
+        kwargs = {"request_timeout": self.request_timeout}
+        if self.pipeline is not None:
+            kwargs["pipeline"] = self.pipeline
+        start = time.perf_counter()
+        try:
+            response = self.aos_client.bulk(build_bulk_actions(self.index_name, docs), **kwargs)
+        except ConnectionTimeout:
+            # the transport already retried the timeout (retry_on_timeout), the request may still have been indexed:
+            # resending docs without _id would duplicate them, report them as failed instead
+            self.limiter.on_result(time.perf_counter() - start, rejected=True, docs=len(docs))
+            return [], [(doc[0], "request timed out") for doc in docs]
+        except ConnectionError:
+            self.limiter.on_result(time.perf_counter() - start, rejected=True, docs=len(docs))
+            return docs, []
+        except TransportError as e:
+            if e.status_code in RETRYABLE_STATUS:
+                self.limiter.on_result(time.perf_counter() - start, rejected=True, docs=len(docs))
+                return docs, []
+            raise
+
+        retry_docs, failed = [], []
+        if response["errors"]:
+            for doc, item in zip(docs, response["items"]):
+                result = list(item.values())[0]
+                if "error" not in result:
+                    continue
+                if _is_retryable_item(result):
+                    retry_docs.append(doc)
+                else:
+                    failed.append((doc[0], result["error"]))
+        self.limiter.on_result(time.perf_counter() - start, rejected=len(retry_docs) > 0, docs=len(docs))
+        return retry_docs, failed
+
+    def _ingest_batch(self, batch_number, docs):
+        try:
+            batch = docs
+            total = len(docs)
+            failed = []
+            for attempt in range(self.max_retries + 1):
+                docs, batch_failed = self._send(docs)
+                failed.extend(batch_failed)
+                if not docs:
+                    break
+                if attempt < self.max_retries:
+                    with self._lock:
+                        self.stats["retries"] += 1
+                    time.sleep(self._backoff(attempt))
+            # whatever is still rejected after max_retries counts as failed
+            failed.extend((doc[0], "rejected after retries") for doc in docs)
+            with self._lock:
+                self.stats["batches"] += 1
+                self.stats["indexed"] += total - len(failed)
+                self.stats["failed"] += len(failed)
+                self.stats["errors"].extend(failed[:max(10 - len(self.stats["errors"]), 0)])
+            if self.progress is not None:
+                self.progress(total)
+            if self.on_batch_done is not None:
+                self.on_batch_done(batch_number, batch, len(failed))
+        finally:
+            self.limiter.release()
+
+    def ingest(self, docs):
+        start = time.time()
+        futures = []
+        batch_numbers = iter(range(2 ** 62))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            def submit(batch):
+                # blocks while the limiter is full, so `docs` is read no faster than the domain indexes
+                self.limiter.acquire()
+                futures.append(executor.submit(self._ingest_batch, next(batch_numbers), batch))
+                # raise worker errors early and only keep the in-flight futures around
+                for future in [f for f in futures if f.done()]:
+                    future.result()
+                    futures.remove(future)
+
+            batch = []
+            for doc in docs:
+                batch.append(doc)
+                if len(batch) == self.bulk_size:
+                    submit(batch)
+                    batch = []
+            if batch:
+                submit(batch)
+            for future in futures:
+                future.result()
+
+        self.stats["elapsed_s"] = time.time() - start
+        self.stats["docs_per_s"] = self.stats["indexed"] / self.stats["elapsed_s"] if self.stats["elapsed_s"] > 0 else None
+        self.stats["final_concurrency"] = self.limiter.limit
+        return self.stats
+
+def docs_per_second(indexed, seconds):
+    # a resumed ingest that finds everything committed indexes nothing in next to no time
+    return indexed / seconds if seconds > 0 else 0.0
+
+def content_digest(text):
+    # 8 bytes per seen passage instead of the passage itself
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+class IngestCheckpoint:
+    '''
+    JSON file with the last committed input offset per key (e.g. per dataset split).
+    An offset is committed once every batch up to it has been indexed without failures.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.offsets = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.offsets = json.load(f)
+
+    def committed(self, key):
+        return self.offsets.get(key, -1)
+
+    def commit(self, key, offset):
+        with self._lock:
+            self.offsets[key] = offset
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.offsets, f)
+            os.replace(tmp_path, self.path)
+
+def ingest_resumable(ingester, rows, to_doc, checkpoint=None, key="default", dedup_key=None):
+    '''
+    Usage : ingest_resumable(ingester, dataset, lambda row: (content_doc_id(row["context"]), {"content": row["context"]}),
+                             IngestCheckpoint("ingest.ckpt"), "train", dedup_key=lambda row: row["context"])
+
+    Reads `rows` lazily, drops rows whose dedup_key was seen before (by digest) and indexes the rest through
+    `ingester`. Rows up to the committed offset of `key` are only hashed, so a restarted run continues after
+    the last fully indexed batch and still deduplicates against everything before it.
+    With deterministic doc ids, batches resent after a crash just overwrite the same documents.
+    '''
+    committed = checkpoint.committed(key) if checkpoint is not None else -1
+    seen = set()
+    lock = threading.Lock()
+    state = {"next_batch": 0, "done": {}, "resumed_from": committed, "skipped": 0, "duplicates": 0}
+
+    def docs():
+        for offset, row in enumerate(rows):
+            if dedup_key is not None:
+                digest = content_digest(dedup_key(row))
+                if digest in seen:
+                    state["duplicates"] += 1
+                    continue
+                seen.add(digest)
+            if offset <= committed:
+                state["skipped"] += 1
+                continue
+            doc_id, source = to_doc(row)
+            yield (doc_id, source, offset)
+
+    def on_batch_done(batch_number, batch, failed_count):
+        if checkpoint is None:
+            return
+        with lock:
+            # a batch with failed docs is never committed, the run resumes in front of it
+            if failed_count == 0:
+                state["done"][batch_number] = batch[-1][2]
+            offset = None
+            while state["next_batch"] in state["done"]:
+                offset = state["done"].pop(state["next_batch"])
+                state["next_batch"] += 1
+            if offset is not None:
+                checkpoint.commit(key, offset)
+
+    ingester.on_batch_done = on_batch_done
+    stats = ingester.ingest(docs())
+    stats["resumed_from"] = state["resumed_from"]
+    stats["skipped"] = state["skipped"]
+    stats["duplicates"] = state["duplicates"]
+    return stats
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from setup_model_and_pipeline import get_aos_client, create_index
+from search_func import search_by_strategy
+from instrumentation import Recorder, InstrumentedClient
+from bulk_ingest import BulkIngester
+
+# name -> get_aos_client options, pool_maxsize None is replaced by the concurrency of the run
+# baseline is the client the scripts always created: requests, 10 pooled connections, no compression
+CLIENT_CONFIGS = {
+    "baseline": {},
+    "pooled": {"pool_maxsize": None},
+    "pooled_compressed": {"pool_maxsize": None, "http_compress": True},
+    "urllib3_pooled_compressed": {"connection": "urllib3", "pool_maxsize": None, "http_compress": True}
+}
+
+def client_from_config(aos_endpoint, config, concurrency):
+    options = dict(config)
+    if "pool_maxsize" in options and options["pool_maxsize"] is None:
+        options["pool_maxsize"] = concurrency
+    return get_aos_client(aos_endpoint, **options)
+
+def search_throughput(aos_client, index_name, query_texts, strategy, search_kwargs, concurrency, recorder=None, label="search"):
+    # concurrency threads sharing aos_client, the connection pool is what differs between client configs
+    search_client = InstrumentedClient(aos_client, recorder, label) if recorder is not None else aos_client
+    # every query has to reach the cluster to measure the client
+    search_kwargs = {name: value for name, value in search_kwargs.items() if name not in ("client_options", "result_cache")}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(tqdm(executor.map(lambda query: search_by_strategy(search_client, index_name, query, strategy, **search_kwargs), query_texts),
+                         total=len(query_texts), desc=label))
+
+def bulk_throughput(aos_client, index_name, docs, bulk_size, concurrency, recorder=None, label="bulk"):
+    # docs go to a scratch copy of the index layout without ingest pipeline, so only transport cost is measured
+    scratch_index = f"{index_name}-client-benchmark"
+    if aos_client.indices.exists(index=scratch_index):
+        aos_client.indices.delete(index=scratch_index)
+    create_index(aos_client, scratch_index, default_pipeline=None)
+    try:
+        bulk_client = InstrumentedClient(aos_client, recorder, label) if recorder is not None else aos_client
+        ingester = BulkIngester(bulk_client, scratch_index, bulk_size=bulk_size, max_workers=concurrency, initial_workers=concurrency, pipeline="_none")
+        return ingester.ingest(docs)
+    finally:
+        aos_client.indices.delete(index=scratch_index)
+
+def compare_clients(aos_endpoint, index_name, query_texts, strategy, search_kwargs, docs=None, concurrency=16, bulk_size=50, configs=None, warmup=20):
+    '''
+    Usage :
+        results = compare_clients(aos_endpoint, index_name, query_texts, "dense_sparse", search_kwargs, docs=list(store.iter_docs()), concurrency=32)
+
+    For every client config (CLIENT_CONFIGS by default): `warmup` searches, then all query_texts from `concurrency` threads,
+    then docs ((doc_id, source) tuples, optional) into a scratch index with `concurrency` _bulk requests in flight.
+    Returns one row per config with qps / latency / docs/s and the gain against the first config (baseline).
+    '''
+    configs = configs or CLIENT_CONFIGS
+    results = []
+    for name, config in configs.items():
+        aos_client = client_from_config(aos_endpoint, config, concurrency)
+        if warmup > 0:
+            search_throughput(aos_client, index_name, query_texts[:warmup], strategy, search_kwargs, concurrency, label=f"{name}:warmup")
+        recorder = Recorder()
+        search_throughput(aos_client, index_name, query_texts, strategy, search_kwargs, concurrency, recorder, f"{name}:search")
+        if docs:
+            bulk_throughput(aos_client, index_name, docs, bulk_size, concurrency, recorder, f"{name}:bulk")
+        report = recorder.report()
+        search_report = report[f"{name}:search"]
+        result = {"client": name, "options": config, "search_qps": search_report["qps"],
+                  "search_p50_ms": search_report["latency_ms"]["p50"], "search_p99_ms": search_report["latency_ms"]["p99"]}
+        if docs:
+            bulk_report = report[f"{name}:bulk"]
+            result.update({"bulk_docs_per_s": bulk_report["docs_per_s"], "bulk_p50_ms": bulk_report["latency_ms"]["p50"]})
+        results.append(result)
+
+    baseline = results[0]
+    for result in results:
+        for metric in ["search_qps", "bulk_docs_per_s"]:
+            if result.get(metric) and baseline.get(metric):
+                result[metric.split("_")[0] + "_gain"] = result[metric] / baseline[metric]
+    return results
+
+def print_client_comparison(results):
+    for result in results:
+        line = f"[{result['client']}] search qps:{result['search_qps']:.1f} ({result.get('search_gain', 1.0):.2f}x), p50(ms):{result['search_p50_ms']:.1f}, p99(ms):{result['search_p99_ms']:.1f}"
+        if "bulk_docs_per_s" in result:
+            line += f", bulk docs/s:{result['bulk_docs_per_s']:.1f} ({result.get('bulk_gain', 1.0):.2f}x)"
+        print(line)
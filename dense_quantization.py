@@ -0,0 +1,68 @@
+import numpy as np
+
+# float: 4 bytes per dimension, int8: 1 byte (byte knn_vector), binary: 1 bit (binary knn_vector, hamming space)
+EMBEDDING_TYPES = ["float", "int8", "binary"]
+
+def quantize_int8(vectors, scale=None):
+    # symmetric scalar quantization, scale maps max |x| to 127 unless given (use one scale for all documents of an index)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if scale is None:
+        scale = 127.0 / max(float(np.abs(vectors).max()), 1e-12)
+    return np.clip(np.rint(vectors * scale), -128, 127).astype(np.int8)
+
+def quantize_binary(vectors):
+    # same layout as Cohere "binary": one bit per dimension (x > 0), 8 dimensions per byte, packed byte - 128 as int8
+    bits = np.packbits(np.asarray(vectors) > 0, axis=-1)
+    return (bits.astype(np.int16) - 128).astype(np.int8)
+
+def quantize(vectors, embedding_type="float", scale=None):
+    if embedding_type in (None, "float"):
+        return np.asarray(vectors, dtype=np.float32)
+    if embedding_type == "int8":
+        return quantize_int8(vectors, scale)
+    if embedding_type == "binary":
+        return quantize_binary(vectors)
+    raise ValueError(f"unknown embedding_type: {embedding_type}, expected one of {EMBEDDING_TYPES}")
+
+class QuantizedQueryEmbeddings:
+    '''
+    Usage :
+        query_embeddings = QuantizedQueryEmbeddings(QueryEmbeddingCache("query_embeddings.sqlite"), "int8")
+        search_by_dense(aos_client, index_name, query, dense_model_id, topk, embedding_cache=query_embeddings)
+
+    Drop-in for the embedding_cache of search_func.py when dense_embedding is a byte / binary field:
+    the float query embeddings of `embedding_cache` are quantized like the documents.
+    int8 scales every query on its own, a positive factor per query does not change the inner product ranking.
+    get_float_embedding keeps the full precision vector for rescore_hits.
+    '''
+    def __init__(self, embedding_cache, embedding_type="int8"):
+        self.embedding_cache = embedding_cache
+        self.embedding_type = embedding_type
+
+    def get_embeddings(self, texts):
+        return [quantize(vector, self.embedding_type).tolist() for vector in self.embedding_cache.get_embeddings(texts)]
+
+    def get_embedding(self, text):
+        return self.get_embeddings([text])[0]
+
+    def get_float_embedding(self, text):
+        return self.embedding_cache.get_embedding(text)
+
+def rescore_hits(hits, query_vector, store, topk):
+    '''
+    Usage : hits = rescore_hits(quantized_hits, float_query_vector, EmbeddingStore("fiqa_embeddings"), topk=10)
+
+    Re-ranks the candidates of a search over quantized vectors by the inner product of the full precision
+    query vector and the full precision document vectors of an embedding_store.EmbeddingStore.
+    Hits without a vector in the store keep their order behind the rescored ones.
+    '''
+    rows = [store.row_of(hit["_id"]) for hit in hits]
+    known = [(hit, row) for hit, row in zip(hits, rows) if row is not None]
+    unknown = [hit for hit, row in zip(hits, rows) if row is None]
+    if not known:
+        return hits[:topk]
+    matrix = np.asarray(store.dense[[row for _, row in known]], dtype=np.float32)
+    scores = matrix @ np.asarray(query_vector, dtype=np.float32)
+    rescored = [dict(hit, _score=float(score)) for (hit, _), score in zip(known, scores)]
+    rescored.sort(key=lambda hit: hit["_score"], reverse=True)
+    return (rescored + unknown)[:topk]
@@ -0,0 +1,124 @@
+import json
+import array
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+
+BEDROCK_EMBEDDING_MODELID = "cohere.embed-multilingual-v3"
+# Cohere embed on Bedrock accepts at most 96 texts per call
+COHERE_MAX_BATCH_SIZE = 96
+
+def get_embedding_bedrock(bedrock, text_arrs, input_type="search_query", model_id=BEDROCK_EMBEDDING_MODELID):
+    body = json.dumps({
+        "texts": text_arrs,
+        "input_type": input_type
+    })
+    bedrock_resp = bedrock.invoke_model(
+            body=body,
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+    response_body = json.loads(bedrock_resp.get('body').read())
+    embeddings = response_body['embeddings']
+    return embeddings
+
+class QueryEmbeddingCache:
+    '''
+    Usage :
+        embedding_cache = QueryEmbeddingCache("query_embeddings.sqlite")
+        embedding_cache.get_embeddings(queries)    # batched Bedrock calls for the misses only
+        search_by_dense(aos_client, index_name, query, dense_model_id, topk, embedding_cache=embedding_cache)
+
+    Embeddings are keyed by (model_id, input_type, text). Lookups go to an in-memory LRU first,
+    then to the sqlite file at `path` (omit it for a memory-only cache), and only then to Bedrock.
+    '''
+    def __init__(self, path=None, model_id=BEDROCK_EMBEDDING_MODELID, input_type="search_query", max_memory_items=100000,
+                 batch_size=COHERE_MAX_BATCH_SIZE, max_workers=4, bedrock=None):
+        self.model_id = model_id
+        self.input_type = input_type
+        self.max_memory_items = max_memory_items
+        self.batch_size = min(batch_size, COHERE_MAX_BATCH_SIZE)
+        self.max_workers = max_workers
+        self._bedrock = bedrock
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (model_id TEXT, input_type TEXT, text TEXT, vector BLOB, PRIMARY KEY (model_id, input_type, text))")
+            self._db.commit()
+
+    @property
+    def bedrock(self):
+        if self._bedrock is None:
+            self._bedrock = boto3.client(service_name='bedrock-runtime')
+        return self._bedrock
+
+    def _remember(self, text, vector):
+        self._memory[text] = vector
+        self._memory.move_to_end(text)
+        if len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, texts):
+        found = {}
+        with self._lock:
+            for text in texts:
+                if text in self._memory:
+                    self._memory.move_to_end(text)
+                    found[text] = self._memory[text]
+            on_disk = [text for text in texts if text not in found]
+            if self._db is not None and on_disk:
+                for start in range(0, len(on_disk), 500):
+                    chunk = on_disk[start:start+500]
+                    rows = self._db.execute(
+                        f"SELECT text, vector FROM embeddings WHERE model_id=? AND input_type=? AND text IN ({','.join('?' * len(chunk))})",
+                        [self.model_id, self.input_type] + chunk
+                    ).fetchall()
+                    for text, blob in rows:
+                        vector = array.array('f', blob).tolist()
+                        found[text] = vector
+                        self._remember(text, vector)
+        return found
+
+    def _store(self, texts, vectors):
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                self._remember(text, vector)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    [(self.model_id, self.input_type, text, array.array('f', vector).tobytes()) for text, vector in zip(texts, vectors)]
+                )
+                self._db.commit()
+
+    def _embed_batch(self, texts):
+        vectors = get_embedding_bedrock(self.bedrock, texts, self.input_type, self.model_id)
+        self._store(texts, vectors)
+        return vectors
+
+    def get_embeddings(self, texts):
+        unique_texts = list(dict.fromkeys(texts))
+        found = self._lookup(unique_texts)
+        missing = [text for text in unique_texts if text not in found]
+        self.hits += len(unique_texts) - len(missing)
+        self.misses += len(missing)
+
+        batches = [missing[start:start+self.batch_size] for start in range(0, len(missing), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, vectors in zip(batches, executor.map(self._embed_batch, batches)):
+                found.update(zip(batch, vectors))
+        return [found[text] for text in texts]
+
+    def get_embedding(self, text):
+        return self.get_embeddings([text])[0]
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
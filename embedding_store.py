@@ -0,0 +1,197 @@
+import os
+import json
+import array
+import shutil
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import boto3
+from embedding_cache import get_embedding_bedrock, BEDROCK_EMBEDDING_MODELID, COHERE_MAX_BATCH_SIZE
+from sparse_pruning import prune_sparse_vector
+from dense_quantization import quantize
+
+DENSE_DIMENSION = 1024
+
+def predict_sparse(aos_client, sparse_model_id, texts):
+    # POST /_plugins/_ml/_predict/sparse_encoding/<sparse_model_id>
+    # {
+    #   "text_docs": ["passage 1", "passage 2"]
+    # }
+    # same input the sparse_encoding processor of neural-sparse-pipeline sends, one call for the whole batch
+    request_body = {
+        "text_docs": texts
+    }
+
+    response = aos_client.transport.perform_request(
+        method="POST",
+        url=f"/_plugins/_ml/_predict/sparse_encoding/{sparse_model_id}",
+        body=json.dumps(request_body)
+    )
+
+    # local models return one inference result per text, remote models one result holding every text
+    vectors = []
+    for result in response["inference_results"]:
+        for output in result["output"]:
+            vectors.extend(output["dataAsMap"]["response"])
+    assert len(vectors) == len(texts), f"{len(texts)} texts but {len(vectors)} sparse vectors"
+    return vectors
+
+class EmbeddingStore:
+    '''
+    Usage :
+        if not EmbeddingStore.exists("squad_v2_embeddings"):
+            precompute_embeddings(aos_client, sparse_model_id, docs, "squad_v2_embeddings")
+        store = EmbeddingStore("squad_v2_embeddings")
+        ingester = BulkIngester(aos_client, index_name, pipeline="_none")
+        ingester.ingest(store.iter_docs())
+
+    Directory of precomputed document embeddings, row i of every file belongs to line i of docs.jsonl:
+        docs.jsonl                             {"id": ..., "content": ...} per document
+        dense.npy                              float32 (rows, dimension)
+        sparse_indptr.npy                      int64 (rows + 1), CSR offsets into the two arrays below
+        sparse_tokens.npy / sparse_weights.npy int32 index into sparse_vocab.json / float32 weight
+        meta.json                              written last, a store without it is incomplete
+    The .npy files are memory mapped, so a store larger than memory can still be indexed.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "sparse_vocab.json")) as f:
+            self.vocab = json.load(f)
+        self.dense = np.load(os.path.join(path, "dense.npy"), mmap_mode="r")
+        self.sparse_indptr = np.load(os.path.join(path, "sparse_indptr.npy"), mmap_mode="r")
+        self.sparse_tokens = np.load(os.path.join(path, "sparse_tokens.npy"), mmap_mode="r")
+        self.sparse_weights = np.load(os.path.join(path, "sparse_weights.npy"), mmap_mode="r")
+        self._rows = None
+        self._int8_scale = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def dense_vector(self, row, embedding_type="float"):
+        if embedding_type in (None, "float"):
+            return self.dense[row].tolist()
+        return quantize(self.dense[row], embedding_type, self.int8_scale()).tolist()
+
+    def int8_scale(self):
+        # one scale for every document: max |x| of the store -> 127
+        if self._int8_scale is None:
+            self._int8_scale = 127.0 / max(float(np.abs(self.dense).max()), 1e-12)
+        return self._int8_scale
+
+    def row_of(self, doc_id):
+        # row of doc_id, None if it is not in the store; the id -> row map is read from docs.jsonl on first use
+        if self._rows is None:
+            with open(os.path.join(self.path, "docs.jsonl")) as f:
+                self._rows = {json.loads(line)["id"]: row for row, line in enumerate(f)}
+        return self._rows.get(doc_id)
+
+    def sparse_vector(self, row):
+        start, end = self.sparse_indptr[row], self.sparse_indptr[row + 1]
+        return {self.vocab[token]: weight for token, weight in zip(self.sparse_tokens[start:end].tolist(), self.sparse_weights[start:end].tolist())}
+
+    def max_sparse_weight(self):
+        # max_token_score of an index ingested from this store
+        return float(self.sparse_weights.max()) if len(self.sparse_weights) else 0.0
+
+    def iter_docs(self, prune_type=None, prune_ratio=None, embedding_type="float"):
+        # (doc_id, source) tuples for BulkIngester, the embeddings are already in source so no ingest pipeline is needed
+        # the store keeps the full sparse vectors, prune_type / prune_ratio prune them on the way out (sparse_pruning.py),
+        # embedding_type int8 / binary quantizes the dense vectors for a byte / binary dense_embedding (dense_quantization.py)
+        with open(os.path.join(self.path, "docs.jsonl")) as f:
+            for row, line in enumerate(f):
+                doc = json.loads(line)
+                yield (doc["id"], {
+                    "content": doc["content"],
+                    "dense_embedding": self.dense_vector(row, embedding_type),
+                    "sparse_embedding": prune_sparse_vector(self.sparse_vector(row), prune_type, prune_ratio)
+                })
+
+def _write_npy(path, dtype, shape):
+    # turns the raw rows appended to <path>.part into a .npy file, copied block by block
+    with open(path, "wb") as f:
+        np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": shape})
+        with open(path + ".part", "rb") as part:
+            shutil.copyfileobj(part, f, 16 * 1024 * 1024)
+    os.remove(path + ".part")
+
+def precompute_embeddings(aos_client, sparse_model_id, docs, path, dense_model_id=BEDROCK_EMBEDDING_MODELID, dimension=DENSE_DIMENSION,
+                          dense_batch_size=COHERE_MAX_BATCH_SIZE, sparse_batch_size=32, max_workers=8, chunk_size=10000, bedrock=None, progress=None):
+    '''
+    Usage : precompute_embeddings(aos_client, sparse_model_id, ((doc_id, content) for ...), "squad_v2_embeddings", progress=tqdm().update)
+
+    Dense embeddings come straight from Bedrock Cohere (input_type search_document, dense_batch_size texts per call),
+    sparse embeddings from batched _predict calls of the sparse model, both with max_workers calls in flight.
+    docs is read lazily chunk_size documents at a time; the docs.jsonl rows and the dense / sparse arrays of a chunk are
+    appended to files on disk before the next chunk is read, so only one chunk (and the token vocabulary) is held in memory.
+    '''
+    bedrock = bedrock or boto3.client(service_name='bedrock-runtime')
+    os.makedirs(path, exist_ok=True)
+    dense_batch_size = min(dense_batch_size, COHERE_MAX_BATCH_SIZE)
+    docs = iter(docs)
+    vocab = {}
+    rows = 0
+    nnz = 0
+
+    def embed_dense(chunk_dense, start, texts):
+        # every batch writes its own rows of the chunk
+        chunk_dense[start:start+len(texts)] = np.asarray(get_embedding_bedrock(bedrock, texts, "search_document", dense_model_id), dtype=np.float32)
+        return len(texts)
+
+    def embed_sparse(texts):
+        return predict_sparse(aos_client, sparse_model_id, texts)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            open(os.path.join(path, "docs.jsonl"), "w") as docs_file, \
+            open(os.path.join(path, "dense.npy.part"), "wb") as dense_file, \
+            open(os.path.join(path, "sparse_indptr.npy.part"), "wb") as indptr_file, \
+            open(os.path.join(path, "sparse_tokens.npy.part"), "wb") as tokens_file, \
+            open(os.path.join(path, "sparse_weights.npy.part"), "wb") as weights_file:
+        indptr_file.write(np.zeros(1, dtype=np.int64).tobytes())
+        while True:
+            chunk = list(islice(docs, chunk_size))
+            if not chunk:
+                break
+            texts = [content for _, content in chunk]
+            chunk_dense = np.empty((len(texts), dimension), dtype=np.float32)
+            dense_futures = [executor.submit(embed_dense, chunk_dense, start, texts[start:start+dense_batch_size])
+                             for start in range(0, len(texts), dense_batch_size)]
+            sparse_futures = [executor.submit(embed_sparse, texts[start:start+sparse_batch_size])
+                              for start in range(0, len(texts), sparse_batch_size)]
+            for future in dense_futures:
+                future.result()
+            indptr = array.array('q')
+            tokens = array.array('i')
+            weights = array.array('f')
+            for future in sparse_futures:
+                for vector in future.result():
+                    for token, weight in vector.items():
+                        tokens.append(vocab.setdefault(token, len(vocab)))
+                        weights.append(weight)
+                    indptr.append(nnz + len(tokens))
+
+            for doc_id, content in chunk:
+                docs_file.write(json.dumps({"id": doc_id, "content": content}, ensure_ascii=False) + "\n")
+            dense_file.write(chunk_dense.tobytes())
+            indptr_file.write(indptr.tobytes())
+            tokens_file.write(tokens.tobytes())
+            weights_file.write(weights.tobytes())
+            rows += len(chunk)
+            nnz += len(tokens)
+            if progress is not None:
+                progress(len(texts))
+
+    _write_npy(os.path.join(path, "dense.npy"), np.float32, (rows, dimension))
+    _write_npy(os.path.join(path, "sparse_indptr.npy"), np.int64, (rows + 1,))
+    _write_npy(os.path.join(path, "sparse_tokens.npy"), np.int32, (nnz,))
+    _write_npy(os.path.join(path, "sparse_weights.npy"), np.float32, (nnz,))
+    with open(os.path.join(path, "sparse_vocab.json"), "w") as f:
+        json.dump(sorted(vocab, key=vocab.get), f, ensure_ascii=False)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"rows": rows, "dimension": dimension, "dense_model_id": dense_model_id, "sparse_model_id": sparse_model_id}, f)
+    return EmbeddingStore(path)
@@ -0,0 +1,108 @@
+import time
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from search_func import HYBRID_DENSE_K, MAX_TOKEN_SCORE, HYBRID_SEARCH_PIPELINE, build_strategy_body, search_by_body
+from instrumentation import InstrumentedClient
+
+FUSION_TECHNIQUES = ["min_max", "l2", "z_score", "rrf"]
+LEGS = ["sparse", "dense", "bm25"]
+
+_leg_executor = None
+
+def get_leg_executor(max_workers=16):
+    # shared by all queries so a benchmark does not pay for a new thread pool per query
+    global _leg_executor
+    if _leg_executor is None:
+        _leg_executor = ThreadPoolExecutor(max_workers=max_workers)
+    return _leg_executor
+
+def normalize(scores, present, technique):
+    # scores: (n_legs, n_docs) array, present: same shape bool mask of docs returned by each leg
+    masked = np.where(present, scores, np.nan)
+    with warnings.catch_warnings():
+        # a leg without hits is an all-NaN row, its NaN statistics are masked out below
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if technique == "min_max":
+            low = np.nanmin(masked, axis=1, keepdims=True)
+            high = np.nanmax(masked, axis=1, keepdims=True)
+            span = np.where(high > low, high - low, 1.0)
+            normalized = np.where(high > low, (masked - low) / span, 1.0)
+        elif technique == "l2":
+            norm = np.sqrt(np.nansum(masked ** 2, axis=1, keepdims=True))
+            normalized = masked / np.where(norm > 0, norm, 1.0)
+        elif technique == "z_score":
+            mean = np.nanmean(masked, axis=1, keepdims=True)
+            std = np.nanstd(masked, axis=1, keepdims=True)
+            normalized = (masked - mean) / np.where(std > 0, std, 1.0)
+        else:
+            raise ValueError(f"unknown normalization: {technique}, expected one of {FUSION_TECHNIQUES}")
+    # a doc missing from a leg gets no contribution from that leg
+    return np.where(present, normalized, 0.0)
+
+def fuse(leg_hits, weights=None, technique="min_max", topk=4, rrf_k=60):
+    '''
+    leg_hits: one hits list per leg (as returned by search_func), weights: one weight per leg.
+    min_max / l2 / z_score normalize the scores of each leg and take the weighted arithmetic mean,
+    rrf sums weight / (rrf_k + rank) over the legs. Returns the fused top-k hits, best first.
+    '''
+    weights = np.asarray(weights if weights is not None else [1.0] * len(leg_hits), dtype=np.float64)
+    doc_index = {}
+    first_hit = {}
+    for hits in leg_hits:
+        for hit in hits:
+            if hit["_id"] not in doc_index:
+                doc_index[hit["_id"]] = len(doc_index)
+                first_hit[hit["_id"]] = hit
+    if not doc_index:
+        return []
+
+    scores = np.zeros((len(leg_hits), len(doc_index)))
+    ranks = np.full((len(leg_hits), len(doc_index)), np.inf)
+    for leg, hits in enumerate(leg_hits):
+        columns = [doc_index[hit["_id"]] for hit in hits]
+        scores[leg, columns] = [hit["_score"] or 0.0 for hit in hits]
+        ranks[leg, columns] = np.arange(1, len(hits) + 1)
+    present = np.isfinite(ranks)
+
+    if technique == "rrf":
+        fused = (weights[:, None] / (rrf_k + ranks)).sum(axis=0)
+    else:
+        fused = (weights[:, None] * normalize(scores, present, technique)).sum(axis=0) / weights.sum()
+
+    doc_ids = list(doc_index)
+    order = np.argsort(-fused, kind="stable")[:topk]
+    return [dict(first_hit[doc_ids[column]], _score=float(fused[column])) for column in order]
+
+def search_by_client_fusion(aos_client, index_name, query, legs=("sparse", "dense"), sparse_model_id=None, dense_model_id=None, topk=4,
+                            weights=None, technique="min_max", leg_size=None, rrf_k=60, embedding_cache=None, sparse_encoder=None,
+                            source=None, recorder=None, label="client_fusion", hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE,
+                            two_phase=None):
+    '''
+    Usage : hits, latency_ms = search_by_client_fusion(aos_client, index_name, query, ("sparse", "dense"), sparse_model_id, dense_model_id, topk=10, weights=[0.3, 0.7], technique="rrf")
+    Runs every leg as its own _search in parallel and fuses the results here, so weights and technique
+    can change per request without touching hybird-search-pipeline.
+    latency_ms has one entry per leg, "fusion" for the fusion step alone and "total" for the whole call.
+    '''
+    leg_size = leg_size or max(topk, 10)
+    start = time.perf_counter()
+
+    def run_leg(leg):
+        request_body, search_pipeline = build_strategy_body(leg, query, sparse_model_id, dense_model_id, leg_size, embedding_cache, sparse_encoder, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase)
+        request_body["size"] = leg_size
+        leg_client = InstrumentedClient(aos_client, recorder, f"{label}:{leg}") if recorder is not None else aos_client
+        leg_start = time.perf_counter()
+        hits = search_by_body(leg_client, index_name, request_body, search_pipeline, source)
+        return hits, (time.perf_counter() - leg_start) * 1000
+
+    results = list(get_leg_executor().map(run_leg, legs))
+    fusion_start = time.perf_counter()
+    hits = fuse([leg_hits for leg_hits, _ in results], weights, technique, topk, rrf_k)
+    end = time.perf_counter()
+
+    latency_ms = {leg: leg_latency for leg, (_, leg_latency) in zip(legs, results)}
+    latency_ms["fusion"] = (end - fusion_start) * 1000
+    latency_ms["total"] = (end - start) * 1000
+    if recorder is not None:
+        recorder.record(label, end - start, time.time() - (end - start), queries=1)
+    return hits, latency_ms
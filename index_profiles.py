@@ -0,0 +1,147 @@
+import json
+import time
+from opensearchpy.exceptions import NotFoundError
+
+DENSE_DIMENSION = 1024
+
+# name -> dense_embedding field + shard layout, see build_dense_field_mapping
+# nmslib_hnsw is the mapping create_index always used; faiss profiles keep ef_search in the method parameters
+# (index.knn.algo_param.ef_search only applies to nmslib)
+INDEX_PROFILES = {
+    "nmslib_hnsw": {
+        "method": {"name": "hnsw", "engine": "nmslib", "space_type": "innerproduct", "parameters": {}}
+    },
+    "faiss_hnsw": {
+        "method": {"name": "hnsw", "engine": "faiss", "space_type": "innerproduct", "parameters": {"m": 16, "ef_construction": 128}}
+    },
+    "faiss_hnsw_m32": {
+        "method": {"name": "hnsw", "engine": "faiss", "space_type": "innerproduct", "parameters": {"m": 32, "ef_construction": 256}}
+    },
+    # fp16 scalar quantization, half the graph memory
+    "faiss_hnsw_fp16": {
+        "method": {"name": "hnsw", "engine": "faiss", "space_type": "innerproduct",
+                   "parameters": {"m": 16, "ef_construction": 128, "encoder": {"name": "sq", "parameters": {"type": "fp16"}}}}
+    },
+    # product quantization needs a trained model, see train_knn_model; 1024 dims / 128 sub-vectors x 8 bits = 128 bytes per vector
+    "faiss_hnsw_pq": {
+        "train": {"name": "hnsw", "engine": "faiss", "space_type": "innerproduct",
+                  "parameters": {"m": 16, "ef_construction": 128, "encoder": {"name": "pq", "parameters": {"m": 128, "code_size": 8}}}}
+    },
+    # quantized graph in memory, full precision vectors on disk for rescoring (OpenSearch 2.17+)
+    "on_disk_32x": {
+        "mode": "on_disk", "compression_level": "32x", "space_type": "innerproduct"
+    },
+    "on_disk_8x": {
+        "mode": "on_disk", "compression_level": "8x", "space_type": "innerproduct"
+    },
+    # Cohere int8 / binary embeddings (or a float embedding store quantized by dense_quantization.py), 4x / 32x smaller vectors;
+    # embedding_type is what the connector requests and the store ingests, data_type the field type
+    "lucene_hnsw_int8": {
+        "data_type": "byte", "embedding_type": "int8",
+        "method": {"name": "hnsw", "engine": "lucene", "space_type": "innerproduct", "parameters": {"m": 16, "ef_construction": 128}}
+    },
+    "faiss_hnsw_binary": {
+        "data_type": "binary", "embedding_type": "binary",
+        "method": {"name": "hnsw", "engine": "faiss", "space_type": "hamming", "parameters": {"m": 16, "ef_construction": 128}}
+    },
+    "faiss_hnsw_2_shards": {
+        "method": {"name": "hnsw", "engine": "faiss", "space_type": "innerproduct", "parameters": {"m": 16, "ef_construction": 128}},
+        "shards": 2, "replicas": 0
+    }
+}
+
+def build_dense_field_mapping(profile="nmslib_hnsw", dimension=DENSE_DIMENSION, ef_search=None, knn_model_id=None):
+    config = INDEX_PROFILES[profile]
+    if "train" in config:
+        if knn_model_id is None:
+            raise ValueError(f"index profile {profile} needs a trained model, create it with train_knn_model and pass knn_model_id")
+        # dimension, method and space come from the model
+        return {"type": "knn_vector", "model_id": knn_model_id}
+    mapping = {"type": "knn_vector", "dimension": dimension}
+    if "method" in config:
+        method = json.loads(json.dumps(config["method"]))
+        if ef_search is not None and method["engine"] == "faiss":
+            method["parameters"]["ef_search"] = ef_search
+        mapping["method"] = method
+    # binary fields count dimension in bits, 1024 dims = 128 bytes per vector
+    for name in ["data_type", "mode", "compression_level", "space_type"]:
+        if name in config:
+            mapping[name] = config[name]
+    return mapping
+
+def profile_embedding_type(profile):
+    # float / int8 / binary, see dense_quantization.EMBEDDING_TYPES
+    return INDEX_PROFILES[profile].get("embedding_type", "float")
+
+def profile_shards(profile, shards=None, replicas=None):
+    # explicit shards / replicas win over the profile, the profile over the single shard / no replica default
+    config = INDEX_PROFILES[profile]
+    return shards if shards is not None else config.get("shards", 1), replicas if replicas is not None else config.get("replicas", 0)
+
+def train_knn_model(aos_client, model_id, training_index, profile="faiss_hnsw_pq", training_field="dense_embedding", dimension=DENSE_DIMENSION,
+                    max_training_vector_count=None, timeout=1800):
+    # POST /_plugins/_knn/models/<model_id>/_train
+    # {
+    #   "training_index": "<index with float vectors>",
+    #   "training_field": "dense_embedding",
+    #   "dimension": 1024,
+    #   "method": {...}
+    # }
+    try:
+        model = aos_client.transport.perform_request(method="GET", url=f"/_plugins/_knn/models/{model_id}?filter_path=state")
+        if model.get("state") == "created":
+            # already trained, e.g. by an earlier benchmark run
+            return model_id
+    except NotFoundError:
+        pass
+
+    request_body = {
+        "training_index": training_index,
+        "training_field": training_field,
+        "dimension": dimension,
+        "description": f"{profile} trained on {training_index}",
+        "method": INDEX_PROFILES[profile]["train"]
+    }
+    if max_training_vector_count is not None:
+        request_body["max_training_vector_count"] = max_training_vector_count
+
+    aos_client.transport.perform_request(
+        method="POST",
+        url=f"/_plugins/_knn/models/{model_id}/_train",
+        body=json.dumps(request_body)
+    )
+
+    # training runs in the background, the model can be used once its state is "created"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        model = aos_client.transport.perform_request(method="GET", url=f"/_plugins/_knn/models/{model_id}?filter_path=state,error")
+        if model["state"] == "created":
+            return model_id
+        if model["state"] == "failed":
+            raise RuntimeError(f"training of knn model {model_id} failed: {model.get('error')}")
+        time.sleep(5)
+    raise TimeoutError(f"knn model {model_id} still training after {timeout}s")
+
+def warmup_knn_index(aos_client, index_name):
+    # loads the graphs of every segment into native memory, before that graph memory is not reported
+    return aos_client.transport.perform_request(method="GET", url=f"/_plugins/_knn/warmup/{index_name}")
+
+def get_knn_stats(aos_client, index_name=None):
+    '''
+    Sums GET /_plugins/_knn/stats over the nodes: graph memory (KB) overall and of `index_name`,
+    graph build (graph_index_requests / errors, total_load_time) and cache counters.
+    '''
+    response = aos_client.transport.perform_request(method="GET", url="/_plugins/_knn/stats")
+    summary = {"graph_memory_kb": 0, "index_graph_memory_kb": 0, "index_graph_count": 0, "graph_index_requests": 0, "graph_index_errors": 0,
+               "total_load_time_ns": 0, "eviction_count": 0, "hit_count": 0, "miss_count": 0, "cache_capacity_reached": False}
+    for node in response.get("nodes", {}).values():
+        summary["graph_memory_kb"] += node.get("graph_memory_usage", 0)
+        for name in ["graph_index_requests", "graph_index_errors", "eviction_count", "hit_count", "miss_count"]:
+            summary[name] += node.get(name, 0)
+        summary["total_load_time_ns"] += node.get("total_load_time", 0)
+        summary["cache_capacity_reached"] = summary["cache_capacity_reached"] or node.get("cache_capacity_reached", False)
+        if index_name is not None:
+            index_stats = node.get("indices_in_cache", {}).get(index_name, {})
+            summary["index_graph_memory_kb"] += index_stats.get("graph_memory_usage", 0)
+            summary["index_graph_count"] += index_stats.get("graph_count", 0)
+    return summary
@@ -0,0 +1,54 @@
+import time
+from tqdm import tqdm
+from setup_model_and_pipeline import create_index, create_batched_ingest_pipeline
+from instrumentation import Recorder, InstrumentedClient
+from bulk_ingest import BulkIngester
+
+def batch_size_throughput(aos_client, index_name, docs, batch_size, base_pipeline="neural-sparse-pipeline", bulk_size=50, max_workers=8, recorder=None, label="ingest"):
+    # docs through a copy of base_pipeline with batch_size, into a scratch copy of the index layout that is deleted afterwards
+    pipeline = create_batched_ingest_pipeline(aos_client, batch_size, base_pipeline)
+    scratch_index = f"{index_name}-batch-{batch_size}"
+    if aos_client.indices.exists(index=scratch_index):
+        aos_client.indices.delete(index=scratch_index)
+    create_index(aos_client, scratch_index, default_pipeline=None)
+    try:
+        bulk_client = InstrumentedClient(aos_client, recorder, label) if recorder is not None else aos_client
+        with tqdm(total=len(docs), desc=label) as progress:
+            ingester = BulkIngester(bulk_client, scratch_index, bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline=pipeline, progress=progress.update)
+            start = time.time()
+            stats = ingester.ingest(docs)
+            stats["seconds"] = time.time() - start
+        return stats
+    finally:
+        aos_client.indices.delete(index=scratch_index)
+
+def compare_batch_sizes(aos_client, index_name, docs, batch_sizes, base_pipeline="neural-sparse-pipeline", bulk_size=50, max_workers=8):
+    '''
+    Usage :
+        results = compare_batch_sizes(aos_client, index_name, docs, [1, 8, 32, 96], bulk_size=96)
+
+    Ingests the same docs ((doc_id, {"content": text}) tuples) once per batch size, each time through a batched copy
+    of base_pipeline (create_batched_ingest_pipeline) into a scratch index, so every run pays the model inference.
+    Processors batch within one _bulk request, a batch_size above bulk_size behaves like bulk_size.
+    Returns one row per batch size with docs/s, _bulk latency and the gain against the first batch size.
+    '''
+    results = []
+    for batch_size in batch_sizes:
+        label = f"batch_{batch_size}"
+        recorder = Recorder()
+        stats = batch_size_throughput(aos_client, index_name, docs, batch_size, base_pipeline, bulk_size, max_workers, recorder, label)
+        bulk_report = recorder.report()[label]
+        results.append({"batch_size": batch_size, "bulk_size": bulk_size, "indexed": stats["indexed"], "failed": stats["failed"], "retries": stats["retries"],
+                        "docs_per_s": stats["indexed"] / stats["seconds"], "bulk_p50_ms": bulk_report["latency_ms"]["p50"],
+                        "bulk_p99_ms": bulk_report["latency_ms"]["p99"]})
+
+    baseline = results[0]
+    for result in results:
+        if baseline["docs_per_s"]:
+            result["gain"] = result["docs_per_s"] / baseline["docs_per_s"]
+    return results
+
+def print_batch_size_comparison(results):
+    for result in results:
+        print(f"[batch_size {result['batch_size']}] docs/s:{result['docs_per_s']:.1f} ({result.get('gain', 1.0):.2f}x), bulk p50(ms):{result['bulk_p50_ms']:.1f}, "
+              f"p99(ms):{result['bulk_p99_ms']:.1f}, indexed:{result['indexed']}, failed:{result['failed']}, retried batches:{result['retries']}")
@@ -0,0 +1,351 @@
+import json
+import math
+import inspect
+import time
+import threading
+import contextvars
+
+# per-request attempt/size counters, shared by the request wrapper and the connection hook of the same thread or task
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+class LatencyHistogram:
+    '''
+    HDR-style histogram of non-negative integers (e.g. microseconds).
+    Values land in log-linear buckets holding `significant_figures` digits of precision,
+    so memory stays bounded whatever the value range and histograms merge by adding counts.
+    '''
+    def __init__(self, significant_figures=3):
+        self.significant_figures = significant_figures
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10 ** significant_figures))
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        shift = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return (shift << self.sub_bucket_bits) | (value >> shift)
+
+    def _bucket_value(self, bucket):
+        shift = bucket >> self.sub_bucket_bits
+        mantissa = bucket & ((1 << self.sub_bucket_bits) - 1)
+        return (mantissa << shift) + ((1 << shift) >> 1)
+
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        assert other.sub_bucket_bits == self.sub_bucket_bits
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = max(math.ceil(p / 100.0 * self.count), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(max(self._bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self, scale=1.0):
+        # percentiles/mean/max divided by `scale`, e.g. scale=1000 turns microseconds into milliseconds
+        if self.count == 0:
+            return {"count": 0}
+        summary = {"count": self.count, "mean": self.mean() / scale, "min": self.min / scale, "max": self.max / scale}
+        for p in PERCENTILES:
+            summary[f"p{p:g}"] = self.percentile(p) / scale
+        return summary
+
+    def to_dict(self):
+        return {
+            "significant_figures": self.significant_figures,
+            "counts": {str(bucket): count for bucket, count in self.counts.items()},
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["significant_figures"])
+        histogram.counts = {int(bucket): count for bucket, count in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+class LabelStats:
+    def __init__(self):
+        self.latency_us = LatencyHistogram()
+        self.took_ms = LatencyHistogram()
+        self.requests = 0
+        self.queries = 0
+        self.docs = 0
+        self.errors = 0
+        self.retries = 0
+        self.response_bytes = 0
+        self.first_start = None
+        self.last_end = None
+
+    def merge(self, other):
+        self.latency_us.merge(other.latency_us)
+        self.took_ms.merge(other.took_ms)
+        for name in ["requests", "queries", "docs", "errors", "retries", "response_bytes"]:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        if other.first_start is not None:
+            self.first_start = other.first_start if self.first_start is None else min(self.first_start, other.first_start)
+            self.last_end = other.last_end if self.last_end is None else max(self.last_end, other.last_end)
+        return self
+
+    def to_dict(self):
+        # json / pickle friendly, e.g. to send the stats of a worker process back for merging
+        data = {name: getattr(self, name) for name in ["requests", "queries", "docs", "errors", "retries", "response_bytes", "first_start", "last_end"]}
+        data["latency_us"] = self.latency_us.to_dict()
+        data["took_ms"] = self.took_ms.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for name in ["requests", "queries", "docs", "errors", "retries", "response_bytes", "first_start", "last_end"]:
+            setattr(stats, name, data[name])
+        stats.latency_us = LatencyHistogram.from_dict(data["latency_us"])
+        stats.took_ms = LatencyHistogram.from_dict(data["took_ms"])
+        return stats
+
+    def report(self):
+        elapsed = (self.last_end - self.first_start) if self.first_start is not None else 0
+        return {
+            "requests": self.requests,
+            "queries": self.queries,
+            "docs": self.docs,
+            "errors": self.errors,
+            "retries": self.retries,
+            "elapsed_s": elapsed,
+            "qps": self.queries / elapsed if elapsed > 0 else None,
+            "docs_per_s": self.docs / elapsed if elapsed > 0 else None,
+            "response_bytes": self.response_bytes,
+            "mean_response_bytes": self.response_bytes / self.requests if self.requests else None,
+            "latency_ms": self.latency_us.summary(scale=1000.0),
+            "took_ms": self.took_ms.summary()
+        }
+
+class Recorder:
+    '''
+    Usage :
+        recorder = Recorder()
+        search_by_dense(InstrumentedClient(aos_client, recorder, "dense"), index_name, query, dense_model_id, topk)
+        recorder.print_report()
+        recorder.to_json("report.json")
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, label, latency, start, took=None, response_bytes=0, retries=0, queries=0, docs=0, error=False):
+        with self._lock:
+            stats = self.stats.setdefault(label, LabelStats())
+            stats.latency_us.record(latency * 1e6)
+            if took is not None:
+                stats.took_ms.record(took)
+            stats.requests += 1
+            stats.queries += queries
+            stats.docs += docs
+            stats.errors += 1 if error else 0
+            stats.retries += retries
+            stats.response_bytes += response_bytes
+            stats.first_start = start if stats.first_start is None else min(stats.first_start, start)
+            stats.last_end = max(stats.last_end or 0, start + latency)
+
+    def merge(self, other):
+        with self._lock:
+            for label, stats in other.stats.items():
+                self.stats.setdefault(label, LabelStats()).merge(stats)
+        return self
+
+    def report(self):
+        with self._lock:
+            return {label: stats.report() for label, stats in self.stats.items()}
+
+    def to_dict(self):
+        with self._lock:
+            return {label: stats.to_dict() for label, stats in self.stats.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        recorder = cls()
+        recorder.stats = {label: LabelStats.from_dict(stats) for label, stats in data.items()}
+        return recorder
+
+    def print_report(self):
+        for label, report in self.report().items():
+            latency = report["latency_ms"]
+            line = f"[{label}] requests:{report['requests']}, errors:{report['errors']}, retries:{report['retries']}"
+            if report["queries"]:
+                line += f", qps:{report['qps']}"
+            if report["docs"]:
+                line += f", docs:{report['docs']}, docs/s:{report['docs_per_s']}"
+            if latency["count"]:
+                line += ", latency(ms) " + ", ".join(f"p{p:g}:{latency[f'p{p:g}']:.1f}" for p in PERCENTILES)
+            if report["took_ms"]["count"]:
+                line += f", took p50(ms):{report['took_ms']['p50']}"
+            line += f", mean_response_bytes:{report['mean_response_bytes']}"
+            print(line)
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+def _count_units(response):
+    # (queries, docs) carried by a response: _search -> 1 query, _msearch -> one per item, _bulk -> successful items
+    if not isinstance(response, dict):
+        return 0, 0
+    if "responses" in response:
+        return len(response["responses"]), 0
+    if "items" in response:
+        docs = sum(1 for item in response["items"] if "error" not in list(item.values())[0])
+        return 0, docs
+    if "hits" in response:
+        return 1, 0
+    return 0, 0
+
+def _record_response(recorder, label, start, start_perf, stats, response=None, error=False):
+    latency = time.perf_counter() - start_perf
+    queries, docs = _count_units(response)
+    took = response.get("took") if isinstance(response, dict) else None
+    recorder.record(label, latency, start, took=took, response_bytes=stats["response_bytes"],
+                    retries=max(stats["attempts"] - 1, 0), queries=queries, docs=docs, error=error)
+
+def measure(recorder, label, call):
+    stats = {"attempts": 0, "response_bytes": 0}
+    token = _request_stats.set(stats)
+    start, start_perf = time.time(), time.perf_counter()
+    try:
+        response = call()
+    except Exception:
+        _record_response(recorder, label, start, start_perf, stats, error=True)
+        raise
+    finally:
+        _request_stats.reset(token)
+    _record_response(recorder, label, start, start_perf, stats, response)
+    return response
+
+async def async_measure(recorder, label, call):
+    stats = {"attempts": 0, "response_bytes": 0}
+    token = _request_stats.set(stats)
+    start, start_perf = time.time(), time.perf_counter()
+    try:
+        response = await call()
+    except Exception:
+        _record_response(recorder, label, start, start_perf, stats, error=True)
+        raise
+    finally:
+        _request_stats.reset(token)
+    _record_response(recorder, label, start, start_perf, stats, response)
+    return response
+
+def _count_attempt(stats, result):
+    if stats is not None and result is not None:
+        data = result[2]
+        stats["response_bytes"] += len(data) if data else 0
+
+def _hook_connection(connection):
+    # every retry of the transport goes through connection.perform_request once
+    if getattr(connection, "_instrumented", False):
+        return
+    perform_request = connection.perform_request
+
+    if inspect.iscoroutinefunction(perform_request):
+        async def counting_perform_request(*args, **kwargs):
+            stats = _request_stats.get()
+            if stats is not None:
+                stats["attempts"] += 1
+            result = await perform_request(*args, **kwargs)
+            _count_attempt(stats, result)
+            return result
+    else:
+        def counting_perform_request(*args, **kwargs):
+            stats = _request_stats.get()
+            if stats is not None:
+                stats["attempts"] += 1
+            result = perform_request(*args, **kwargs)
+            _count_attempt(stats, result)
+            return result
+
+    connection.perform_request = counting_perform_request
+    connection._instrumented = True
+
+def _hook_transport(transport):
+    # connections of AsyncTransport are only created on the first request, so hook them as they are handed out
+    if getattr(transport, "_instrumented", False):
+        return
+    get_connection = transport.get_connection
+
+    def hooked_get_connection():
+        connection = get_connection()
+        _hook_connection(connection)
+        return connection
+
+    transport.get_connection = hooked_get_connection
+    transport._instrumented = True
+
+class _InstrumentedTransport:
+    def __init__(self, transport, recorder, label):
+        self._transport = transport
+        self.recorder = recorder
+        self.label = label
+
+    def perform_request(self, *args, **kwargs):
+        return measure(self.recorder, self.label, lambda: self._transport.perform_request(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+class _AsyncInstrumentedTransport(_InstrumentedTransport):
+    async def perform_request(self, *args, **kwargs):
+        return await async_measure(self.recorder, self.label, lambda: self._transport.perform_request(*args, **kwargs))
+
+class InstrumentedClient:
+    '''
+    Wraps an OpenSearch (or AsyncOpenSearch) client, every transport.perform_request and bulk call
+    is recorded into `recorder` under `label`. Everything else passes through to the wrapped client.
+    '''
+    def __init__(self, aos_client, recorder, label):
+        self._client = aos_client
+        self.recorder = recorder
+        self.label = label
+        self.is_async = inspect.iscoroutinefunction(aos_client.transport.perform_request)
+        transport_class = _AsyncInstrumentedTransport if self.is_async else _InstrumentedTransport
+        self.transport = transport_class(aos_client.transport, recorder, label)
+        _hook_transport(aos_client.transport)
+
+    def bulk(self, *args, **kwargs):
+        if self.is_async:
+            return async_measure(self.recorder, self.label, lambda: self._client.bulk(*args, **kwargs))
+        return measure(self.recorder, self.label, lambda: self._client.bulk(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
@@ -0,0 +1,201 @@
+import json
+import time
+import random
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from setup_model_and_pipeline import get_aos_client, CONNECTION_CLASSES
+from search_func import STRATEGIES, search_by_strategy
+from instrumentation import Recorder
+from embedding_cache import QueryEmbeddingCache
+from sparse_query_encoder import SparseQueryEncoder
+
+# fixed: one query every 1/rate seconds, poisson: exponential gaps with mean 1/rate (independent users)
+ARRIVALS = ["fixed", "poisson"]
+
+def arrival_times(rate, duration, arrival="poisson", seed=0):
+    # send offsets (seconds from the start) of an open-loop schedule of `rate` queries/s over `duration` seconds
+    rng = random.Random(seed)
+    offsets = []
+    offset = 0.0
+    while True:
+        offset += rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+        if offset >= duration:
+            return offsets
+        offsets.append(offset)
+
+def load_queries(path, limit=None):
+    # one query per line, or json lines with "text" (BEIR queries.jsonl) or "question" (squad)
+    queries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                row = json.loads(line)
+                line = row.get("text") or row["question"]
+            queries.append(line)
+            if limit is not None and len(queries) >= limit:
+                break
+    return queries
+
+def _worker_search_kwargs(config):
+    # clients, caches and encoders do not cross process boundaries, every worker builds its own from paths
+    search_kwargs = dict(config["search_kwargs"])
+    if config.get("embedding_cache"):
+        search_kwargs["embedding_cache"] = QueryEmbeddingCache(config["embedding_cache"])
+    if config.get("sparse_tokenizer") and config.get("sparse_idf"):
+        search_kwargs["sparse_encoder"] = SparseQueryEncoder(config["sparse_tokenizer"], config["sparse_idf"], top_n=config.get("sparse_top_n"),
+                                                             min_weight=config.get("sparse_min_weight", 0.0))
+    return search_kwargs
+
+def _run_worker(task):
+    # one process: sends its share of the schedule from `threads` threads, never waiting for a response before a send
+    config, strategy, schedule, start_at, threads = task
+    aos_client = get_aos_client(config["aos_endpoint"], pool_maxsize=threads, **config.get("client_options", {}))
+    search_kwargs = _worker_search_kwargs(config)
+    recorder = Recorder()
+
+    def send(query, scheduled):
+        sent = time.time()
+        error = False
+        try:
+            search_by_strategy(aos_client, config["index_name"], query, strategy, **search_kwargs)
+        except Exception:
+            error = True
+        end = time.time()
+        # latency from the scheduled send time: time spent waiting for a free thread / connection behind slow
+        # responses counts (no coordinated omission), service time from the actual send only for comparison
+        recorder.record(strategy, end - scheduled, scheduled, queries=1, error=error)
+        recorder.record(f"{strategy}:service", end - sent, sent, queries=1, error=error)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for offset, query in schedule:
+            scheduled = start_at + offset
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, query, scheduled)
+    return recorder.to_dict()
+
+def run_load_step(config, strategy, queries, rate, duration, processes=4, threads=32, arrival="poisson", seed=0, startup=3.0):
+    '''
+    Usage : row = run_load_step(config, "dense_sparse", queries, rate=50, duration=30, processes=4)
+
+    Sends rate x duration queries (cycling through `queries`) on an open-loop schedule, split round-robin over
+    `processes` worker processes with `threads` threads each, and merges the histograms of the workers.
+    The schedule starts `startup` seconds from now so that every worker has its client before the first send.
+    config: {"aos_endpoint", "index_name", "search_kwargs" (picklable: model ids, topk, source, ...), "client_options",
+             "embedding_cache" / "sparse_tokenizer" / "sparse_idf" / "sparse_top_n" / "sparse_min_weight" (paths and settings)}
+    '''
+    offsets = arrival_times(rate, duration, arrival, seed)
+    schedule = [(offset, queries[number % len(queries)]) for number, offset in enumerate(offsets)]
+    start_at = time.time() + startup
+    tasks = [(config, strategy, schedule[worker::processes], start_at, threads) for worker in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        parts = pool.map(_run_worker, tasks)
+    recorder = Recorder()
+    for part in parts:
+        recorder.merge(Recorder.from_dict(part))
+
+    report = recorder.report()
+    latency = report.get(strategy, {})
+    service = report.get(f"{strategy}:service", {})
+    errors = latency.get("errors", 0)
+    # offered: what the schedule actually sent (a poisson schedule varies around the target),
+    # achieved: successful queries over the step, or up to the last response if the domain fell behind
+    stats = recorder.stats.get(strategy)
+    window = max(duration, stats.last_end - start_at) if stats is not None else duration
+    row = {"strategy": strategy, "target_qps": rate, "arrival": arrival, "sent": len(schedule), "errors": errors,
+           "offered_qps": len(schedule) / duration, "achieved_qps": (latency.get("queries", 0) - errors) / window}
+    for name in ["p50", "p90", "p99", "p99.9"]:
+        row[f"{name}_ms"] = latency.get("latency_ms", {}).get(name)
+        row[f"service_{name}_ms"] = service.get("latency_ms", {}).get(name)
+    return row
+
+def saturation_point(curve, min_ratio=0.95, slo_p99_ms=None):
+    # highest target rate the domain still keeps up with: achieved >= min_ratio x offered, no errors, p99 within the slo
+    saturation = None
+    for row in sorted(curve, key=lambda row: row["target_qps"]):
+        keeps_up = row["achieved_qps"] >= min_ratio * row["offered_qps"] and row["errors"] == 0
+        if not keeps_up or (slo_p99_ms is not None and row["p99_ms"] > slo_p99_ms):
+            break
+        saturation = row["target_qps"]
+    return saturation
+
+def run_load_curve(config, strategies, queries, rates, duration, processes=4, threads=32, arrival="poisson", seed=0, startup=3.0,
+                   slo_p99_ms=None, output=None):
+    '''
+    Usage : curves, saturation = run_load_curve(config, ["bm25", "sparse", "dense_sparse"], queries, [10, 20, 50, 100], duration=30)
+
+    Throughput vs latency curve per strategy: one run_load_step per rate, lowest rate first, every row is appended
+    to `output` (json lines) as soon as it is measured. Returns ({strategy: rows}, {strategy: saturation qps}).
+    '''
+    curves = {}
+    for strategy in strategies:
+        curves[strategy] = []
+        for rate in sorted(rates):
+            row = run_load_step(config, strategy, queries, rate, duration, processes, threads, arrival, seed, startup)
+            curves[strategy].append(row)
+            print(f"[load] {json.dumps(row)}")
+            if output:
+                with open(output, "a") as f:
+                    f.write(json.dumps(row) + "\n")
+    return curves, {strategy: saturation_point(curve, slo_p99_ms=slo_p99_ms) for strategy, curve in curves.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aos_endpoint', type=str, default='', help='aos endpoint')
+    parser.add_argument('--index_name', type=str, default='', help='index name')
+    parser.add_argument('--queries', type=str, default='', help='query file, one query per line or json lines with a text / question field')
+    parser.add_argument('--query_limit', type=int, default=None, help='use the first n queries only')
+    parser.add_argument('--topk', type=int, default=4, help='top k')
+    parser.add_argument('--dense_model_id', type=str, default='', help='dense_model_id')
+    parser.add_argument('--sparse_model_id', type=str, default='', help='sparse_model_id')
+    parser.add_argument("--strategies", type=str, default=','.join(STRATEGIES), help='comma separated strategies, measured one after the other')
+    parser.add_argument("--rates", type=str, default='5,10,20,50,100', help='comma separated target queries/s, one step each')
+    parser.add_argument("--duration", type=float, default=30, help='seconds of every step')
+    parser.add_argument("--arrival", type=str, default='poisson', choices=ARRIVALS, help='arrival schedule of the queries')
+    parser.add_argument("--processes", type=int, default=4, help='worker processes sending queries (client json and signing stay off one GIL)')
+    parser.add_argument("--threads", type=int, default=32, help='max in-flight queries per process, also its connection pool size')
+    parser.add_argument("--startup", type=float, default=3.0, help='seconds between scheduling a step and its first send')
+    parser.add_argument("--seed", type=int, default=0, help='seed of the poisson schedule')
+    parser.add_argument("--slo_p99_ms", type=float, default=None, help='a step with a higher p99 is past the saturation point')
+    parser.add_argument("--embedding_cache", type=str, default='', help='sqlite file caching query embeddings, filled before the first step')
+    parser.add_argument("--sparse_tokenizer", type=str, default='', help='tokenizer.json of the doc-only sparse model, with --sparse_idf encodes sparse queries client side')
+    parser.add_argument("--sparse_idf", type=str, default='', help='idf.json of the doc-only sparse model')
+    parser.add_argument("--sparse_top_n", type=int, default=None, help='keep the n heaviest query tokens')
+    parser.add_argument("--sparse_min_weight", type=float, default=0.0, help='drop query tokens lighter than this')
+    parser.add_argument("--two_phase", type=str, default=None, choices=['pipeline', 'client'], help='two-phase sparse search of the sparse strategy')
+    parser.add_argument("--max_token_score", type=float, default=None, help='max_token_score of neural_sparse queries')
+    parser.add_argument("--cascade_candidates", type=int, default=None, help='candidates of the cascade_bm25 / cascade_sparse strategies rescored by dense similarity (needs --embedding_cache)')
+    parser.add_argument("--http_compress", action="store_true", help='gzip request bodies and accept gzip responses')
+    parser.add_argument("--connection", type=str, default='requests', choices=list(CONNECTION_CLASSES), help='http connection class of the workers')
+    parser.add_argument("--output", type=str, default='load.jsonl', help='every measured step is appended to this file')
+    parser.add_argument("--report_json", type=str, default='', help='write the curves and saturation points to this json file')
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries, args.query_limit)
+    search_kwargs = {"sparse_model_id": args.sparse_model_id, "dense_model_id": args.dense_model_id, "topk": args.topk, "source": False, "two_phase": args.two_phase}
+    if args.max_token_score is not None:
+        search_kwargs["max_token_score"] = args.max_token_score
+    if args.cascade_candidates is not None:
+        search_kwargs["cascade_candidates"] = args.cascade_candidates
+    if args.embedding_cache:
+        # embed every query once up front, the workers then only read the sqlite file
+        QueryEmbeddingCache(args.embedding_cache).get_embeddings(queries)
+    config = {"aos_endpoint": args.aos_endpoint, "index_name": args.index_name, "search_kwargs": search_kwargs,
+              "client_options": {"http_compress": args.http_compress, "connection": args.connection},
+              "embedding_cache": args.embedding_cache, "sparse_tokenizer": args.sparse_tokenizer, "sparse_idf": args.sparse_idf,
+              "sparse_top_n": args.sparse_top_n, "sparse_min_weight": args.sparse_min_weight}
+
+    curves, saturation = run_load_curve(config, args.strategies.split(','), queries, [float(rate) for rate in args.rates.split(',')], args.duration,
+                                        args.processes, args.threads, args.arrival, args.seed, args.startup, args.slo_p99_ms, args.output)
+    for strategy, curve in curves.items():
+        print(f"{strategy}: saturation at {saturation[strategy]} qps")
+        for row in curve:
+            print(f"  target:{row['target_qps']:g} offered:{row['offered_qps']:.1f} achieved:{row['achieved_qps']:.1f} errors:{row['errors']} p50(ms):{row['p50_ms']} p99(ms):{row['p99_ms']} service p99(ms):{row['service_p99_ms']}")
+    if args.report_json:
+        with open(args.report_json, "w") as f:
+            json.dump({"curves": curves, "saturation_qps": saturation}, f, indent=2)
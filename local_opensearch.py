@@ -0,0 +1,782 @@
+import re
+import gzip
+import json
+import math
+import time
+import random
+import hashlib
+import fnmatch
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from sparse_pruning import prune_sparse_vector
+
+# CJK characters are one token each, everything else splits on non-word characters
+TOKEN_PATTERN = re.compile(r"[\u4e00-\u9fff]|[^\W_\u4e00-\u9fff]+")
+DEFAULT_DIMENSION = 1024
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+@lru_cache(maxsize=200000)
+def _token_vector(token, dimension):
+    seed = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+
+def fake_dense_embedding(text, dimension=DEFAULT_DIMENSION):
+    # sum of one fixed random vector per token, unit length: texts sharing tokens get a high inner product
+    vector = np.zeros(dimension, dtype=np.float32)
+    for token in tokenize(text):
+        vector += _token_vector(token, dimension)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+@lru_cache(maxsize=200000)
+def _token_weight(token):
+    # fixed per token in [0.05, 3.0), like the spread of a real sparse model, so pruning has light tokens to drop
+    seed = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=4).digest(), "little")
+    return 0.05 + 2.95 * (seed / 2**32) ** 2
+
+def fake_sparse_embedding(text):
+    counts = {}
+    for token in tokenize(text):
+        counts[token] = counts.get(token, 0) + 1
+    return {token: (1.0 + math.log(count)) * _token_weight(token) for token, count in counts.items()}
+
+class StandInError(Exception):
+    def __init__(self, status, error_type, reason):
+        super().__init__(reason)
+        self.status = status
+        self.error_type = error_type
+        self.reason = reason
+
+    def body(self):
+        return {"error": {"type": self.error_type, "reason": self.reason}, "status": self.status}
+
+def _flatten_settings(settings, prefix=""):
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(_flatten_settings(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = str(value)
+    return flat
+
+def _project_source(source, projection):
+    # _source: true / false / "field" / ["fields"] / {"includes": [...], "excludes": [...]}
+    if projection is None or projection is True:
+        return source
+    if projection is False:
+        return None
+    if isinstance(projection, str):
+        projection = [projection]
+    if isinstance(projection, list):
+        projection = {"includes": projection}
+    includes = projection.get("includes") or projection.get("include")
+    excludes = projection.get("excludes") or projection.get("exclude") or []
+    return {field: value for field, value in source.items() if (not includes or field in includes) and field not in excludes}
+
+def innerproduct_score(inner_product):
+    # score of space_type innerproduct
+    return float(inner_product + 1 if inner_product >= 0 else 1 / (1 - inner_product))
+
+class LocalIndex:
+    def __init__(self, name, body=None, dimension=DEFAULT_DIMENSION):
+        body = body or {}
+        self.name = name
+        # a recreated index gets a new uuid, like a real one
+        self.uuid = hashlib.md5(f"{name}-{time.time()}-{random.random()}".encode()).hexdigest()[:22]
+        settings = body.get("settings", {})
+        self.settings = settings
+        self.flat_settings = _flatten_settings(settings)
+        self.default_pipeline = settings.get("default_pipeline") or settings.get("index", {}).get("default_pipeline")
+        self.mappings = body.get("mappings", {})
+        self.source_excludes = self.mappings.get("_source", {}).get("excludes", [])
+        self.vector_fields = [field for field, mapping in self.mappings.get("properties", {}).items() if mapping.get("type") == "knn_vector"]
+        # byte / binary fields hold one byte per value, binary fields are compared by hamming distance
+        vector_mappings = {field: self.mappings["properties"][field] for field in self.vector_fields}
+        self.vector_bytes = {field: 1 if mapping.get("data_type") in ("byte", "binary") else 4 for field, mapping in vector_mappings.items()}
+        self.vector_spaces = {field: mapping.get("space_type") or mapping.get("method", {}).get("space_type", "l2") for field, mapping in vector_mappings.items()}
+        self.dimension = dimension
+        self.lock = threading.RLock()
+        self.slots = {}
+        self.ids = []
+        self.sources = []
+        self.terms = []
+        self.lengths = []
+        self.vectors = []
+        self.sparse = []
+        self.postings = {}
+        self.sparse_postings = {}
+        self.live = []
+        self.live_count = 0
+        self.field_lengths = {}
+        self.store_bytes = 0
+        self.generation = 0
+        self.delete_total = 0
+        self.refresh_total = 0
+        self._matrix = {}
+
+    def _remove(self, slot):
+        for key in self.terms[slot]:
+            del self.postings[key][slot]
+        for key in self.sparse[slot]:
+            del self.sparse_postings[key][slot]
+        for field, length in self.lengths[slot].items():
+            self.field_lengths[field] -= length
+        self.live[slot] = False
+        self.live_count -= 1
+        self.store_bytes -= self.sources[slot][1]
+        # an overwritten / deleted slot keeps its id only
+        self.sources[slot] = (None, 0)
+        self.terms[slot], self.lengths[slot], self.vectors[slot], self.sparse[slot] = {}, {}, {}, {}
+
+    def index(self, doc_id, source, op_type="index"):
+        with self.lock:
+            if doc_id in self.slots and self.live[self.slots[doc_id]]:
+                if op_type == "create":
+                    raise StandInError(409, "version_conflict_engine_exception", f"[{doc_id}]: version conflict, document already exists")
+                self._remove(self.slots[doc_id])
+                result = "updated"
+            else:
+                result = "created"
+            slot = len(self.ids)
+            self.slots[doc_id] = slot
+            self.ids.append(doc_id)
+            terms = {}
+            length = {}
+            vectors = {}
+            sparse = {}
+            for field, value in source.items():
+                if isinstance(value, str):
+                    tokens = tokenize(value)
+                    length[field] = len(tokens)
+                    self.field_lengths[field] = self.field_lengths.get(field, 0) + len(tokens)
+                    for token in tokens:
+                        terms[(field, token)] = terms.get((field, token), 0) + 1
+                elif field in self.vector_fields and isinstance(value, list):
+                    vectors[field] = np.asarray(value, dtype=np.float32)
+                elif isinstance(value, dict) and value and all(isinstance(weight, (int, float)) for weight in value.values()):
+                    for token, weight in value.items():
+                        sparse[(field, token)] = float(weight)
+            for key, tf in terms.items():
+                self.postings.setdefault(key, {})[slot] = tf
+            for key, weight in sparse.items():
+                self.sparse_postings.setdefault(key, {})[slot] = weight
+            stored = _project_source(source, {"excludes": self.source_excludes}) if self.source_excludes else source
+            size = len(json.dumps(stored)) + self.vector_size(vectors) + 8 * len(sparse)
+            self.sources.append((stored, size))
+            self.store_bytes += size
+            self.terms.append(terms)
+            self.lengths.append(length)
+            self.vectors.append(vectors)
+            self.sparse.append(sparse)
+            self.live.append(True)
+            self.live_count += 1
+            self._matrix = {}
+            self.generation += 1
+            return result
+
+    def delete(self, doc_id):
+        with self.lock:
+            if doc_id not in self.slots or not self.live[self.slots[doc_id]]:
+                return "not_found"
+            self._remove(self.slots[doc_id])
+            self._matrix = {}
+            self.generation += 1
+            self.delete_total += 1
+            return "deleted"
+
+    def doc_count(self):
+        return self.live_count
+
+    def vector_size(self, vectors):
+        return sum(self.vector_bytes[field] * len(vector) for field, vector in vectors.items())
+
+    def refresh(self):
+        with self.lock:
+            self.refresh_total += 1
+            for field in self.vector_fields:
+                self._vector_matrix(field)
+
+    def _vector_matrix(self, field):
+        # (slots, matrix) of the live docs with a vector in `field`, rebuilt after writes
+        if field not in self._matrix:
+            slots = [slot for slot in range(len(self.ids)) if self.live[slot] and field in self.vectors[slot]]
+            matrix = np.stack([self.vectors[slot][field] for slot in slots]) if slots else np.zeros((0, self.dimension), dtype=np.float32)
+            self._matrix[field] = (np.asarray(slots), matrix)
+        return self._matrix[field]
+
+    def match(self, field, query_text, k1=1.2, b=0.75):
+        live_count = self.live_count
+        if live_count == 0:
+            return {}
+        average_length = (self.field_lengths.get(field, 0) / live_count) or 1.0
+        scores = {}
+        for token in set(tokenize(query_text)):
+            postings = self.postings.get((field, token), {})
+            if not postings:
+                continue
+            idf = math.log(1 + (live_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for slot, tf in postings.items():
+                norm = tf + k1 * (1 - b + b * self.lengths[slot].get(field, 0) / average_length)
+                scores[slot] = scores.get(slot, 0.0) + idf * tf * (k1 + 1) / norm
+        return scores
+
+    def knn(self, field, vector, k):
+        slots, matrix = self._vector_matrix(field)
+        if len(slots) == 0:
+            return {}
+        if self.vector_spaces.get(field) == "hamming":
+            # packed int8 bits, score 1 / (1 + hamming distance)
+            bits = np.unpackbits(matrix.astype(np.int8).view(np.uint8), axis=1)
+            query_bits = np.unpackbits(np.asarray(vector, dtype=np.int8).view(np.uint8))
+            distance = (bits != query_bits).sum(axis=1)
+            top = np.argsort(distance, kind="stable")[:k]
+            return {int(slots[i]): 1.0 / (1 + float(distance[i])) for i in top}
+        inner_product = matrix @ np.asarray(vector, dtype=np.float32)
+        top = np.argsort(-inner_product, kind="stable")[:k]
+        return {int(slots[i]): innerproduct_score(ip) for i, ip in zip(top, inner_product[top])}
+
+    def exact_knn(self, field, vector, candidates):
+        # knn_score script: exact innerproduct score of the candidate slots that have a vector, no graph
+        slots, matrix = self._vector_matrix(field)
+        if len(slots) == 0:
+            return {}
+        inner_product = matrix @ np.asarray(vector, dtype=np.float32)
+        return {int(slot): innerproduct_score(ip) for slot, ip in zip(slots, inner_product) if int(slot) in candidates}
+
+    def sparse_dot(self, field, query_tokens):
+        scores = {}
+        for token, query_weight in query_tokens.items():
+            for slot, weight in self.sparse_postings.get((field, token), {}).items():
+                scores[slot] = scores.get(slot, 0.0) + query_weight * weight
+        return scores
+
+class LocalOpenSearch:
+    '''
+    Usage :
+        python3 local_opensearch.py --port 9200 --index_name <index_name> --latency_ms 5 --error_rate 0.01
+        python3 benchmark.py --aos_endpoint http://localhost:9200 --index_name <index_name> ...
+
+        # or in process
+        server, aos_endpoint = start_local_opensearch(latency_ms=2)
+        aos_client = get_aos_client(aos_endpoint)
+
+    Stand-in for the OpenSearch domain and its models to measure the client side without AWS:
+    _bulk (with the ingest pipeline of the index), _search / _msearch (match, knn, neural, neural_sparse,
+    hybrid with a search pipeline, rescore, script_score with knn_score, scroll, the neural_sparse_two_phase_processor), refresh, _stats and the
+    ingest / search pipeline and sparse _predict APIs.
+    neural / neural_sparse / the ingest pipeline use deterministic fake embeddings, whatever the model_id.
+    latency_ms (+ uniform latency_jitter_ms) is added to every request and every model call of an ingest processor
+    (batch_size texts of a _bulk request per call), inference_ms per embedded text,
+    error_rate fails whole requests with 503 and reject_rate rejects _bulk items with 429.
+    '''
+    def __init__(self, dimension=DEFAULT_DIMENSION, latency_ms=0.0, latency_jitter_ms=0.0, inference_ms=0.0, error_rate=0.0, reject_rate=0.0, seed=0):
+        self.dimension = dimension
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.inference_ms = inference_ms
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.indices = {}
+        self.ingest_pipelines = {}
+        self.search_pipelines = {}
+        # scroll_id -> (remaining hits, page size)
+        self.scrolls = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    # --- fault and latency injection ---
+
+    def _chance(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self.random.random() < rate
+
+    def _delay(self, texts=0):
+        with self._lock:
+            jitter = self.random.uniform(0, self.latency_jitter_ms) if self.latency_jitter_ms else 0.0
+        delay = self.latency_ms + jitter + self.inference_ms * texts
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _auto_id(self):
+        with self._lock:
+            self._next_id += 1
+            return hashlib.blake2b(str(self._next_id).encode(), digest_size=10).hexdigest()
+
+    # --- request routing ---
+
+    def handle(self, method, path, params, body):
+        # returns (status, response body)
+        self._delay()
+        if self._chance(self.error_rate):
+            raise StandInError(503, "unavailable_shards_exception", "injected failure")
+        parts = [part for part in path.split("/") if part]
+        if not parts:
+            return 200, {"name": "local-opensearch", "cluster_name": "local", "version": {"distribution": "opensearch", "number": "2.13.0"}, "tagline": "The OpenSearch Project: https://opensearch.org/"}
+        if parts[0] == "_bulk":
+            return 200, self.bulk(None, body, params)
+        if parts[0] == "_msearch":
+            return 200, self.msearch(None, body)
+        if parts[0] == "_ingest" and len(parts) == 3:
+            return self._pipeline(self.ingest_pipelines, method, parts[2], body)
+        if parts[0] == "_search" and len(parts) == 3 and parts[1] == "pipeline":
+            return self._pipeline(self.search_pipelines, method, parts[2], body)
+        if parts[0] == "_search" and len(parts) == 2 and parts[1] == "scroll":
+            return 200, self.scroll(method, json.loads(body) if body else {})
+        if parts[0] == "_plugins" and parts[1:3] == ["_ml", "_predict"]:
+            texts = json.loads(body)["text_docs"]
+            self._delay(len(texts))
+            if parts[3] == "sparse_encoding":
+                outputs = [{"name": "output", "dataAsMap": {"response": [fake_sparse_embedding(text)]}} for text in texts]
+            else:
+                outputs = [{"name": "sentence_embedding", "data_type": "FLOAT32", "shape": [self.dimension], "data": fake_dense_embedding(text, self.dimension).tolist()} for text in texts]
+            return 200, {"inference_results": [{"output": [output]} for output in outputs]}
+        if parts[0] == "_plugins" and parts[1:3] == ["_knn", "warmup"]:
+            return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+        if parts[0] == "_plugins" and parts[1:3] == ["_knn", "stats"]:
+            return 200, self.knn_stats()
+        if parts[0].startswith("_"):
+            raise StandInError(400, "illegal_argument_exception", f"unsupported endpoint {method} {path}")
+
+        index_name = parts[0]
+        if len(parts) == 1:
+            if method == "PUT":
+                if index_name in self.indices:
+                    raise StandInError(400, "resource_already_exists_exception", f"index [{index_name}] already exists")
+                self.indices[index_name] = LocalIndex(index_name, json.loads(body) if body else None, self.dimension)
+                return 200, {"acknowledged": True, "shards_acknowledged": True, "index": index_name}
+            if method == "DELETE":
+                self._index(index_name)
+                del self.indices[index_name]
+                return 200, {"acknowledged": True}
+            if method == "HEAD":
+                return (200 if index_name in self.indices else 404), None
+            if "*" in index_name:
+                return 200, {name: {"settings": index.settings, "mappings": index.mappings} for name, index in self.indices.items() if fnmatch.fnmatchcase(name, index_name)}
+            index = self._index(index_name)
+            return 200, {index_name: {"settings": index.settings, "mappings": index.mappings}}
+        if parts[1] == "_bulk":
+            return 200, self.bulk(index_name, body, params)
+        if parts[1] == "_search":
+            request_body = json.loads(body) if body else {}
+            if "size" in params:
+                # helpers.scan sends the page size as a url parameter
+                request_body.setdefault("size", int(params["size"]))
+            return 200, self.search(index_name, request_body, params.get("search_pipeline"), params.get("scroll"))
+        if parts[1] == "_msearch":
+            return 200, self.msearch(index_name, body)
+        if parts[1] == "_refresh":
+            for name in index_name.split(","):
+                self._index(name).refresh()
+            return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+        if parts[1] == "_settings":
+            index = self._index(index_name)
+            if method == "PUT":
+                index.flat_settings.update(_flatten_settings(json.loads(body)))
+                return 200, {"acknowledged": True}
+            names = parts[2].split(",") if len(parts) > 2 else None
+            return 200, {index_name: {"settings": {key: value for key, value in index.flat_settings.items() if names is None or key in names}}}
+        if parts[1] == "_stats":
+            return 200, self.stats(index_name)
+        if parts[1] == "_count":
+            return 200, {"count": self._index(index_name).doc_count()}
+        if parts[1] == "_doc" and len(parts) == 3:
+            index = self._index(index_name)
+            if method == "DELETE":
+                return 200, {"_index": index_name, "_id": parts[2], "result": index.delete(parts[2])}
+            if method in ("PUT", "POST"):
+                return 201, {"_index": index_name, "_id": parts[2], "result": index.index(parts[2], self._run_ingest_pipeline(index, json.loads(body), params.get("pipeline")))}
+            slot = index.slots.get(parts[2])
+            if slot is None or not index.live[slot]:
+                return 404, {"_index": index_name, "_id": parts[2], "found": False}
+            return 200, {"_index": index_name, "_id": parts[2], "found": True, "_source": index.sources[slot][0]}
+        raise StandInError(400, "illegal_argument_exception", f"unsupported endpoint {method} {path}")
+
+    def _index(self, index_name):
+        if index_name not in self.indices:
+            raise StandInError(404, "index_not_found_exception", f"no such index [{index_name}]")
+        return self.indices[index_name]
+
+    def _pipeline(self, pipelines, method, name, body):
+        if method == "PUT":
+            pipelines[name] = json.loads(body)
+            return 200, {"acknowledged": True}
+        if method == "DELETE":
+            pipelines.pop(name, None)
+            return 200, {"acknowledged": True}
+        if name not in pipelines:
+            return 404, {}
+        return 200, {name: pipelines[name]}
+
+    # --- ingest ---
+
+    def _run_ingest_pipeline(self, index, source, pipeline=None):
+        return self._run_ingest_pipeline_batch(index, [source], pipeline)[0]
+
+    def _run_ingest_pipeline_batch(self, index, sources, pipeline=None):
+        # request pipeline, else default_pipeline of the index; "_none" disables both.
+        # a processor sends the texts of a _bulk request to its model batch_size (1 by default) at a time:
+        # latency_ms is paid once per model call, inference_ms once per text
+        name = pipeline or index.default_pipeline
+        if not name or name == "_none":
+            return sources
+        if name not in self.ingest_pipelines:
+            raise StandInError(400, "illegal_argument_exception", f"pipeline with id [{name}] does not exist")
+        sources = [dict(source) for source in sources]
+        for processor in self.ingest_pipelines[name].get("processors", []):
+            for processor_type, config in processor.items():
+                batch_size = max(int(config.get("batch_size", 1)), 1)
+                for input_field, output_field in config.get("field_map", {}).items():
+                    targets = [source for source in sources if isinstance(source.get(input_field), str)]
+                    for start in range(0, len(targets), batch_size):
+                        batch = targets[start:start + batch_size]
+                        self._delay(len(batch))
+                        for source in batch:
+                            if processor_type == "sparse_encoding":
+                                source[output_field] = prune_sparse_vector(fake_sparse_embedding(source[input_field]), config.get("prune_type"), config.get("prune_ratio"))
+                            elif processor_type == "text_embedding":
+                                source[output_field] = fake_dense_embedding(source[input_field], self.dimension).tolist()
+        return sources
+
+    def bulk(self, index_name, body, params):
+        start = time.perf_counter()
+        lines = [line for line in body.split("\n") if line.strip()]
+        # (op_type, target, doc_id, source, pipeline) in request order
+        actions = []
+        position = 0
+        while position < len(lines):
+            action = json.loads(lines[position])
+            op_type, meta = next(iter(action.items()))
+            position += 1
+            source = None
+            if op_type != "delete":
+                source = json.loads(lines[position])
+                position += 1
+            actions.append((op_type, meta.get("_index", index_name), meta.get("_id"), source, meta.get("pipeline") or params.get("pipeline")))
+
+        # rejections first, then the pipeline runs once over all docs of an (index, pipeline) so processors can batch
+        errors = {}
+        groups = {}
+        for number, (op_type, target, doc_id, source, pipeline) in enumerate(actions):
+            try:
+                if self._chance(self.reject_rate):
+                    raise StandInError(429, "es_rejected_execution_exception", "injected rejection, write queue is full")
+                self._index(target)
+                if op_type != "delete":
+                    groups.setdefault((target, pipeline), []).append(number)
+            except StandInError as e:
+                errors[number] = e
+        sources = {}
+        for (target, pipeline), numbers in groups.items():
+            try:
+                sources.update(zip(numbers, self._run_ingest_pipeline_batch(self._index(target), [actions[number][3] for number in numbers], pipeline)))
+            except StandInError as e:
+                errors.update((number, e) for number in numbers)
+
+        items = []
+        for number, (op_type, target, doc_id, source, pipeline) in enumerate(actions):
+            try:
+                if number in errors:
+                    raise errors[number]
+                index = self._index(target)
+                if op_type == "delete":
+                    result = index.delete(doc_id)
+                    status = 200 if result == "deleted" else 404
+                else:
+                    if doc_id is None:
+                        doc_id = self._auto_id()
+                    result = index.index(doc_id, sources[number], op_type)
+                    status = 201 if result == "created" else 200
+                items.append({op_type: {"_index": target, "_id": doc_id, "result": result, "status": status}})
+            except StandInError as e:
+                items.append({op_type: {"_index": target, "_id": doc_id, "status": e.status, "error": {"type": e.error_type, "reason": e.reason}}})
+        return {"took": int((time.perf_counter() - start) * 1000), "errors": any("error" in list(item.values())[0] for item in items), "items": items}
+
+    # --- search ---
+
+    def _score_clause(self, index, clause, size):
+        # {slot: score} of one leaf query
+        (query_type, config), = clause.items()
+        if query_type == "match_all":
+            return {slot: 1.0 for slot in range(len(index.ids)) if index.live[slot]}
+        if query_type == "script_score":
+            script = config["script"]
+            if script.get("lang") != "knn" or script.get("source") != "knn_score":
+                raise StandInError(400, "illegal_argument_exception", "only the knn_score script of the k-NN plugin is supported")
+            if script["params"].get("space_type", "innerproduct") != "innerproduct":
+                raise StandInError(400, "illegal_argument_exception", "only space_type innerproduct is supported")
+            return index.exact_knn(script["params"]["field"], script["params"]["query_value"], self._score_clause(index, config["query"], size))
+        (field, options), = config.items()
+        if query_type == "match":
+            query_text = options["query"] if isinstance(options, dict) else options
+            return index.match(field, query_text)
+        if query_type == "knn":
+            return index.knn(field, options["vector"], options.get("k", size))
+        if query_type == "neural":
+            self._delay(1)
+            return index.knn(field, fake_dense_embedding(options["query_text"], self.dimension), options.get("k", size))
+        if query_type == "neural_sparse":
+            return index.sparse_dot(field, self._query_tokens(options))
+        raise StandInError(400, "parsing_exception", f"unknown query [{query_type}]")
+
+    def _query_tokens(self, options):
+        if "query_tokens" in options:
+            return options["query_tokens"]
+        self._delay(1)
+        return {token: 1.0 for token in fake_sparse_embedding(options["query_text"])}
+
+    def _search_pipeline(self, search_pipeline):
+        if search_pipeline not in self.search_pipelines:
+            raise StandInError(404, "resource_not_found_exception", f"pipeline [{search_pipeline}] is not defined")
+        return self.search_pipelines[search_pipeline]
+
+    def _two_phase(self, request_body, search_pipeline):
+        # neural_sparse_two_phase_processor: a top level neural_sparse query keeps the tokens of at least prune_ratio x the heaviest one,
+        # the rest goes into a rescore of the first size x expansion_rate hits
+        if not search_pipeline or "neural_sparse" not in request_body.get("query", {}):
+            return request_body
+        for processor in self._search_pipeline(search_pipeline).get("request_processors", []):
+            config = processor.get("neural_sparse_two_phase_processor")
+            if config is None or not config.get("enabled", True):
+                continue
+            parameters = config.get("two_phase_parameter", {})
+            (field, options), = request_body["query"]["neural_sparse"].items()
+            query_tokens = self._query_tokens(options)
+            threshold = max(query_tokens.values(), default=0.0) * parameters.get("prune_ratio", 0.4)
+            high = {token: weight for token, weight in query_tokens.items() if weight >= threshold}
+            low = {token: weight for token, weight in query_tokens.items() if weight < threshold}
+            request_body = dict(request_body, query={"neural_sparse": {field: {"query_tokens": high}}})
+            if low:
+                size = request_body.get("from", 0) + request_body.get("size", 10)
+                request_body["rescore"] = {
+                    "window_size": min(int(size * parameters.get("expansion_rate", 5.0)), parameters.get("max_window_size", 10000)),
+                    "query": {"rescore_query": {"neural_sparse": {field: {"query_tokens": low}}}}
+                }
+        return request_body
+
+    def _rescore(self, index, ranked, rescore):
+        # score_mode total: query_weight x first phase + rescore_query_weight x rescore query, the window stays ahead of the rest
+        window = rescore.get("window_size", 10)
+        config = rescore["query"]
+        extra = self._score_clause(index, config["rescore_query"], window)
+        query_weight, rescore_weight = config.get("query_weight", 1.0), config.get("rescore_query_weight", 1.0)
+        rescored = [(slot, score * query_weight + extra.get(slot, 0.0) * rescore_weight) for slot, score in ranked[:window]]
+        return sorted(rescored, key=lambda item: (-item[1], item[0])) + ranked[window:]
+
+    def _normalization_processor(self, search_pipeline):
+        if not search_pipeline:
+            raise StandInError(400, "illegal_argument_exception", "hybrid query needs a search pipeline with a normalization-processor")
+        for processor in self._search_pipeline(search_pipeline).get("phase_results_processors", []):
+            if "normalization-processor" in processor:
+                return processor["normalization-processor"]
+        raise StandInError(400, "illegal_argument_exception", f"search pipeline [{search_pipeline}] has no normalization-processor")
+
+    def _hybrid(self, index, queries, size, search_pipeline):
+        processor = self._normalization_processor(search_pipeline)
+        normalization = processor.get("normalization", {}).get("technique", "min_max")
+        combination = processor.get("combination", {})
+        weights = combination.get("parameters", {}).get("weights") or [1.0 / len(queries)] * len(queries)
+        legs = []
+        for clause in queries:
+            scores = self._score_clause(index, clause, size)
+            top = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:size]
+            values = [score for _, score in top]
+            if normalization == "l2":
+                norm = math.sqrt(sum(value * value for value in values)) or 1.0
+                legs.append({slot: score / norm for slot, score in top})
+            elif normalization == "min_max":
+                low, high = (min(values), max(values)) if values else (0.0, 0.0)
+                legs.append({slot: (score - low) / (high - low) if high > low else 1.0 for slot, score in top})
+            else:
+                raise StandInError(400, "illegal_argument_exception", f"unsupported normalization technique [{normalization}]")
+
+        technique = combination.get("technique", "arithmetic_mean")
+        combined = {}
+        for slot in set().union(*legs):
+            scores = [(weight, leg.get(slot, 0.0)) for weight, leg in zip(weights, legs)]
+            if technique == "arithmetic_mean":
+                combined[slot] = sum(weight * score for weight, score in scores) / sum(weights)
+            elif technique == "geometric_mean":
+                present = [(weight, score) for weight, score in scores if score > 0]
+                combined[slot] = math.exp(sum(weight * math.log(score) for weight, score in present) / sum(weight for weight, _ in present)) if present else 0.0
+            elif technique == "harmonic_mean":
+                present = [(weight, score) for weight, score in scores if score > 0]
+                combined[slot] = sum(weight for weight, _ in present) / sum(weight / score for weight, score in present) if present else 0.0
+            else:
+                raise StandInError(400, "illegal_argument_exception", f"unsupported combination technique [{technique}]")
+        return combined
+
+    def search(self, index_name, request_body, search_pipeline=None, scroll=None):
+        start = time.perf_counter()
+        index = self._index(index_name)
+        request_body = self._two_phase(request_body, search_pipeline)
+        size = request_body.get("size", 10)
+        offset = request_body.get("from", 0)
+        query = request_body.get("query", {"match_all": {}})
+        with index.lock:
+            if "hybrid" in query:
+                scores = self._hybrid(index, query["hybrid"]["queries"], offset + size, search_pipeline)
+            else:
+                scores = self._score_clause(index, query, offset + size)
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            if "rescore" in request_body:
+                ranked = self._rescore(index, ranked, request_body["rescore"])
+            # a scroll keeps every remaining hit, not only the page
+            end = len(ranked) if scroll else offset + size
+            hits = []
+            for slot, score in ranked[offset:end]:
+                hit = {"_index": index_name, "_id": index.ids[slot], "_score": score}
+                source = _project_source(index.sources[slot][0], request_body.get("_source"))
+                if source is not None:
+                    hit["_source"] = source
+                hits.append(hit)
+        response = {
+            "took": int((time.perf_counter() - start) * 1000),
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"total": {"value": len(ranked), "relation": "eq"}, "max_score": ranked[0][1] if ranked else None, "hits": hits[:size]}
+        }
+        if scroll:
+            scroll_id = self._auto_id()
+            self.scrolls[scroll_id] = (hits[size:], size)
+            response["_scroll_id"] = scroll_id
+        return response
+
+    def scroll(self, method, body):
+        if method == "DELETE":
+            scroll_ids = body.get("scroll_id", [])
+            scroll_ids = [scroll_ids] if isinstance(scroll_ids, str) else scroll_ids
+            freed = sum(1 for scroll_id in scroll_ids if self.scrolls.pop(scroll_id, None) is not None)
+            return {"succeeded": True, "num_freed": freed}
+        scroll_id = body["scroll_id"]
+        if scroll_id not in self.scrolls:
+            raise StandInError(404, "search_context_missing_exception", f"No search context found for id [{scroll_id}]")
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return {"_scroll_id": scroll_id, "timed_out": False, "hits": {"hits": hits[:size]}}
+
+    def msearch(self, index_name, body):
+        start = time.perf_counter()
+        lines = [line for line in body.split("\n") if line.strip()]
+        responses = []
+        for position in range(0, len(lines), 2):
+            header = json.loads(lines[position])
+            try:
+                response = self.search(header.get("index", index_name), json.loads(lines[position + 1]), header.get("search_pipeline"))
+                response["status"] = 200
+                responses.append(response)
+            except StandInError as e:
+                responses.append(e.body())
+        return {"took": int((time.perf_counter() - start) * 1000), "responses": responses}
+
+    def knn_stats(self):
+        # vectors held for exact search stand in for the graphs
+        indices_in_cache = {}
+        for name, index in self.indices.items():
+            vector_kb = sum(index.vector_size(vectors) for vectors in index.vectors) // 1024
+            if vector_kb:
+                indices_in_cache[name] = {"graph_memory_usage": vector_kb, "graph_count": len(index.vector_fields), "graph_memory_usage_percentage": 0.0}
+        node = {
+            "graph_memory_usage": sum(stats["graph_memory_usage"] for stats in indices_in_cache.values()),
+            "indices_in_cache": indices_in_cache,
+            "graph_index_requests": 0, "graph_index_errors": 0, "total_load_time": 0,
+            "eviction_count": 0, "hit_count": 0, "miss_count": 0, "cache_capacity_reached": False
+        }
+        return {"_nodes": {"total": 1, "successful": 1, "failed": 0}, "cluster_name": "local", "nodes": {"local": node}}
+
+    def stats(self, index_name):
+        indices = {}
+        for name in index_name.split(","):
+            index = self._index(name)
+            primaries = {"docs": {"count": index.doc_count(), "deleted": len(index.ids) - index.doc_count()}, "store": {"size_in_bytes": index.store_bytes}, "segments": {"count": 1},
+                         "indexing": {"index_total": index.generation - index.delete_total, "delete_total": index.delete_total}, "refresh": {"total": index.refresh_total}}
+            indices[name] = {"uuid": index.uuid, "primaries": primaries, "total": primaries}
+        totals = {
+            "docs": {"count": sum(stats["primaries"]["docs"]["count"] for stats in indices.values()), "deleted": sum(stats["primaries"]["docs"]["deleted"] for stats in indices.values())},
+            "store": {"size_in_bytes": sum(stats["primaries"]["store"]["size_in_bytes"] for stats in indices.values())},
+            "segments": {"count": len(indices)}
+        }
+        return {"_shards": {"total": len(indices), "successful": len(indices), "failed": 0}, "_all": {"primaries": totals, "total": totals}, "indices": indices}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, with Nagle every keep-alive response waits for a delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        try:
+            status, response = self.server.stand_in.handle(self.command, url.path, params, body.decode("utf-8"))
+        except StandInError as e:
+            status, response = e.status, e.body()
+        except (ValueError, KeyError, TypeError) as e:
+            status, response = 400, StandInError(400, "parsing_exception", repr(e)).body()
+        payload = b"" if response is None else json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+def start_local_opensearch(host="127.0.0.1", port=0, **options):
+    '''
+    Usage : server, aos_endpoint = start_local_opensearch(latency_ms=2, reject_rate=0.01)
+    Serves a LocalOpenSearch(**options) from a daemon thread, port=0 picks a free port.
+    aos_endpoint ("http://host:port") goes to get_aos_client / get_async_aos_client, server.shutdown() stops it.
+    '''
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.stand_in = LocalOpenSearch(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='listen address')
+    parser.add_argument('--port', type=int, default=9200, help='listen port')
+    parser.add_argument('--index_name', type=str, default='', help='create this index and the ingest / search pipelines like setup_model_and_pipeline.py')
+    parser.add_argument('--lean_index', action='store_true', help='exclude the embedding fields from _source of --index_name')
+    parser.add_argument('--dimension', type=int, default=DEFAULT_DIMENSION, help='dimension of the fake dense embeddings')
+    parser.add_argument('--latency_ms', type=float, default=0.0, help='latency added to every request')
+    parser.add_argument('--latency_jitter_ms', type=float, default=0.0, help='uniform random latency added on top of --latency_ms')
+    parser.add_argument('--inference_ms', type=float, default=0.0, help='latency added per embedded text (ingest pipeline, neural queries, _predict)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='share of requests failing with 503')
+    parser.add_argument('--reject_rate', type=float, default=0.0, help='share of _bulk items rejected with 429')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the injected latency and errors')
+    args = parser.parse_args()
+
+    server, aos_endpoint = start_local_opensearch(args.host, args.port, dimension=args.dimension, latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+                                                  inference_ms=args.inference_ms, error_rate=args.error_rate, reject_rate=args.reject_rate, seed=args.seed)
+    if args.index_name:
+        from setup_model_and_pipeline import get_aos_client, create_index, create_ingest_pipeline, create_query_pipeline, create_sparse_two_phase_pipeline
+        # model ids are not checked by the stand-in
+        aos_client = get_aos_client(aos_endpoint)
+        create_ingest_pipeline(aos_client, "local-sparse-model", "local-dense-model")
+        create_query_pipeline(aos_client, "local-sparse-model", "local-dense-model")
+        create_sparse_two_phase_pipeline(aos_client)
+        create_index(aos_client, args.index_name, lean=args.lean_index)
+        print(f"index:{args.index_name}, sparse_model_id:local-sparse-model, dense_model_id:local-dense-model")
+    print(f"local opensearch listening on {aos_endpoint}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,173 @@
+from itertools import chain
+import numpy as np
+
+METRICS = ["recall", "precision", "mrr", "map", "ndcg"]
+
+def prepare_qrels(qrels, depth):
+    '''
+    qrels {query_id: {doc_id: relevance}} -> the judgement side of the arrays, built once for every run:
+        query_ids     queries with at least one relevant (relevance > 0) doc, others are skipped like pytrec_eval does
+        relevant      per query {doc_id: relevance} of its relevant docs
+        num_relevant  [queries] relevant docs per query
+        ideal         [queries, depth] relevance of the relevant docs, best first, zero padded
+    '''
+    query_ids = [query_id for query_id, judged in qrels.items() if any(rel > 0 for rel in judged.values())]
+    relevant = [{doc_id: rel for doc_id, rel in qrels[query_id].items() if rel > 0} for query_id in query_ids]
+    ideal = np.zeros((len(query_ids), depth), dtype=np.float32)
+    num_relevant = np.zeros(len(query_ids), dtype=np.float32)
+    for row, docs in enumerate(relevant):
+        gains = sorted(docs.values(), reverse=True)[:depth]
+        num_relevant[row] = len(docs)
+        ideal[row, :len(gains)] = gains
+    return {"query_ids": query_ids, "relevant": relevant, "num_relevant": num_relevant, "ideal": ideal, "depth": depth}
+
+def run_gains(judgements, run, ignore_identical_ids=True, block_size=4096):
+    # run {query_id: {doc_id: score}} -> [queries, depth] relevance of the doc at every rank (0 if not judged relevant / no doc).
+    # the run is read once into a padded [queries, longest list] score matrix; the rank of every retrieved relevant doc is the
+    # number of docs of its row ahead of it, all counted in array comparisons (block_size relevant docs at a time).
+    # Order is pytrec_eval's (trec_eval): score descending, then doc id descending, not the order of the run.
+    # ignore_identical_ids: BEIR convention, a doc with the id of the query does not count
+    depth = judgements["depth"]
+    query_ids = judgements["query_ids"]
+    gains = np.zeros((len(query_ids), depth), dtype=np.float32)
+    scored = [run.get(query_id) or {} for query_id in query_ids]
+    # (row, doc id, score, relevance) of every relevant doc the run retrieved
+    found = [(row, doc_id, docs[doc_id], judged[doc_id]) for row, (judged, docs) in enumerate(zip(judgements["relevant"], scored))
+             for doc_id in judged.keys() & docs.keys() if not (ignore_identical_ids and doc_id == query_ids[row])]
+    if not found:
+        return gains
+
+    found_rows, found_docs, found_scores, found_gains = zip(*found)
+    found_rows = np.array(found_rows, dtype=np.int64)
+    found_scores = np.array(found_scores, dtype=np.float64)
+    found_gains = np.array(found_gains, dtype=np.float32)
+
+    # score matrix of the rows with a retrieved relevant doc, padded with -inf
+    rows = np.unique(found_rows)
+    lengths = np.fromiter((len(scored[row]) for row in rows), dtype=np.int64, count=len(rows))
+    flat_scores = np.fromiter(chain.from_iterable(scored[row].values() for row in rows), dtype=np.float64, count=int(lengths.sum()))
+    matrix = np.full((len(rows), int(lengths.max())), -np.inf)
+    # row-major boolean assignment, the flat scores of a row land in its first columns
+    matrix[np.arange(matrix.shape[1]) < lengths[:, None]] = flat_scores
+    matrix_rows = np.searchsorted(rows, found_rows)
+    # doc ids of a row, only listed for rows with tied scores
+    row_docs = {}
+
+    ranks = np.zeros(len(found), dtype=np.int64)
+    for start in range(0, len(found), block_size):
+        block = slice(start, start + block_size)
+        candidates = matrix[matrix_rows[block]]
+        ranks[block] = np.count_nonzero(candidates > found_scores[block, None], axis=1)
+        # equal scores: the larger doc id goes first. Every doc ties with itself, only docs with other ties compare ids
+        tied, columns = np.nonzero(candidates == found_scores[block, None])
+        shared = np.bincount(tied, minlength=len(candidates))[tied] > 1
+        for number, column in zip(tied[shared] + start, columns[shared]):
+            row = matrix_rows[number]
+            if row not in row_docs:
+                row_docs[row] = list(scored[rows[row]])
+            ranks[number] += row_docs[row][column] > found_docs[number]
+    if ignore_identical_ids:
+        # a skipped doc with the id of the query that ranks ahead moves the relevant doc up one place
+        own = np.array([scored[row].get(query_ids[row], np.nan) for row in rows], dtype=np.float64)[matrix_rows]
+        ahead = own > found_scores
+        for number in np.nonzero(own == found_scores)[0]:
+            ahead[number] = query_ids[found_rows[number]] > found_docs[number]
+        ranks -= ahead
+
+    placed = ranks < depth
+    gains[found_rows[placed], ranks[placed]] = found_gains[placed]
+    return gains
+
+def per_query_metrics(judgements, gains, cutoffs, metrics=METRICS):
+    '''
+    Every metric at every cutoff for every query in one pass over the [queries, depth] arrays.
+    Returns (names ["ndcg@10", ...], [queries, len(names)] matrix). Definitions follow pytrec_eval / BEIR:
+    recall and MAP divide by all relevant docs of the query, nDCG uses linear gains and log2(rank + 1) discounts,
+    MRR is the reciprocal rank of the first relevant doc within the cutoff.
+    '''
+    depth = judgements["depth"]
+    if max(cutoffs) > depth:
+        raise ValueError(f"cutoff {max(cutoffs)} beyond the depth {depth} of the arrays")
+    relevant = (gains > 0).astype(np.float32)
+    hits = np.cumsum(relevant, axis=1)
+    ranks = np.arange(1, depth + 1, dtype=np.float32)
+    discounts = 1.0 / np.log2(ranks + 1)
+    num_relevant = judgements["num_relevant"]
+    columns = {}
+    if "recall" in metrics:
+        columns["recall"] = hits / num_relevant[:, None]
+    if "precision" in metrics:
+        columns["precision"] = hits / ranks
+    if "mrr" in metrics:
+        first = np.where(relevant.any(axis=1), relevant.argmax(axis=1), depth)
+        reciprocal = np.where(first < depth, 1.0 / (first + 1), 0.0).astype(np.float32)
+        columns["mrr"] = np.where(ranks[None, :] > first[:, None], reciprocal[:, None], 0.0)
+    if "map" in metrics:
+        columns["map"] = np.cumsum(relevant * hits / ranks, axis=1) / num_relevant[:, None]
+    if "ndcg" in metrics:
+        ideal_dcg = np.cumsum(judgements["ideal"] * discounts, axis=1)
+        columns["ndcg"] = np.cumsum(gains * discounts, axis=1) / ideal_dcg
+
+    names = [f"{metric}@{k}" for metric in metrics for k in cutoffs]
+    matrix = np.stack([columns[metric][:, k - 1] for metric in metrics for k in cutoffs], axis=1)
+    return names, matrix
+
+def bootstrap_intervals(matrix, names, samples=1000, confidence=0.95, seed=0, batch_size=100):
+    # percentile bootstrap over queries: every resample draws len(queries) queries with replacement, turned into
+    # per-query counts so one matrix product gives the means of all metrics of a batch of resamples.
+    # the same seed draws the same resamples for every run, so intervals of two strategies are paired
+    rng = np.random.default_rng(seed)
+    num_queries = matrix.shape[0]
+    means = []
+    for start in range(0, samples, batch_size):
+        draws = rng.integers(0, num_queries, size=(min(batch_size, samples - start), num_queries))
+        counts = np.stack([np.bincount(row, minlength=num_queries) for row in draws]).astype(np.float32)
+        means.append(counts @ matrix / num_queries)
+    means = np.concatenate(means)
+    tail = (1.0 - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail], axis=0)
+    return {name: (float(low[column]), float(high[column])) for column, name in enumerate(names)}
+
+def evaluate_runs(qrels, runs, cutoffs=(1, 4, 10), metrics=METRICS, bootstrap=0, confidence=0.95, seed=0, ignore_identical_ids=True):
+    '''
+    Usage :
+        results = evaluate_runs(qrels, {"dense": dense_run, "sparse": sparse_run}, cutoffs=[1, 5, 10, 100], bootstrap=1000)
+        results["dense"]["ndcg@10"], results["dense"]["ci"]["ndcg@10"] -> 0.41, (0.39, 0.43)
+
+    qrels are converted once, every run once, then all metrics at all cutoffs come out of a few array operations.
+    Like pytrec_eval (and BEIR EvaluateRetrieval), the means only cover the judged queries the run has hits for:
+    a query without hits is not in a TREC run file at all and is skipped, not scored 0. "queries" is the number of
+    queries averaged, "queries_without_hits" the number of judged queries skipped that way.
+    bootstrap > 0 adds the `confidence` percentile interval of every mean over that many query resamples.
+    '''
+    cutoffs = sorted(set(cutoffs))
+    judgements = prepare_qrels(qrels, max(cutoffs))
+    results = {}
+    for name, run in runs.items():
+        names, matrix = per_query_metrics(judgements, run_gains(judgements, run, ignore_identical_ids), cutoffs, metrics)
+        with_hits = np.fromiter((bool(run.get(query_id)) for query_id in judgements["query_ids"]), dtype=bool, count=len(judgements["query_ids"]))
+        matrix = matrix[with_hits]
+        result = dict(zip(names, (float(value) for value in matrix.mean(axis=0)))) if len(matrix) else dict.fromkeys(names, 0.0)
+        result["queries"] = len(matrix)
+        result["queries_without_hits"] = int(len(with_hits) - with_hits.sum())
+        if bootstrap > 0 and len(matrix):
+            result["ci"] = bootstrap_intervals(matrix, names, bootstrap, confidence, seed)
+        results[name] = result
+    return results
+
+def evaluate(qrels, run, cutoffs=(1, 4, 10), metrics=METRICS, bootstrap=0, confidence=0.95, seed=0, ignore_identical_ids=True):
+    return evaluate_runs(qrels, {"run": run}, cutoffs, metrics, bootstrap, confidence, seed, ignore_identical_ids)["run"]
+
+def format_metrics(result, cutoffs, metrics=METRICS):
+    # one line per metric: "ndcg   @1: 0.3100 [0.2900, 0.3300]  @10: ..."
+    lines = []
+    for metric in metrics:
+        cells = []
+        for k in sorted(set(cutoffs)):
+            name = f"{metric}@{k}"
+            cell = f"@{k}: {result[name]:.4f}"
+            if "ci" in result:
+                cell += " [{:.4f}, {:.4f}]".format(*result["ci"][name])
+            cells.append(cell)
+        lines.append(f"{metric:<9} " + "  ".join(cells))
+    return "\n".join(lines)
@@ -0,0 +1,132 @@
+import json
+import random
+import itertools
+from instrumentation import Recorder
+from metrics import evaluate
+from strategy_runner import STRATEGY_RUNNERS
+from setup_model_and_pipeline import create_query_pipeline, get_cluster_version, get_ef_search, get_knn_engine, set_ef_search
+
+# the sweep writes its own search pipeline, hybird-search-pipeline of the production queries is left alone
+SWEEP_PIPELINE = "hybird-search-pipeline-sweep"
+PIPELINE_PARAMS = ["normalization", "weights", "combination"]
+
+DEFAULT_GRID = {
+    "ef_search": [16, 32, 64, 128, 256],
+    "hybrid_k": [10, 20, 50, 100],
+    "max_token_score": [1.0, 3.5],
+    "normalization": ["l2", "min_max"],
+    "weights": [[0.3, 0.7], [0.5, 0.5], [0.7, 0.3]]
+}
+
+def grid_points(grid):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def sample_points(grid, samples, seed=0):
+    # random search: `samples` distinct points of the grid
+    points = grid_points(grid)
+    return random.Random(seed).sample(points, min(samples, len(points)))
+
+def drop_param(points, name):
+    # the points without `name`, points that become equal are kept once
+    unique = {}
+    for point in points:
+        point = {param: value for param, value in point.items() if param != name}
+        unique.setdefault(json.dumps(point, sort_keys=True), point)
+    return list(unique.values())
+
+def evaluate_run(qrels, run, k):
+    # mean recall@k and nDCG@k (linear gain, like pytrec_eval ndcg_cut) over the queries of qrels
+    result = evaluate(qrels, run, [k], metrics=["recall", "ndcg"])
+    return {"recall": result[f"recall@{k}"], "ndcg": result[f"ndcg@{k}"]}
+
+def pareto_frontier(results, quality="ndcg", cost="p90_ms"):
+    # points no other point beats on both quality (higher) and cost (lower), cheapest first
+    frontier = []
+    for result in sorted(results, key=lambda result: (result[cost], -result[quality])):
+        if not frontier or result[quality] > frontier[-1][quality]:
+            frontier.append(result)
+    return frontier
+
+def apply_point(aos_client, index_name, point, sparse_model_id, dense_model_id, pipeline_name=SWEEP_PIPELINE):
+    if "ef_search" in point:
+        set_ef_search(aos_client, index_name, point["ef_search"])
+    if any(name in point for name in PIPELINE_PARAMS):
+        create_query_pipeline(aos_client, sparse_model_id, dense_model_id, normalization=point.get("normalization", "l2"),
+                              weights=point.get("weights"), combination=point.get("combination", "arithmetic_mean"), pipeline_name=pipeline_name)
+
+def run_sweep(aos_client, aos_endpoint, index_name, queries, qrels, strategy, search_kwargs, points, k=10, concurrency=1, msearch_size=0,
+              warmup=20, quality="ndcg", cost="p90_ms", output=None, pipeline_name=SWEEP_PIPELINE):
+    '''
+    Usage :
+        points = sample_points(DEFAULT_GRID, 30)
+        results, frontier = run_sweep(aos_client, aos_endpoint, index_name, queries, qrels, "dense_sparse", search_kwargs, points, k=10)
+
+    For every point: sets index.knn.algo_param.ef_search of the index and the normalization / combination of pipeline_name,
+    sends `warmup` queries, then runs all `queries` ({query_id: text}) with hybrid_k / max_token_score / two_phase / cascade_candidates of the point and
+    measures recall@k, nDCG@k against qrels and the latency percentiles. ef_search is set back to its value before the sweep.
+    The setting only applies to nmslib, on a faiss / lucene / on_disk index ef_search is dropped from the points.
+    max_token_score is dropped as well on OpenSearch 2.12+, where neural_sparse ignores it.
+    Latency is per query: queries go one request each, msearch_size is ignored (a _msearch batch has one latency for all its queries).
+    Each result is appended to `output` (json lines) as soon as it is measured.
+    Returns (results, pareto frontier of quality vs cost).
+    '''
+    if msearch_size > 0:
+        print(f"[sweep] msearch_size {msearch_size} ignored, the sweep measures per query latency")
+        msearch_size = 0
+    if any("ef_search" in point for point in points):
+        engine = get_knn_engine(aos_client, index_name)
+        if engine != "nmslib":
+            # faiss keeps ef_search in the method parameters of the mapping, fixed when the index is created
+            print(f"[sweep] ef_search not swept: index.knn.algo_param.ef_search only applies to nmslib, dense_embedding of {index_name} uses {engine or 'a trained model'}")
+            points = drop_param(points, "ef_search")
+    if any("max_token_score" in point for point in points):
+        version = get_cluster_version(aos_client)
+        if version >= (2, 12):
+            # every max_token_score gives the same hits and latency, the axis would only multiply the points
+            print(f"[sweep] max_token_score not swept: neural_sparse ignores it since OpenSearch 2.12, the cluster runs {version[0]}.{version[1]}")
+            points = drop_param(points, "max_token_score")
+    query_ids = list(queries.keys())
+    query_texts = [queries[query_id] for query_id in query_ids]
+    qrels = {query_id: qrels[query_id] for query_id in query_ids if query_id in qrels}
+    run = STRATEGY_RUNNERS[strategy]
+    original_ef_search = get_ef_search(aos_client, index_name)
+    sweeps_pipeline = any(name in point for point in points for name in PIPELINE_PARAMS)
+    results = []
+    try:
+        for number, point in enumerate(points, 1):
+            apply_point(aos_client, index_name, point, search_kwargs.get("sparse_model_id"), search_kwargs.get("dense_model_id"), pipeline_name)
+            point_kwargs = dict(search_kwargs, topk=max(k, search_kwargs.get("topk", k)))
+            # ef_search / the sweep pipeline change the hits without changing the index generation
+            point_kwargs.pop("result_cache", None)
+            for name in ["hybrid_k", "max_token_score", "two_phase", "cascade_candidates"]:
+                if name in point:
+                    point_kwargs[name] = point[name]
+            if sweeps_pipeline:
+                point_kwargs["hybrid_pipeline"] = pipeline_name
+
+            if warmup > 0:
+                run(aos_client, aos_endpoint, index_name, query_texts[:warmup], point_kwargs, concurrency, msearch_size)
+            recorder = Recorder()
+            hits_list = run(aos_client, aos_endpoint, index_name, query_texts, point_kwargs, concurrency, msearch_size, recorder)
+            run_res = {}
+            for query_id, hits in zip(query_ids, hits_list):
+                # BEIR convention, a doc with the id of the query does not count
+                run_res[query_id] = {hit["_id"]: hit["_score"] for hit in hits if hit["_id"] != query_id}
+
+            report = recorder.report()[strategy]
+            result = dict(point, **evaluate_run(qrels, run_res, k))
+            result.update({f"{name}_ms": report["latency_ms"][name] for name in ["p50", "p90", "p99"]})
+            result["qps"] = report["qps"]
+            results.append(result)
+            print(f"[sweep {number}/{len(points)}] {json.dumps(result)}")
+            if output:
+                with open(output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+    finally:
+        if original_ef_search is not None:
+            set_ef_search(aos_client, index_name, original_ef_search)
+        if sweeps_pipeline:
+            aos_client.transport.perform_request(method="DELETE", url=f"/_search/pipeline/{pipeline_name}")
+
+    return results, pareto_frontier(results, quality, cost)
@@ -0,0 +1,151 @@
+import time
+import heapq
+import queue
+import hashlib
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from search_func import HYBRID_DENSE_K, MAX_TOKEN_SCORE, CASCADE_CANDIDATES, build_strategy_body, search_by_body
+from hybrid_fusion import fuse
+from setup_model_and_pipeline import create_index
+from bulk_ingest import BulkIngester
+from instrumentation import InstrumentedClient
+
+# hash: stable hash of the doc id, every partition gets a similar share of every topic
+# time: time buckets of a timestamp field round-robin over the partitions, recent docs end up together
+ROUTINGS = ["hash", "time"]
+# legs of the hybrid strategies, in the order of the queries of their hybrid query (and of the pipeline weights)
+HYBRID_LEGS = {"dense_sparse": ["sparse", "dense"], "dense_bm25": ["bm25", "dense"]}
+
+_partition_executor = None
+# closes the doc queue of a partition in ingest_partitioned
+_END_OF_DOCS = object()
+
+def get_partition_executor(max_workers=64):
+    # shared by all queries, sized for queries in flight x partitions x legs
+    global _partition_executor
+    if _partition_executor is None:
+        _partition_executor = ThreadPoolExecutor(max_workers=max_workers)
+    return _partition_executor
+
+def partition_names(index_name, partitions):
+    return [f"{index_name}-p{number}" for number in range(partitions)]
+
+def route(doc_id, source, partitions, routing="hash", time_field="timestamp", bucket_seconds=86400):
+    # partition number of a doc; time routing reads source[time_field] in epoch seconds
+    if routing == "hash":
+        return int.from_bytes(hashlib.blake2b(str(doc_id).encode("utf-8"), digest_size=8).digest(), "big") % partitions
+    if routing == "time":
+        return int(float(source[time_field]) // bucket_seconds) % partitions
+    raise ValueError(f"unknown routing: {routing}, expected one of {ROUTINGS}")
+
+def create_partitioned_index(aos_client, index_name, partitions, **index_options):
+    # one index per partition with the same layout (create_index options: lean, default_pipeline, profile, ...), existing ones are replaced
+    names = partition_names(index_name, partitions)
+    for name in names:
+        if aos_client.indices.exists(index=name):
+            aos_client.indices.delete(index=name)
+        create_index(aos_client, name, **index_options)
+    return names
+
+def ingest_partitioned(aos_client, index_name, docs, partitions, routing="hash", bulk_size=50, max_workers=8, pipeline=None, progress=None,
+                       time_field="timestamp", bucket_seconds=86400, queue_batches=2):
+    '''
+    Usage : stats = ingest_partitioned(aos_client, index_name, ((doc_id, {"content": text}) for ...), 4, bulk_size=50, max_workers=8)
+
+    Streams `docs` through route() into one BulkIngester per partition, each with up to max_workers in-flight
+    _bulk requests, all partitions at the same time, then refreshes them. docs is read once and lazily: every partition
+    has a queue of queue_batches x max_workers batches, so only the docs in flight are held in memory.
+    Returns the summed stats of the partitions and the number of docs routed to each ("partition_docs").
+    '''
+    names = partition_names(index_name, partitions)
+    queues = [queue.Queue(maxsize=queue_batches * max_workers * bulk_size) for _ in names]
+    routed = [0] * partitions
+    failed = threading.Event()
+
+    def partition_docs(number):
+        while True:
+            doc = queues[number].get()
+            if doc is _END_OF_DOCS:
+                return
+            yield doc
+
+    def ingest(number):
+        try:
+            ingester = BulkIngester(aos_client, names[number], bulk_size=bulk_size, max_workers=max_workers, request_timeout=100, pipeline=pipeline, progress=progress)
+            return ingester.ingest(partition_docs(number))
+        except BaseException:
+            # stops the routing, the other partitions finish the docs they already have
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=partitions) as executor:
+        futures = [executor.submit(ingest, number) for number in range(partitions)]
+
+        def put(number, doc):
+            # gives up once the ingester of the partition is gone, nobody drains its queue anymore
+            while not futures[number].done():
+                try:
+                    queues[number].put(doc, timeout=1.0)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            for doc in docs:
+                if failed.is_set():
+                    break
+                number = route(doc[0], doc[1], partitions, routing, time_field, bucket_seconds)
+                routed[number] += 1
+                put(number, doc)
+        finally:
+            for number in range(partitions):
+                put(number, _END_OF_DOCS)
+        parts = [future.result() for future in futures]
+    for name in names:
+        aos_client.indices.refresh(index=name)
+    stats = {name: sum(part[name] for part in parts) for name in ["indexed", "failed", "retries", "batches"]}
+    stats["errors"] = [error for part in parts for error in part["errors"]]
+    stats["partition_docs"] = routed
+    return stats
+
+def merge_hits(hits_lists, size):
+    # k-way heap merge of per-partition hits lists, each best first, into the global top `size`
+    return list(islice(heapq.merge(*hits_lists, key=lambda hit: -(hit["_score"] or 0.0)), size))
+
+def search_partitioned(aos_client, index_name, query, strategy, partitions, sparse_model_id=None, dense_model_id=None, topk=4, embedding_cache=None, sparse_encoder=None,
+                       source=None, hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, two_phase=None, cascade_candidates=CASCADE_CANDIDATES,
+                       technique="l2", weights=None, recorder=None, label=None):
+    '''
+    Usage : hits = search_partitioned(aos_client, index_name, query, "dense_sparse", 4, sparse_model_id, dense_model_id, topk=10, embedding_cache=embedding_cache)
+
+    Scatter-gather over the partitions of index_name (partition_names): one request per partition, all in parallel,
+    the per-partition top hits merged by score with a heap. Raw scores of one leg compare across partitions
+    (bm25 idf is per partition, close with hash routing). A hybrid query per partition would normalize every partition
+    on its own and put the best doc of each at the top, so the legs of dense_sparse / dense_bm25 are scattered as plain
+    queries instead, merged per leg and normalized / combined once over the merged legs (hybrid_fusion.fuse with the
+    technique and weights of the hybrid pipeline).
+    Pass an embedding_cache / sparse_encoder, otherwise every partition embeds the query with the remote model again.
+    With a recorder every query is recorded under `label` and every partition request under `<label>:partition`.
+    '''
+    label = label or f"{strategy}_p{partitions}"
+    names = partition_names(index_name, partitions)
+    legs = HYBRID_LEGS.get(strategy, [strategy])
+    # a hybrid leg returns as many hits as its clause in the hybrid query would
+    size = max(topk, hybrid_k) if strategy in HYBRID_LEGS else topk
+    search_client = InstrumentedClient(aos_client, recorder, f"{label}:partition") if recorder is not None else aos_client
+
+    def search_partition(task):
+        leg, name = task
+        request_body, search_pipeline = build_strategy_body(leg, query, sparse_model_id, dense_model_id, size, embedding_cache, sparse_encoder, source,
+                                                            hybrid_k, max_token_score, two_phase=two_phase, cascade_candidates=cascade_candidates)
+        request_body["size"] = size
+        return search_by_body(search_client, name, request_body, search_pipeline, source)
+
+    start, start_perf = time.time(), time.perf_counter()
+    results = list(get_partition_executor().map(search_partition, [(leg, name) for leg in legs for name in names]))
+    merged = [merge_hits(results[number * len(names):(number + 1) * len(names)], size) for number in range(len(legs))]
+    hits = fuse(merged, weights, technique, topk) if strategy in HYBRID_LEGS else merged[0][:topk]
+    if recorder is not None:
+        recorder.record(label, time.perf_counter() - start_perf, start, queries=1)
+    return hits
@@ -0,0 +1,139 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from setup_model_and_pipeline import get_index_generation
+
+class SearchResultCache:
+    '''
+    Usage :
+        result_cache = SearchResultCache(aos_client, max_items=10000, ttl=300, max_bytes=64*1024*1024)
+        hits = search_by_strategy(aos_client, index_name, query, "dense_sparse", sparse_model_id, dense_model_id, topk, result_cache=result_cache)
+        print(result_cache.report())
+
+    Hits are keyed by (index, strategy, query text, model ids, topk, pipeline and the other search parameters) and kept as json:
+    at most max_items entries and max_bytes bytes, least recently used out first, each for at most ttl seconds.
+    An entry is only served while the generation of its index (get_index_generation: refreshes, writes, uuid) is the one
+    it was searched at; the generation is read through `aos_client` at most every check_interval seconds.
+    A hit skips the search request and the embedding / sparse encoding of the query. The key does not cover
+    embedding_cache / sparse_encoder, use one cache per encoder configuration.
+    With a `recorder` every hit is recorded under `label` (lookup latency, one query), next to the requests of the misses.
+    '''
+    def __init__(self, aos_client, max_items=10000, ttl=300, max_bytes=64*1024*1024, check_interval=1.0, recorder=None, label="result_cache"):
+        self.aos_client = aos_client
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.recorder = recorder
+        self.label = label
+        # key -> (index_name, generation, hits json, expires_at, seconds the search took)
+        self._entries = OrderedDict()
+        # index_name -> (generation, checked_at)
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    def key(self, index_name, strategy, query, *params):
+        # params: everything besides the query that changes the hits, in a fixed order
+        return json.dumps([index_name, strategy, query, params], default=str)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= len(entry[2])
+
+    def generation(self, index_name):
+        now = time.monotonic()
+        with self._lock:
+            known = self._generations.get(index_name)
+            if known is not None and now - known[1] < self.check_interval:
+                return known[0]
+        generation = get_index_generation(self.aos_client, index_name)
+        with self._lock:
+            known = self._generations.get(index_name)
+            self._generations[index_name] = (generation, now)
+            if known is not None and known[0] != generation:
+                # the index changed, drop its entries now instead of waiting for the LRU
+                self.invalidations += 1
+                for key in [key for key, entry in self._entries.items() if entry[0] == index_name]:
+                    self._drop(key)
+        return generation
+
+    def get(self, index_name, key):
+        # (hits or None, generation to hand to put after the search)
+        start, start_perf = time.time(), time.perf_counter()
+        generation = self.generation(index_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] < time.monotonic():
+                self.expirations += 1
+                self._drop(key)
+                entry = None
+            if entry is None or entry[1] != generation:
+                self.misses += 1
+                return None, generation
+            self._entries.move_to_end(key)
+            self.hits += 1
+            hits = json.loads(entry[2])
+            latency = time.perf_counter() - start_perf
+            self.saved_seconds += max(entry[4] - latency, 0.0)
+        if self.recorder is not None:
+            self.recorder.record(self.label, latency, start, queries=1)
+        return hits, generation
+
+    def put(self, index_name, key, hits, generation, cost=0.0):
+        data = json.dumps(hits)
+        with self._lock:
+            self.miss_seconds += cost
+            if len(data) > self.max_bytes:
+                return
+            current = self._generations.get(index_name)
+            if current is not None and current[0] != generation:
+                # searched before the index changed, already stale
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (index_name, generation, data, time.monotonic() + self.ttl, cost)
+            self.bytes += len(data)
+            while len(self._entries) > self.max_items or self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_search(self, index_name, key, search):
+        hits, generation = self.get(index_name, key)
+        if hits is not None:
+            return hits
+        start = time.perf_counter()
+        hits = search()
+        self.put(index_name, key, hits, generation, time.perf_counter() - start)
+        return hits
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self.bytes = 0
+
+    def report(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                # search time the hits did not spend, against the mean search time of a miss
+                "saved_ms": self.saved_seconds * 1000,
+                "mean_miss_ms": self.miss_seconds * 1000 / self.misses if self.misses else None
+            }
@@ -1,6 +1,68 @@
 import json
+import time
 
-def search_by_bm25(aos_client, index_name, query, topk=4):    
+HYBRID_SEARCH_PIPELINE = "hybird-search-pipeline"
+EMBEDDING_FIELDS = ["dense_embedding", "sparse_embedding"]
+# default _source projection, hits never carry the 1024-float dense_embedding or the sparse_embedding token map
+DEFAULT_SOURCE = {"excludes": EMBEDDING_FIELDS}
+# k of the dense clause inside hybrid queries and max_token_score of neural_sparse (ignored by OpenSearch 2.12+), see parameter_sweep.py for their trade-off
+HYBRID_DENSE_K = 10
+MAX_TOKEN_SCORE = 3.5
+# two-phase sparse search: query tokens weighing at least prune_ratio x the heaviest token find the candidates,
+# the remaining tokens only rescore the top topk x expansion_rate (the parameters of neural_sparse_two_phase_processor)
+SPARSE_TWO_PHASE_PIPELINE = "neural-sparse-two-phase-pipeline"
+TWO_PHASE_PRUNE_RATIO = 0.4
+TWO_PHASE_EXPANSION_RATE = 5.0
+TWO_PHASE_MAX_WINDOW_SIZE = 10000
+# cascade: a cheap first stage (bm25 or sparse) ranks the candidates, only its top CASCADE_CANDIDATES are rescored
+# by the exact dense similarity (knn_score script of the k-NN plugin, space of the index profiles), no HNSW search
+CASCADE_STRATEGIES = ["cascade_bm25", "cascade_sparse"]
+CASCADE_CANDIDATES = 100
+CASCADE_SPACE_TYPE = "innerproduct"
+
+def build_dense_clause(query, dense_model_id, k, query_vector=None):
+    # a precomputed query_vector skips the remote embedding model call of the neural query
+    if query_vector is not None:
+        return {
+            "knn": {
+                "dense_embedding": {
+                    "vector": query_vector,
+                    "k": k
+                }
+            }
+        }
+    return {
+        "neural": {
+            "dense_embedding": {
+                "query_text": query,
+                "model_id": dense_model_id,
+                "k": k
+            }
+        }
+    }
+
+def build_sparse_clause(query, sparse_model_id, query_tokens=None, max_token_score=MAX_TOKEN_SCORE):
+    # client-side encoded query_tokens skip the remote sparse model call of the neural_sparse query
+    if query_tokens is not None:
+        return {
+            "neural_sparse": {
+                "sparse_embedding": {
+                    "query_tokens": query_tokens,
+                    "max_token_score": max_token_score
+                }
+            }
+        }
+    return {
+        "neural_sparse": {
+            "sparse_embedding": {
+                "query_text": query,
+                "model_id": sparse_model_id,
+                "max_token_score": max_token_score
+            }
+        }
+    }
+
+def build_bm25_body(query, topk=4):
     request_body = {
       "size": topk,
       "query": {
@@ -9,100 +71,79 @@ def search_by_bm25(aos_client, index_name, query, topk=4):
         }
       }
     }
+    return request_body
 
-    response = aos_client.transport.perform_request(
-        method="GET",
-        url=f"/{index_name}/_search",
-        body=json.dumps(request_body)
-    )
-
-    # docs = [hit["_source"]['content'] for hit in response["hits"]["hits"]]
-    return response["hits"]["hits"]
-
-def search_by_dense(aos_client, index_name, query, dense_model_id, topk=4):
+def build_dense_body(query, dense_model_id, topk=4, query_vector=None):
     request_body = {
-        "query": {
-            "neural": {
-                "dense_embedding": {
-                  "query_text": query,
-                  "model_id": dense_model_id,
-                  "k": topk
-                }
-            }
-        }
+        "query": build_dense_clause(query, dense_model_id, topk, query_vector)
     }
+    return request_body
 
-    response = aos_client.transport.perform_request(
-        method="GET",
-        url=f"/{index_name}/_search",
-        body=json.dumps(request_body)
-    )
+def build_sparse_body(query, sparse_model_id, topk=4, query_tokens=None, max_token_score=MAX_TOKEN_SCORE):
+    request_body = {
+      "size": topk,
+      "query": build_sparse_clause(query, sparse_model_id, query_tokens, max_token_score)
+    }
+    return request_body
 
-    # docs = [hit["_source"]['content'] for hit in response["hits"]["hits"]]
-    return response["hits"]["hits"]
+def split_query_tokens(query_tokens, prune_ratio=TWO_PHASE_PRUNE_RATIO):
+    # (high, low) weight tokens, same split as neural_sparse_two_phase_processor
+    if not query_tokens:
+        return {}, {}
+    threshold = max(query_tokens.values()) * prune_ratio
+    high = {token: weight for token, weight in query_tokens.items() if weight >= threshold}
+    low = {token: weight for token, weight in query_tokens.items() if weight < threshold}
+    return high, low
 
-def search_by_sparse(aos_client, index_name, query, sparse_model_id, topk=4):
+def build_two_phase_sparse_body(query_tokens, topk=4, max_token_score=MAX_TOKEN_SCORE, prune_ratio=TWO_PHASE_PRUNE_RATIO,
+                                expansion_rate=TWO_PHASE_EXPANSION_RATE, max_window_size=TWO_PHASE_MAX_WINDOW_SIZE):
+    # client-side two-phase: the high weight tokens select the candidates, a rescore adds the low weight tokens to the top window,
+    # so within the window the score is the full dot product again
+    high, low = split_query_tokens(query_tokens, prune_ratio)
     request_body = {
       "size": topk,
-      "query": {
-          "neural_sparse": {
-              "sparse_embedding": {
-                "query_text": query,
-                "model_id": sparse_model_id,
-                "max_token_score": 3.5
-              }
-          }
-      }
+      "query": build_sparse_clause(None, None, high, max_token_score)
     }
+    if low:
+        request_body["rescore"] = {
+            "window_size": min(max(int(topk * expansion_rate), topk), max_window_size),
+            "query": {
+                "rescore_query": build_sparse_clause(None, None, low, max_token_score),
+                "query_weight": 1.0,
+                "rescore_query_weight": 1.0
+            }
+        }
+    return request_body
 
-    response = aos_client.transport.perform_request(
-        method="GET",
-        url=f"/{index_name}/_search",
-        body=json.dumps(request_body)
-    )
-
-    # docs = [hit["_source"]['content'] for hit in response["hits"]["hits"]]
-    return response["hits"]["hits"]
+def build_sparse_search(query, sparse_model_id, topk=4, query_tokens=None, max_token_score=MAX_TOKEN_SCORE, two_phase=None):
+    # returns (request_body, search_pipeline) of a sparse search
+    # two_phase: None = every token scores every doc, "pipeline" = SPARSE_TWO_PHASE_PIPELINE (create_sparse_two_phase_pipeline) splits
+    # the query on the cluster, "client" = build_two_phase_sparse_body, which needs client-side query_tokens (sparse_encoder)
+    if two_phase == "client":
+        if query_tokens is None:
+            raise ValueError("client-side two-phase sparse search needs query tokens, pass a sparse_encoder or use two_phase='pipeline'")
+        return build_two_phase_sparse_body(query_tokens, topk, max_token_score), None
+    if two_phase == "pipeline":
+        return build_sparse_body(query, sparse_model_id, topk, query_tokens, max_token_score), SPARSE_TWO_PHASE_PIPELINE
+    if two_phase:
+        raise ValueError(f"unknown two_phase mode: {two_phase}, expected 'pipeline' or 'client'")
+    return build_sparse_body(query, sparse_model_id, topk, query_tokens, max_token_score), None
 
-def search_by_dense_sparse(aos_client, index_name, query, sparse_model_id, dense_model_id, topk=4):
+def build_dense_sparse_body(query, sparse_model_id, dense_model_id, topk=4, query_vector=None, query_tokens=None, hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE):
     request_body = {
       "size": topk,
       "query": {
         "hybrid": {
           "queries": [
-            {
-              "neural_sparse": {
-                  "sparse_embedding": {
-                    "query_text": query,
-                    "model_id": sparse_model_id,
-                    "max_token_score": 3.5
-                  }
-              }
-            },
-            {
-              "neural": {
-                  "dense_embedding": {
-                      "query_text": query,
-                      "model_id": dense_model_id,
-                      "k": 10
-                    }
-                }
-            }
+            build_sparse_clause(query, sparse_model_id, query_tokens, max_token_score),
+            build_dense_clause(query, dense_model_id, hybrid_k, query_vector)
           ]
         }
       }
     }
+    return request_body
 
-    response = aos_client.transport.perform_request(
-        method="GET",
-        url=f"/{index_name}/_search?search_pipeline=hybird-search-pipeline",
-        body=json.dumps(request_body)
-    )
-
-    # docs = [hit["_source"]['content'] for hit in response["hits"]["hits"]]
-    return response["hits"]["hits"]
-
-def search_by_dense_bm25(aos_client, index_name, query, dense_model_id, topk=4):
+def build_dense_bm25_body(query, dense_model_id, topk=4, query_vector=None, hybrid_k=HYBRID_DENSE_K):
     request_body = {
       "size": topk,
       "query": {
@@ -115,25 +156,204 @@ def search_by_dense_bm25(aos_client, index_name, query, dense_model_id, topk=4):
                 }
               }
             },
-            {
-              "neural": {
-                  "dense_embedding": {
-                      "query_text": query,
-                      "model_id": dense_model_id,
-                      "k": 10
-                    }
-                }
-            }
+            build_dense_clause(query, dense_model_id, hybrid_k, query_vector)
           ]
         }
       }
     }
+    return request_body
 
+def build_exact_dense_clause(query_vector, space_type=CASCADE_SPACE_TYPE):
+    # exact similarity of query_vector and dense_embedding for every doc the clause runs on, a rescore runs it on its window only
+    return {
+        "script_score": {
+            "query": {
+                "match_all": {}
+            },
+            "script": {
+                "source": "knn_score",
+                "lang": "knn",
+                "params": {
+                    "field": "dense_embedding",
+                    "query_value": query_vector,
+                    "space_type": space_type
+                }
+            }
+        }
+    }
+
+def build_cascade_body(query, stage, sparse_model_id=None, topk=4, query_vector=None, query_tokens=None, candidates=CASCADE_CANDIDATES, max_token_score=MAX_TOKEN_SCORE):
+    # stage "bm25" / "sparse" picks the candidates, the rescore replaces the stage score of its top `candidates` by the dense score
+    if query_vector is None:
+        raise ValueError("cascade search rescores with the query vector, pass an embedding_cache")
+    if stage == "bm25":
+        request_body = build_bm25_body(query, topk)
+    elif stage == "sparse":
+        request_body = build_sparse_body(query, sparse_model_id, topk, query_tokens, max_token_score)
+    else:
+        raise ValueError(f"unknown cascade stage: {stage}, expected 'bm25' or 'sparse'")
+    request_body["rescore"] = {
+        "window_size": max(candidates, topk),
+        "query": {
+            "rescore_query": build_exact_dense_clause(query_vector),
+            "query_weight": 0.0,
+            "rescore_query_weight": 1.0
+        }
+    }
+    return request_body
+
+def build_search_url(index_name, search_pipeline=None):
+    url = f"/{index_name}/_search"
+    if search_pipeline:
+        url += f"?search_pipeline={search_pipeline}"
+    return url
+
+def apply_source(request_body, source=None):
+    # source: False for ids/scores only, True for the full _source, a list of fields or {"includes": [...], "excludes": [...]};
+    # None means DEFAULT_SOURCE
+    request_body["_source"] = DEFAULT_SOURCE if source is None else source
+    return request_body
+
+def search_by_body(aos_client, index_name, request_body, search_pipeline=None, source=None):
+    apply_source(request_body, source)
     response = aos_client.transport.perform_request(
         method="GET",
-        url=f"/{index_name}/_search?search_pipeline=hybird-search-pipeline",
+        url=build_search_url(index_name, search_pipeline),
         body=json.dumps(request_body)
     )
 
     # docs = [hit["_source"]['content'] for hit in response["hits"]["hits"]]
-    return response["hits"]["hits"]
\ No newline at end of file
+    return response["hits"]["hits"]
+
+def search_by_bm25(aos_client, index_name, query, topk=4, source=None):
+    request_body = build_bm25_body(query, topk)
+    return search_by_body(aos_client, index_name, request_body, source=source)
+
+def get_query_vector(query, embedding_cache):
+    return embedding_cache.get_embedding(query) if embedding_cache is not None else None
+
+def get_query_tokens(query, sparse_encoder):
+    return sparse_encoder.encode(query) if sparse_encoder is not None else None
+
+def search_by_dense(aos_client, index_name, query, dense_model_id, topk=4, embedding_cache=None, source=None):
+    request_body = build_dense_body(query, dense_model_id, topk, get_query_vector(query, embedding_cache))
+    return search_by_body(aos_client, index_name, request_body, source=source)
+
+def search_by_sparse(aos_client, index_name, query, sparse_model_id, topk=4, sparse_encoder=None, source=None, max_token_score=MAX_TOKEN_SCORE, two_phase=None):
+    request_body, search_pipeline = build_sparse_search(query, sparse_model_id, topk, get_query_tokens(query, sparse_encoder), max_token_score, two_phase)
+    return search_by_body(aos_client, index_name, request_body, search_pipeline, source)
+
+def search_by_dense_sparse(aos_client, index_name, query, sparse_model_id, dense_model_id, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                           hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE):
+    request_body = build_dense_sparse_body(query, sparse_model_id, dense_model_id, topk, get_query_vector(query, embedding_cache), get_query_tokens(query, sparse_encoder), hybrid_k, max_token_score)
+    return search_by_body(aos_client, index_name, request_body, hybrid_pipeline, source)
+
+def search_by_dense_bm25(aos_client, index_name, query, dense_model_id, topk=4, embedding_cache=None, source=None, hybrid_k=HYBRID_DENSE_K, hybrid_pipeline=HYBRID_SEARCH_PIPELINE):
+    request_body = build_dense_bm25_body(query, dense_model_id, topk, get_query_vector(query, embedding_cache), hybrid_k)
+    return search_by_body(aos_client, index_name, request_body, hybrid_pipeline, source)
+
+def search_by_cascade(aos_client, index_name, query, stage="sparse", sparse_model_id=None, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                      candidates=CASCADE_CANDIDATES, max_token_score=MAX_TOKEN_SCORE):
+    request_body = build_cascade_body(query, stage, sparse_model_id, topk, get_query_vector(query, embedding_cache), get_query_tokens(query, sparse_encoder), candidates, max_token_score)
+    return search_by_body(aos_client, index_name, request_body, source=source)
+
+STRATEGIES = ["bm25", "dense", "sparse", "dense_sparse", "dense_bm25"]
+
+def build_strategy_body(strategy, query, sparse_model_id=None, dense_model_id=None, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                        hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE, two_phase=None, cascade_candidates=CASCADE_CANDIDATES):
+    # returns (request_body, search_pipeline) of one of STRATEGIES or CASCADE_STRATEGIES
+    if strategy == "bm25":
+        return apply_source(build_bm25_body(query, topk), source), None
+    if strategy == "dense":
+        return apply_source(build_dense_body(query, dense_model_id, topk, get_query_vector(query, embedding_cache)), source), None
+    if strategy == "sparse":
+        request_body, search_pipeline = build_sparse_search(query, sparse_model_id, topk, get_query_tokens(query, sparse_encoder), max_token_score, two_phase)
+        return apply_source(request_body, source), search_pipeline
+    if strategy == "dense_sparse":
+        return apply_source(build_dense_sparse_body(query, sparse_model_id, dense_model_id, topk, get_query_vector(query, embedding_cache), get_query_tokens(query, sparse_encoder), hybrid_k, max_token_score), source), hybrid_pipeline
+    if strategy == "dense_bm25":
+        return apply_source(build_dense_bm25_body(query, dense_model_id, topk, get_query_vector(query, embedding_cache), hybrid_k), source), hybrid_pipeline
+    if strategy in CASCADE_STRATEGIES:
+        stage = strategy[len("cascade_"):]
+        return apply_source(build_cascade_body(query, stage, sparse_model_id, topk, get_query_vector(query, embedding_cache), get_query_tokens(query, sparse_encoder), cascade_candidates, max_token_score), source), None
+    raise ValueError(f"unknown strategy: {strategy}, expected one of {STRATEGIES + CASCADE_STRATEGIES}")
+
+def search_by_strategy(aos_client, index_name, query, strategy, sparse_model_id=None, dense_model_id=None, topk=4, embedding_cache=None, sparse_encoder=None, source=None,
+                       hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE, two_phase=None, result_cache=None,
+                       cascade_candidates=CASCADE_CANDIDATES):
+    # result_cache: a result_cache.SearchResultCache, a hit skips the query embedding / encoding and the request
+    def search():
+        request_body, search_pipeline = build_strategy_body(strategy, query, sparse_model_id, dense_model_id, topk, embedding_cache, sparse_encoder, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase,
+                                                            cascade_candidates)
+        return search_by_body(aos_client, index_name, request_body, search_pipeline, source)
+
+    if result_cache is None:
+        return search()
+    key = result_cache.key(index_name, strategy, query, sparse_model_id, dense_model_id, topk, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase, cascade_candidates)
+    return result_cache.get_or_search(index_name, key, search)
+
+def _msearch(aos_client, ndjson_lines):
+    response = aos_client.transport.perform_request(
+        method="POST",
+        url="/_msearch",
+        headers={"Content-Type": "application/x-ndjson"},
+        body="".join(ndjson_lines)
+    )
+
+    hits_list = []
+    for item in response["responses"]:
+        if "error" in item:
+            raise RuntimeError(f"_msearch item failed: {item['error']}")
+        hits_list.append(item["hits"]["hits"])
+    return hits_list
+
+def search_many(aos_client, index_name, queries, strategy, sparse_model_id=None, dense_model_id=None, topk=4, max_queries_per_request=100, max_request_bytes=1024*1024, embedding_cache=None, sparse_encoder=None, source=None,
+                hybrid_k=HYBRID_DENSE_K, max_token_score=MAX_TOKEN_SCORE, hybrid_pipeline=HYBRID_SEARCH_PIPELINE, two_phase=None, result_cache=None, cascade_candidates=CASCADE_CANDIDATES):
+    '''
+    Usage : search_many(aos_client, index_name, ["q1", "q2"], "dense_sparse", sparse_model_id=sparse_model_id, dense_model_id=dense_model_id, topk=10)
+    Packs the queries into _msearch requests of at most max_queries_per_request queries / max_request_bytes bytes,
+    returns one hits list per query in the order of `queries`.
+    With a result_cache only the queries it misses are sent.
+    '''
+    if result_cache is not None:
+        keys = [result_cache.key(index_name, strategy, query, sparse_model_id, dense_model_id, topk, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase, cascade_candidates) for query in queries]
+        cached = [result_cache.get(index_name, key) for key in keys]
+        missing = [number for number, (hits, _) in enumerate(cached) if hits is None]
+        start = time.perf_counter()
+        missing_hits = search_many(aos_client, index_name, [queries[number] for number in missing], strategy, sparse_model_id, dense_model_id, topk, max_queries_per_request,
+                                   max_request_bytes, embedding_cache, sparse_encoder, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase,
+                                   cascade_candidates=cascade_candidates) if missing else []
+        # an _msearch costs every query in it the same share
+        cost = (time.perf_counter() - start) / max(len(missing), 1)
+        hits_list = [hits for hits, _ in cached]
+        for number, hits in zip(missing, missing_hits):
+            result_cache.put(index_name, keys[number], hits, cached[number][1], cost)
+            hits_list[number] = hits
+        return hits_list
+
+    if embedding_cache is not None:
+        # embed all missing queries in a few batched calls up front
+        embedding_cache.get_embeddings(queries)
+
+    hits_list = []
+    chunk = []
+    chunk_bytes = 0
+    for query in queries:
+        request_body, search_pipeline = build_strategy_body(strategy, query, sparse_model_id, dense_model_id, topk, embedding_cache, sparse_encoder, source, hybrid_k, max_token_score, hybrid_pipeline, two_phase,
+                                                            cascade_candidates)
+        header = {"index": index_name}
+        if search_pipeline:
+            header["search_pipeline"] = search_pipeline
+        line = json.dumps(header) + "\n" + json.dumps(request_body) + "\n"
+        line_bytes = len(line.encode("utf-8"))
+
+        if chunk and (len(chunk) >= max_queries_per_request or chunk_bytes + line_bytes > max_request_bytes):
+            hits_list.extend(_msearch(aos_client, chunk))
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(line)
+        chunk_bytes += line_bytes
+
+    if chunk:
+        hits_list.extend(_msearch(aos_client, chunk))
+    return hits_list
@@ -3,7 +3,12 @@ import boto3
 import requests
 from requests_aws4auth import AWS4Auth
 import argparse
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, helpers
+from functools import lru_cache
+from opensearchpy import OpenSearch, RequestsHttpConnection, Urllib3HttpConnection, AWSV4SignerAuth, Urllib3AWSV4SignerAuth, helpers
+from search_func import EMBEDDING_FIELDS, HYBRID_SEARCH_PIPELINE, SPARSE_TWO_PHASE_PIPELINE, TWO_PHASE_PRUNE_RATIO, TWO_PHASE_EXPANSION_RATE, TWO_PHASE_MAX_WINDOW_SIZE
+from index_profiles import INDEX_PROFILES, build_dense_field_mapping, profile_shards, profile_embedding_type
+from dense_quantization import EMBEDDING_TYPES
+from embedding_cache import COHERE_MAX_BATCH_SIZE
 # pip3 install boto3 requests requests_aws4auth argparse opensearch-py
 
 def create_bedrock_caller_role(domain_name, account_id, region):
@@ -59,25 +64,101 @@ def create_bedrock_caller_role(domain_name, account_id, region):
     iam.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
 
 
-def get_aos_client(aos_endpoint):
+def parse_local_endpoint(aos_endpoint):
+    # http://host:port is a local_opensearch.py stand-in (or any cluster without TLS / SigV4)
+    if not aos_endpoint.startswith('http://'):
+        return None
+    host, _, port = aos_endpoint[len('http://'):].rstrip('/').partition(':')
+    return {'host': host, 'port': int(port) if port else 9200}
+
+# "requests" is the connection every script always used, "urllib3" skips the requests layer (less CPU per request)
+CONNECTION_CLASSES = {"requests": RequestsHttpConnection, "urllib3": Urllib3HttpConnection}
+
+def parse_endpoints(aos_endpoint):
+    # "host1,host2,..." -> hosts of one cluster, all https (Amazon OpenSearch Service, port 443) or all http:// (local)
+    endpoints = [endpoint.strip() for endpoint in aos_endpoint.split(',') if endpoint.strip()]
+    local_hosts = [parse_local_endpoint(endpoint) for endpoint in endpoints]
+    if all(host is not None for host in local_hosts):
+        return local_hosts, True
+    if any(host is not None for host in local_hosts):
+        raise ValueError(f"mixed http:// and https endpoints: {aos_endpoint}")
+    return [{'host': endpoint.replace('https://', '').rstrip('/'), 'port': 443} for endpoint in endpoints], False
+
+@lru_cache(maxsize=None)
+def get_aws_auth(auth_type="requests"):
+    # one boto3 session and one signer per process, shared by every client: no credential lookup per client,
+    # refreshable credentials (instance profile / assumed role) are refreshed by the signer itself
     session = boto3.Session()
     credentials = session.get_credentials()
     region = session.region_name
-    auth = AWSV4SignerAuth(credentials, region)
-    aos_endpoint= aos_endpoint.replace('https://', '') if 'https://' in aos_endpoint else aos_endpoint
+    if auth_type == "async":
+        from opensearchpy import AWSV4SignerAsyncAuth
+        return AWSV4SignerAsyncAuth(credentials, region)
+    if auth_type == "urllib3":
+        return Urllib3AWSV4SignerAuth(credentials, region)
+    return AWSV4SignerAuth(credentials, region)
+
+def _sniff_options(sniff):
+    # sniffing replaces the hosts by the nodes of the cluster, only for self-managed clusters:
+    # Amazon OpenSearch Service nodes are not reachable directly, several endpoints are used round-robin instead
+    if not sniff:
+        return {}
+    return {"sniff_on_start": True, "sniff_on_connection_fail": True, "sniffer_timeout": 60}
+
+def get_aos_client(aos_endpoint, pool_maxsize=10, http_compress=False, sniff=False, connection="requests", timeout=60):
+    '''
+    Usage : aos_client = get_aos_client("host1,host2", pool_maxsize=32, http_compress=True, connection="urllib3")
+
+    pool_maxsize   kept-alive connections per host, size it to the number of threads sharing the client
+    http_compress  gzip request bodies (_bulk, _msearch, vectors in queries) and accept gzip responses
+    several comma separated endpoints are used round-robin, dead ones are retried after a timeout.
+    The defaults are the single connection setup of the earlier scripts. The client is thread safe, share one.
+    '''
+    hosts, local = parse_endpoints(aos_endpoint)
+    options = dict(
+        hosts = hosts,
+        connection_class = CONNECTION_CLASSES[connection],
+        pool_maxsize = pool_maxsize,
+        http_compress = http_compress,
+        timeout = timeout, # 默认超时时间是10 秒，
+        max_retries=5, # 重试次数
+        retry_on_timeout=True,
+        **_sniff_options(sniff)
+    )
+    if local:
+        return OpenSearch(use_ssl = False, **options)
 
-    client = OpenSearch(
-        hosts = [{'host': aos_endpoint, 'port': 443}],
-        http_auth = auth,
+    return OpenSearch(
+        http_auth = get_aws_auth(connection),
         use_ssl = True,
         verify_certs = True,
-        connection_class = RequestsHttpConnection,
-        timeout = 60, # 默认超时时间是10 秒，
-        max_retries=5, # 重试次数
-        retry_on_timeout=True
+        **options
     )
 
-    return client
+def get_async_aos_client(aos_endpoint, pool_maxsize=10, http_compress=False, sniff=False, timeout=60):
+    # AsyncOpenSearch needs aiohttp: pip3 install "opensearch-py[async]"
+    from opensearchpy import AsyncOpenSearch, AIOHttpConnection
+
+    hosts, local = parse_endpoints(aos_endpoint)
+    options = dict(
+        hosts = hosts,
+        connection_class = AIOHttpConnection,
+        maxsize = pool_maxsize, # 并发请求数，每个并发请求占用一个连接 (aiohttp 连接池参数名是 maxsize)
+        http_compress = http_compress,
+        timeout = timeout,
+        max_retries=5,
+        retry_on_timeout=True,
+        **_sniff_options(sniff)
+    )
+    if local:
+        return AsyncOpenSearch(use_ssl = False, **options)
+
+    return AsyncOpenSearch(
+        http_auth = get_aws_auth("async"),
+        use_ssl = True,
+        verify_certs = True,
+        **options
+    )
 
 def create_aos_model_group(aos_client):
     # POST /_plugins/_ml/model_groups/_register
@@ -126,7 +207,23 @@ def register_and_deploy_aos_model(aos_client, model_name, model_group_id, descri
 
     return response
 
-def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id):
+def _sparse_prune_options(prune_type=None, prune_ratio=None):
+    # prune_type / prune_ratio of the sparse_encoding processor (OpenSearch 2.16+), see sparse_pruning.py
+    if prune_type in (None, "none"):
+        return {}
+    return {"prune_type": prune_type, "prune_ratio": prune_ratio}
+
+# processors that call a model per document unless given a batch_size
+INFERENCE_PROCESSORS = ["sparse_encoding", "text_embedding"]
+
+def _batch_options(batch_size=None):
+    # batch_size of the inference processors (OpenSearch 2.16+): the docs of one _bulk request go to the model
+    # batch_size at a time instead of one by one, batches never span _bulk requests so bulk_size caps it
+    if batch_size is None or batch_size <= 1:
+        return {}
+    return {"batch_size": batch_size}
+
+def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id, prune_type=None, prune_ratio=None, pipeline_name="neural-sparse-pipeline", batch_size=None):
     # PUT /_ingest/pipeline/neural-sparse-pipeline
     # {
     #     "description": "neural sparse encoding pipeline",
@@ -136,7 +233,10 @@ def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id):
     #             "model_id": "<nerual_sparse_model_id>",
     #             "field_map": {
     #               "content": "sparse_embedding"
-    #             }
+    #             },
+    #             "prune_type": "max_ratio",   # optional
+    #             "prune_ratio": 0.1,
+    #             "batch_size": 32             # optional
     #         }
     #         },
     #         {
@@ -144,7 +244,8 @@ def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id):
     #             "model_id": "<cohere_ingest_model_id>",
     #             "field_map": {
     #               "content": "dense_embedding"
-    #             }
+    #             },
+    #             "batch_size": 32             # optional
     #         }
     #         }
     #     ]
@@ -158,7 +259,9 @@ def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id):
                 "model_id": sparse_model_id,
                 "field_map": {
                     "content": "sparse_embedding"
-                }
+                },
+                **_sparse_prune_options(prune_type, prune_ratio),
+                **_batch_options(batch_size)
             }
             },
             {
@@ -166,7 +269,8 @@ def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id):
                 "model_id": dense_model_id,
                 "field_map": {
                     "content": "dense_embedding"
-                }
+                },
+                **_batch_options(batch_size)
             }
             }
         ]
@@ -174,13 +278,47 @@ def create_ingest_pipeline(aos_client, sparse_model_id, dense_model_id):
 
     response = aos_client.transport.perform_request(
         method="PUT",
-        url=f"/_ingest/pipeline/neural-sparse-pipeline",
+        url=f"/_ingest/pipeline/{pipeline_name}",
         body=json.dumps(request_body)
     )
 
     return response
 
-def create_query_pipeline(aos_client, sparse_model_id, dense_model_id):
+def _copy_ingest_pipeline(aos_client, base_pipeline, pipeline_name, update):
+    # PUT pipeline_name as base_pipeline with update(processor_type, config) applied to every processor
+    response = aos_client.transport.perform_request(method="GET", url=f"/_ingest/pipeline/{base_pipeline}")
+    request_body = response[base_pipeline]
+    for processor in request_body.get("processors", []):
+        for processor_type, config in processor.items():
+            update(processor_type, config)
+
+    aos_client.transport.perform_request(
+        method="PUT",
+        url=f"/_ingest/pipeline/{pipeline_name}",
+        body=json.dumps(request_body)
+    )
+    return pipeline_name
+
+def create_pruned_ingest_pipeline(aos_client, prune_type, prune_ratio, base_pipeline="neural-sparse-pipeline", pipeline_name=None):
+    # copy of base_pipeline with pruning sparse_encoding processors, the model ids stay those of base_pipeline
+    # returns the name of the new pipeline, <base_pipeline>-<prune_type>-<prune_ratio> by default
+    def update(processor_type, config):
+        if processor_type == "sparse_encoding":
+            config.pop("prune_type", None)
+            config.pop("prune_ratio", None)
+            config.update(_sparse_prune_options(prune_type, prune_ratio))
+    return _copy_ingest_pipeline(aos_client, base_pipeline, pipeline_name or f"{base_pipeline}-{prune_type}-{prune_ratio:g}", update)
+
+def create_batched_ingest_pipeline(aos_client, batch_size, base_pipeline="neural-sparse-pipeline", pipeline_name=None):
+    # copy of base_pipeline whose inference processors send batch_size docs per model call (OpenSearch 2.16+)
+    # returns the name of the new pipeline, <base_pipeline>-batch-<batch_size> by default
+    def update(processor_type, config):
+        if processor_type in INFERENCE_PROCESSORS:
+            config.pop("batch_size", None)
+            config.update(_batch_options(batch_size))
+    return _copy_ingest_pipeline(aos_client, base_pipeline, pipeline_name or f"{base_pipeline}-batch-{batch_size}", update)
+
+def create_query_pipeline(aos_client, sparse_model_id, dense_model_id, normalization="l2", weights=None, combination="arithmetic_mean", pipeline_name=HYBRID_SEARCH_PIPELINE):
     # PUT /_search/pipeline/hybird-search-pipeline
     # {
     #   "description": "Post processor for hybrid search",
@@ -210,12 +348,12 @@ def create_query_pipeline(aos_client, sparse_model_id, dense_model_id):
         {
           "normalization-processor": {
             "normalization": {
-              "technique": "l2"
+              "technique": normalization
             },
             "combination": {
-              "technique": "arithmetic_mean",
+              "technique": combination,
               "parameters": {
-                "weights": [
+                "weights": weights or [
                   0.5,
                   0.5
                 ]
@@ -228,36 +366,76 @@ def create_query_pipeline(aos_client, sparse_model_id, dense_model_id):
 
     response = aos_client.transport.perform_request(
         method="PUT",
-        url=f"/_search/pipeline/hybird-search-pipeline",
+        url=f"/_search/pipeline/{pipeline_name}",
+        body=json.dumps(request_body)
+    )
+
+    return response
+
+def create_sparse_two_phase_pipeline(aos_client, prune_ratio=TWO_PHASE_PRUNE_RATIO, expansion_rate=TWO_PHASE_EXPANSION_RATE,
+                                     max_window_size=TWO_PHASE_MAX_WINDOW_SIZE, pipeline_name=SPARSE_TWO_PHASE_PIPELINE):
+    # PUT /_search/pipeline/neural-sparse-two-phase-pipeline
+    # {
+    #   "description": "Two-phase neural sparse search",
+    #   "request_processors": [
+    #     {
+    #       "neural_sparse_two_phase_processor": {
+    #         "enabled": true,
+    #         "two_phase_parameter": {
+    #           "prune_ratio": 0.4,
+    #           "expansion_rate": 5.0,
+    #           "max_window_size": 10000
+    #         }
+    #       }
+    #     }
+    #   ]
+    # }
+    # OpenSearch 2.15+, used by the sparse strategy with two_phase="pipeline"
+
+    request_body = {
+      "description": "Two-phase neural sparse search",
+      "request_processors": [
+        {
+          "neural_sparse_two_phase_processor": {
+            "enabled": True,
+            "two_phase_parameter": {
+              "prune_ratio": prune_ratio,
+              "expansion_rate": expansion_rate,
+              "max_window_size": max_window_size
+            }
+          }
+        }
+      ]
+    }
+
+    response = aos_client.transport.perform_request(
+        method="PUT",
+        url=f"/_search/pipeline/{pipeline_name}",
         body=json.dumps(request_body)
     )
 
     return response
 
-def create_index(aos_client, index_name="aos-retrieval"):
+def create_index(aos_client, index_name="aos-retrieval", lean=False, default_pipeline="neural-sparse-pipeline", ef_search=32,
+                 profile="nmslib_hnsw", shards=None, replicas=None, knn_model_id=None):
+    # lean: keep the embeddings out of _source, they stay searchable through the knn graph / rank_features postings
+    # but the stored documents shrink to the text (no reindex / update_by_query from _source anymore)
+    # default_pipeline=None: documents arrive with precomputed embeddings (embedding_store.py), no inference at ingest
+    # profile: one of index_profiles.INDEX_PROFILES (engine / quantization / on-disk mode of dense_embedding, shard layout)
+    number_of_shards, number_of_replicas = profile_shards(profile, shards, replicas)
     index_mapping = {
         "settings" : {
             "index":{
-                "number_of_shards" : 1,
-                "number_of_replicas" : 0,
+                "number_of_shards" : number_of_shards,
+                "number_of_replicas" : number_of_replicas,
                 "knn": "true",
-                "knn.algo_param.ef_search": 32
-            },
-            "default_pipeline": "neural-sparse-pipeline"
+                "knn.algo_param.ef_search": ef_search
+            }
         },
         "mappings": {
             "properties": {
                 "content": {"type": "text", "analyzer": "ik_max_word", "search_analyzer": "ik_smart"},
-                "dense_embedding": {
-                    "type": "knn_vector",
-                    "dimension": 1024,
-                    "method": {
-                        "name": "hnsw",
-                        "engine": "nmslib",
-                        "space_type": "innerproduct",
-                        "parameters": {}
-                    }
-                },
+                "dense_embedding": build_dense_field_mapping(profile, ef_search=ef_search, knn_model_id=knn_model_id),
                 "sparse_embedding": {
                     "type": "rank_features"
                 }
@@ -265,12 +443,128 @@ def create_index(aos_client, index_name="aos-retrieval"):
         }
     }
 
+    if default_pipeline is not None:
+        index_mapping["settings"]["default_pipeline"] = default_pipeline
+
+    if lean:
+        index_mapping["mappings"]["_source"] = {"excludes": EMBEDDING_FIELDS}
+
     # 创建索引
     response = aos_client.indices.create(index=index_name, body=index_mapping)
     return response
 
-def create_bedrock_cohere_connector(account_id, aos_endpoint, input_type='search_document'):
+def get_ef_search(aos_client, index_name):
+    response = aos_client.indices.get_settings(index=index_name, name="index.knn.algo_param.ef_search", include_defaults=True, flat_settings=True)
+    settings = response[index_name]
+    value = settings.get("settings", {}).get("index.knn.algo_param.ef_search") or settings.get("defaults", {}).get("index.knn.algo_param.ef_search")
+    return int(value) if value is not None else None
+
+def get_knn_engine(aos_client, index_name, field="dense_embedding"):
+    # nmslib / faiss / lucene; on_disk mode runs on faiss, a field built from a trained model (model_id) gives None
+    mapping = aos_client.indices.get(index=index_name)[index_name]["mappings"]["properties"][field]
+    if "method" in mapping:
+        return mapping["method"].get("engine", "nmslib")
+    if "mode" in mapping:
+        return "faiss"
+    return None
+
+def get_cluster_version(aos_client):
+    # (major, minor) of the cluster, e.g. (2, 13) for 2.13.0
+    number = aos_client.info()["version"]["number"]
+    return tuple(int(part) for part in number.split("-")[0].split(".")[:2])
+
+def set_ef_search(aos_client, index_name, ef_search):
+    # dynamic setting, no reindex; takes effect on the next search of each segment
+    return aos_client.indices.put_settings(index=index_name, body={"index": {"knn.algo_param.ef_search": ef_search}})
+
+def get_index_stats(aos_client, index_name):
+    response = aos_client.indices.stats(index=index_name, metric="docs,store,segments")
+    primaries = response["_all"]["primaries"]
+    return {
+        "docs": primaries["docs"]["count"],
+        "store_bytes": primaries["store"]["size_in_bytes"],
+        "segments": primaries["segments"]["count"]
+    }
+
+def get_index_generation(aos_client, index_name, docs_only=False):
+    # changes whenever the hits of a query can have changed: a refresh, writes / deletes not refreshed yet, a recreated index;
+    # a scheduled refresh only runs (and counts) when there is something to refresh. index_name may be an alias / pattern
+    # docs_only: just uuid and doc count, which survive refreshes and merges but not a delete and re-ingest
+    if docs_only:
+        response = aos_client.indices.stats(index=index_name, metric="docs")
+        return tuple((name, stats.get("uuid"), stats["primaries"]["docs"]["count"]) for name, stats in sorted(response["indices"].items()))
+    response = aos_client.indices.stats(index=index_name, metric="indexing,refresh")
+    return tuple(
+        (name, stats.get("uuid"), stats["primaries"]["refresh"]["total"], stats["primaries"]["indexing"]["index_total"], stats["primaries"]["indexing"]["delete_total"])
+        for name, stats in sorted(response["indices"].items())
+    )
+
+# docs get_max_token_score reads by default, the whole corpus of a large index is GBs of token maps
+MAX_TOKEN_SCORE_SAMPLE = 10000
+
+def get_max_token_score(aos_client, index_name, field="sparse_embedding", sample_size=MAX_TOKEN_SCORE_SAMPLE):
+    # largest token weight stored in `field`, the tightest max_token_score that still never prunes a match;
+    # reads the field from _source, so not on a lean index (use EmbeddingStore.max_sparse_weight of the store it was ingested from).
+    # Only the first sample_size docs are scanned (None: the whole corpus), an estimate from below on a large index.
+    # neural_sparse ignores max_token_score since OpenSearch 2.12, the value only matters on older clusters
+    max_weight = 0.0
+    scanned = 0
+    for hit in helpers.scan(aos_client, index=index_name, query={"_source": [field]}, size=1000):
+        weights = hit.get("_source", {}).get(field)
+        if weights:
+            max_weight = max(max_weight, max(weights.values()))
+        scanned += 1
+        if sample_size is not None and scanned >= sample_size:
+            break
+    if scanned == 0:
+        return None
+    if max_weight == 0.0:
+        raise ValueError(f"no {field} in _source of {index_name}, a lean index has to take max_token_score from the embedding store")
+    return max_weight
+
+# post_process_function of a connector requesting int8 / binary embeddings: Cohere answers {"embeddings": {"int8": [[...]]}},
+# neural-search reads FLOAT32 model output only, so the int8 values go out as FLOAT32 data
+COHERE_QUANTIZED_POST_PROCESS = """
+    def embeddings = params.embeddings.EMBEDDING_TYPE;
+    if (embeddings == null) {
+      return "Invalid embedding";
+    }
+    def result = new StringBuilder("[");
+    for (int m = 0; m < embeddings.length; m++) {
+      def values = new StringBuilder("[");
+      for (int i = 0; i < embeddings[m].length; i++) {
+        values.append(embeddings[m][i].intValue());
+        if (i < embeddings[m].length - 1) {
+          values.append(",");
+        }
+      }
+      values.append("]");
+      result.append('{"name":"sentence_embedding","data_type":"FLOAT32","shape":[' + embeddings[m].length + '],"data":' + values + '}');
+      if (m < embeddings.length - 1) {
+        result.append(",");
+      }
+    }
+    result.append("]");
+    return result.toString();
+"""
+
+# client_config of the remote connectors (ml-commons 2.12+), sized for batched ingest: the text_embedding processors of
+# all in-flight _bulk requests share max_connection connections to Bedrock, a throttled call (429) is retried
+# max_retry_times with jittered exponential backoff from retry_backoff_millis instead of failing its docs; timeouts in seconds
+CONNECTOR_CLIENT_CONFIG = {
+    "max_connection": 50,
+    "connection_timeout": 10,
+    "read_timeout": 60,
+    "retry_backoff_policy": "exponential_full_jitter",
+    "retry_backoff_millis": 200,
+    "retry_timeout_seconds": 60,
+    "max_retry_times": 5
+}
+
+def create_bedrock_cohere_connector(account_id, aos_endpoint, input_type='search_document', embedding_type='float', client_config=None):
     # input_type could be search_document | search_query
+    # embedding_type could be float | int8 | binary, int8 goes to a byte knn_vector and binary to a binary one (see index_profiles.py)
+    # client_config: http client of the connector (see CONNECTOR_CLIENT_CONFIG), the ml-commons defaults if None
     service = 'es'
     session = boto3.Session()
     credentials = session.get_credentials()
@@ -286,6 +580,14 @@ def create_bedrock_cohere_connector(account_id, aos_endpoint, input_type='search
 
     bedrock_url = "https://bedrock-runtime.{}.amazonaws.com/model/{}/invoke".format(region, model_name)
 
+    request_body = {"texts": "${parameters.texts}", "input_type": input_type}
+    post_process_function = "connector.post_process.cohere.embedding"
+    if embedding_type != 'float':
+        request_body["embedding_types"] = [embedding_type]
+        post_process_function = COHERE_QUANTIZED_POST_PROCESS.replace("EMBEDDING_TYPE", embedding_type)
+    # ${parameters.texts} is a json array, it must not be quoted
+    request_body = json.dumps(request_body).replace('"${parameters.texts}"', '${parameters.texts}')
+
     payload = {
       "name": "Amazon Bedrock Connector: Cohere doc embedding",
       "description": "The connector to the Bedrock Cohere multilingual doc embedding model",
@@ -293,7 +595,9 @@ def create_bedrock_cohere_connector(account_id, aos_endpoint, input_type='search
       "protocol": "aws_sigv4",
       "parameters": {
         "region": region,
-        "service_name": "bedrock"
+        "service_name": "bedrock",
+        # a batched text_embedding processor hands the connector many docs, Cohere takes up to 96 texts per call
+        "input_docs_processed_step_size": COHERE_MAX_BATCH_SIZE
       },
       "credential": {
         "roleArn": role_arn
@@ -307,12 +611,14 @@ def create_bedrock_cohere_connector(account_id, aos_endpoint, input_type='search
             "content-type": "application/json",
             "x-amz-content-sha256": "required"
           },
-          "request_body": "{ \"texts\": ${parameters.texts}, \"input_type\": \"search_document\" }",
+          "request_body": request_body,
           "pre_process_function": "connector.pre_process.cohere.embedding",
-          "post_process_function": "connector.post_process.cohere.embedding"
+          "post_process_function": post_process_function
         }
       ]
     }
+    if client_config:
+        payload["client_config"] = client_config
     headers = {"Content-Type": "application/json"}
 
     r = requests.post(url, auth=awsauth, json=payload, headers=headers)
@@ -326,7 +632,22 @@ if __name__ == '__main__':
     parser.add_argument('--aos_endpoint', type=str, default='', help='aos endpoint')
     parser.add_argument('--sparse_model_id', type=str, default='', help='you can found it in the output of cloudformation')
     parser.add_argument('--index_name', type=str, default='', help='index name')
+    parser.add_argument('--lean_index', action='store_true', help='exclude the embedding fields from _source')
+    parser.add_argument('--no_default_pipeline', action='store_true', help='create the index without default_pipeline, for ingest of precomputed embeddings')
+    parser.add_argument('--index_profile', type=str, default='nmslib_hnsw', choices=list(INDEX_PROFILES), help='knn engine / quantization / shard layout of the index, see index_profiles.py')
+    parser.add_argument('--shards', type=int, default=None, help='number_of_shards, overrides the profile')
+    parser.add_argument('--replicas', type=int, default=None, help='number_of_replicas, overrides the profile')
+    parser.add_argument('--knn_model_id', type=str, default='', help='trained knn model of a profile that needs training (faiss_hnsw_pq)')
+    parser.add_argument('--embedding_type', type=str, default='float', choices=EMBEDDING_TYPES, help='Cohere embedding type of both connectors, int8 needs --index_profile lucene_hnsw_int8, binary faiss_hnsw_binary')
+    parser.add_argument('--ingest_batch_size', type=int, default=None, help='docs per model call of the ingest pipeline processors (OpenSearch 2.16+), capped by the docs of one _bulk request')
+    parser.add_argument('--connector_max_connection', type=int, default=CONNECTOR_CLIENT_CONFIG["max_connection"], help='max connections of each Bedrock connector')
+    parser.add_argument('--connector_max_retries', type=int, default=CONNECTOR_CLIENT_CONFIG["max_retry_times"], help='retries of a throttled Bedrock call, -1 retries until retry_timeout_seconds')
+    parser.add_argument('--connector_retry_backoff_ms', type=int, default=CONNECTOR_CLIENT_CONFIG["retry_backoff_millis"], help='base backoff of the connector retries')
+    parser.add_argument('--connector_read_timeout', type=int, default=CONNECTOR_CLIENT_CONFIG["read_timeout"], help='seconds to wait for a Bedrock response')
+    parser.add_argument('--default_connector_client', action='store_true', help='create the connectors without client_config (ml-commons defaults, no retries)')
     args = parser.parse_args()
+    if profile_embedding_type(args.index_profile) != args.embedding_type:
+        parser.error(f"--index_profile {args.index_profile} stores {profile_embedding_type(args.index_profile)} vectors, not {args.embedding_type}")
     aos_endpoint = args.aos_endpoint
     aos_domain = '-'.join(aos_endpoint.split('-')[1:3])
     sparse_model_id = args.sparse_model_id
@@ -349,11 +670,17 @@ if __name__ == '__main__':
     model_group_id = create_aos_model_group(aos_client)
     print(f"model_group_id:{model_group_id}")
 
-    response = create_index(aos_client, index_name)
+    response = create_index(aos_client, index_name, lean=args.lean_index, default_pipeline=None if args.no_default_pipeline else "neural-sparse-pipeline",
+                            profile=args.index_profile, shards=args.shards, replicas=args.replicas, knn_model_id=args.knn_model_id or None)
     print(f"index:{response}")
 
-    cohere_doc_emb_connector_id = create_bedrock_cohere_connector(account_id, aos_endpoint, 'search_document')
-    cohere_query_emb_connector_id = create_bedrock_cohere_connector(account_id, aos_endpoint, 'search_query')
+    client_config = None
+    if not args.default_connector_client:
+        client_config = dict(CONNECTOR_CLIENT_CONFIG, max_connection=args.connector_max_connection, max_retry_times=args.connector_max_retries,
+                             retry_backoff_millis=args.connector_retry_backoff_ms, read_timeout=args.connector_read_timeout)
+    print(f"connector client_config:{client_config}")
+    cohere_doc_emb_connector_id = create_bedrock_cohere_connector(account_id, aos_endpoint, 'search_document', args.embedding_type, client_config)
+    cohere_query_emb_connector_id = create_bedrock_cohere_connector(account_id, aos_endpoint, 'search_query', args.embedding_type, client_config)
     print(f"cohere_doc_emb_connector_id: {cohere_doc_emb_connector_id}")
     print(f"cohere_query_emb_connector_id: {cohere_query_emb_connector_id}")
 
@@ -371,10 +698,14 @@ if __name__ == '__main__':
     print(f"query_dense_model_id:{query_dense_model_id}")
 
     # pipeline = neural-sparse-pipeline
-    response = create_ingest_pipeline(aos_client, sparse_model_id, doc_dense_model_id)
+    response = create_ingest_pipeline(aos_client, sparse_model_id, doc_dense_model_id, batch_size=args.ingest_batch_size)
     print("create_ingest_pipeline:")
     print(response)
 
     response = create_query_pipeline(aos_client, sparse_model_id, query_dense_model_id)
     print("create_query_pipeline:")
+    print(response)
+
+    response = create_sparse_two_phase_pipeline(aos_client)
+    print("create_sparse_two_phase_pipeline:")
     print(response)
\ No newline at end of file
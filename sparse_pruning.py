@@ -0,0 +1,40 @@
+PRUNE_TYPES = ["none", "top_k", "abs_value", "max_ratio", "alpha_mass"]
+
+def prune_sparse_vector(vector, prune_type="none", prune_ratio=None):
+    '''
+    Usage : prune_sparse_vector({"hello": 2.1, "world": 0.05}, "max_ratio", 0.1) -> {"hello": 2.1}
+
+    Same pruning as the prune_type / prune_ratio of the sparse_encoding processor (OpenSearch 2.16+),
+    so precomputed embeddings and pipeline-encoded ones end up with the same postings:
+        top_k       keeps the prune_ratio heaviest tokens
+        abs_value   keeps tokens weighing at least prune_ratio
+        max_ratio   keeps tokens weighing at least prune_ratio x the heaviest token
+        alpha_mass  keeps the heaviest tokens until they hold prune_ratio of the total weight
+    '''
+    if not vector or prune_type in (None, "none"):
+        return vector
+    if prune_type == "top_k":
+        return dict(sorted(vector.items(), key=lambda item: item[1], reverse=True)[:int(prune_ratio)])
+    if prune_type == "abs_value":
+        return {token: weight for token, weight in vector.items() if weight >= prune_ratio}
+    if prune_type == "max_ratio":
+        threshold = max(vector.values()) * prune_ratio
+        return {token: weight for token, weight in vector.items() if weight >= threshold}
+    if prune_type == "alpha_mass":
+        budget = sum(vector.values()) * prune_ratio
+        pruned = {}
+        mass = 0.0
+        for token, weight in sorted(vector.items(), key=lambda item: item[1], reverse=True):
+            if mass >= budget:
+                break
+            pruned[token] = weight
+            mass += weight
+        return pruned
+    raise ValueError(f"unknown prune_type: {prune_type}, expected one of {PRUNE_TYPES}")
+
+def parse_prune_setting(setting):
+    # "top_k:64" -> ("top_k", 64.0), "none" -> ("none", None)
+    prune_type, _, prune_ratio = setting.partition(":")
+    if prune_type not in PRUNE_TYPES:
+        raise ValueError(f"unknown prune_type: {prune_type}, expected one of {PRUNE_TYPES}")
+    return prune_type, float(prune_ratio) if prune_ratio else None
@@ -0,0 +1,45 @@
+import json
+from functools import lru_cache
+
+class SparseQueryEncoder:
+    '''
+    Usage :
+        sparse_encoder = SparseQueryEncoder("tokenizer.json", "idf.json", top_n=32, min_weight=0.5)
+        search_by_sparse(aos_client, index_name, query, sparse_model_id, topk, sparse_encoder=sparse_encoder)
+
+    Inference-free query side of the doc-only neural sparse models
+    (e.g. opensearch-neural-sparse-encoding-doc-v2-distill): the query is tokenized with the
+    tokenizer of the ingest model and every token is weighted by its entry in the model's idf.json,
+    so neural_sparse gets `query_tokens` directly and no model runs at search time.
+    Both files ship with the model; tokens must come from the same vocabulary as the ingest model.
+    top_n keeps the heaviest tokens only and min_weight drops light ones, fewer tokens = faster query, lower recall.
+    '''
+    def __init__(self, tokenizer_path, idf_path, top_n=None, min_weight=0.0, cache_size=10000, default_weight=1.0):
+        # pip3 install tokenizers
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        with open(idf_path) as f:
+            self.idf = json.load(f)
+        self.top_n = top_n
+        self.min_weight = min_weight
+        self.default_weight = default_weight
+        self.special_tokens = {"[CLS]", "[SEP]", "[PAD]", "[UNK]", "[MASK]", "<s>", "</s>", "<pad>", "<unk>"}
+        self._encode = lru_cache(maxsize=cache_size)(self._encode_uncached)
+
+    def _encode_uncached(self, query):
+        tokens = {}
+        for token in self.tokenizer.encode(query).tokens:
+            if token in self.special_tokens:
+                continue
+            tokens[token] = self.idf.get(token, self.default_weight)
+        weighted = sorted(tokens.items(), key=lambda item: item[1], reverse=True)
+        weighted = [(token, weight) for token, weight in weighted if weight >= self.min_weight]
+        if self.top_n is not None:
+            weighted = weighted[:self.top_n]
+        return tuple(weighted)
+
+    def encode(self, query):
+        return dict(self._encode(query))
+
+    def cache_info(self):
+        return self._encode.cache_info()
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from opensearchpy.exceptions import NotFoundError
+from search_func import STRATEGIES, CASCADE_STRATEGIES, CASCADE_CANDIDATES, HYBRID_SEARCH_PIPELINE, HYBRID_DENSE_K, search_by_strategy, search_many
+from async_search_func import search_concurrently, async_search_by_strategy
+from instrumentation import InstrumentedClient
+from hybrid_fusion import search_by_client_fusion
+from dense_quantization import rescore_hits
+from partitioned_search import search_partitioned
+from setup_model_and_pipeline import get_index_generation
+
+# name -> run(aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency, msearch_size, recorder, position)
+# returning one hits list per query
+STRATEGY_RUNNERS = {}
+
+def register_strategy(name, run):
+    STRATEGY_RUNNERS[name] = run
+
+def _search_func_runner(strategy, label=None, **overrides):
+    # label: name in the recorder / progress bar, overrides: search kwargs fixed for this runner
+    label = label or strategy
+    def run(aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency=1, msearch_size=0, recorder=None, position=0):
+        search_kwargs = dict(search_kwargs, **overrides)
+        # client_options only shape the async client of the concurrent path
+        client_options = search_kwargs.pop("client_options", None)
+        search_client = InstrumentedClient(aos_client, recorder, label) if recorder is not None else aos_client
+        if msearch_size > 0:
+            return search_many(search_client, index_name, query_texts, strategy, max_queries_per_request=msearch_size, **search_kwargs)
+        if concurrency > 1:
+            return search_concurrently(aos_endpoint, index_name, query_texts, async_search_by_strategy, strategy, concurrency=concurrency, recorder=recorder, label=label,
+                                       client_options=client_options, **search_kwargs)
+        return [search_by_strategy(search_client, index_name, query, strategy, **search_kwargs) for query in tqdm(query_texts, desc=label, position=position)]
+    return run
+
+for _strategy in STRATEGIES + CASCADE_STRATEGIES:
+    register_strategy(_strategy, _search_func_runner(_strategy))
+
+def client_fusion_runner(legs, weights=None, technique="min_max"):
+    # legs of one query already run in parallel, so concurrency here is the number of queries in flight
+    def run(aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency=1, msearch_size=0, recorder=None, position=0):
+        # legs go straight to search_by_body, neither the async client options nor the result cache apply
+        search_kwargs = {name: value for name, value in search_kwargs.items() if name not in ("client_options", "result_cache")}
+        def search(query):
+            hits, _ = search_by_client_fusion(aos_client, index_name, query, legs, weights=weights, technique=technique, recorder=recorder, **search_kwargs)
+            return hits
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            return list(tqdm(executor.map(search, query_texts), total=len(query_texts), desc="client_fusion", position=position))
+    return run
+
+def two_phase_sparse_runner(mode="pipeline"):
+    # the sparse strategy with two_phase="pipeline" / "client", registered next to the plain sparse run to compare both
+    return _search_func_runner("sparse", "sparse_two_phase", two_phase=mode)
+
+def rescored_dense_runner(store, oversample=4):
+    # dense over a quantized dense_embedding, topk x oversample candidates re-ranked by the full precision vectors of `store`
+    # (an embedding_store.EmbeddingStore); search_kwargs["embedding_cache"] must be a dense_quantization.QuantizedQueryEmbeddings
+    run_dense = _search_func_runner("dense", "dense_rescored")
+    def run(aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency=1, msearch_size=0, recorder=None, position=0):
+        topk = search_kwargs.get("topk", 4)
+        query_embeddings = search_kwargs["embedding_cache"]
+        hits_list = run_dense(aos_client, aos_endpoint, index_name, query_texts, dict(search_kwargs, topk=topk * oversample), concurrency, msearch_size, recorder, position)
+        return [rescore_hits(hits, query_embeddings.get_float_embedding(query), store, topk) for query, hits in zip(query_texts, hits_list)]
+    return run
+
+def cascade_runner(stage, candidates=CASCADE_CANDIDATES, store=None, label=None):
+    # cascade_<stage> rescoring the top `candidates` of the stage by the knn_score script on the cluster, or with a `store`
+    # (an embedding_store.EmbeddingStore) the stage alone returns `candidates` hits that rescore_hits ranks by the stored vectors;
+    # both need search_kwargs["embedding_cache"] for the query vector
+    label = label or f"cascade_{stage}_{candidates}"
+    if store is None:
+        return _search_func_runner(f"cascade_{stage}", label, cascade_candidates=candidates)
+    run_stage = _search_func_runner(stage, label)
+    def run(aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency=1, msearch_size=0, recorder=None, position=0):
+        topk = search_kwargs.get("topk", 4)
+        embedding_cache = search_kwargs["embedding_cache"]
+        # a QuantizedQueryEmbeddings keeps the float vector the store is compared with
+        query_vector = getattr(embedding_cache, "get_float_embedding", embedding_cache.get_embedding)
+        hits_list = run_stage(aos_client, aos_endpoint, index_name, query_texts, dict(search_kwargs, topk=max(candidates, topk)), concurrency, msearch_size, recorder, position)
+        return [rescore_hits(hits, query_vector(query), store, topk) for query, hits in zip(query_texts, hits_list)]
+    return run
+
+def partitioned_runner(strategy, partitions, technique="l2", weights=None, label=None):
+    # strategy as a scatter-gather over the partitions of the index (partitioned_search.py), concurrency is the number
+    # of queries in flight, each of them fans out over all partitions
+    label = label or f"{strategy}_p{partitions}"
+    def run(aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency=1, msearch_size=0, recorder=None, position=0):
+        # partitions are searched one plain request each, the async client, the result cache and the hybrid pipeline do not apply
+        search_kwargs = {name: value for name, value in search_kwargs.items() if name not in ("client_options", "result_cache", "hybrid_pipeline")}
+        def search(query):
+            return search_partitioned(aos_client, index_name, query, strategy, partitions, technique=technique, weights=weights, recorder=recorder, label=label, **search_kwargs)
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            return list(tqdm(executor.map(search, query_texts), total=len(query_texts), desc=label, position=position))
+    return run
+
+def write_run(path, run, tag):
+    # TREC run format: query_id Q0 doc_id rank score tag
+    with open(path, "w") as f:
+        for query_id, hits in run.items():
+            for rank, hit in enumerate(hits, 1):
+                f.write(f"{query_id} Q0 {hit['_id']} {rank} {hit['_score']} {tag}\n")
+
+def load_run(path):
+    # {query_id: {doc_id: score}} with the docs of each query in rank order
+    run = {}
+    with open(path) as f:
+        for line in f:
+            query_id, _, doc_id, _, score, _ = line.split()
+            run.setdefault(query_id, {})[doc_id] = float(score)
+    return run
+
+def _index_generation(aos_client, index_name):
+    # uuid and doc count of the index, or of its partitions (partitioned_search.partition_names) when there is no such index
+    if aos_client.indices.exists(index=index_name):
+        return get_index_generation(aos_client, index_name, docs_only=True)
+    partition = re.compile(rf"{re.escape(index_name)}-p\d+")
+    names = sorted(name for name in aos_client.indices.get(index=f"{index_name}-p*") if partition.fullmatch(name))
+    return get_index_generation(aos_client, ",".join(names), docs_only=True) if names else ()
+
+def _search_pipeline(aos_client, pipeline_name):
+    # definition of a search pipeline (normalization technique, weights, ...), None when it does not exist
+    try:
+        return aos_client.transport.perform_request(method="GET", url=f"/_search/pipeline/{pipeline_name}").get(pipeline_name)
+    except NotFoundError:
+        return None
+
+def _run_meta(aos_client, index_name, queries, search_kwargs, run_params):
+    # everything the hits depend on: a deleted and re-ingested index (other pruning, profile, corpus, ...) gets a new uuid,
+    # a changed hybrid pipeline other weights, so neither reuses the old runs
+    digest = hashlib.blake2b(json.dumps(queries, sort_keys=True, ensure_ascii=False).encode("utf-8"), digest_size=16).hexdigest()
+    hybrid_pipeline = search_kwargs.get("hybrid_pipeline", HYBRID_SEARCH_PIPELINE)
+    meta = {
+        "index_name": index_name,
+        "index_generation": [list(index) for index in _index_generation(aos_client, index_name)],
+        "queries": digest,
+        "topk": search_kwargs.get("topk"),
+        "sparse_model_id": search_kwargs.get("sparse_model_id"),
+        "dense_model_id": search_kwargs.get("dense_model_id"),
+        "hybrid_k": search_kwargs.get("hybrid_k", HYBRID_DENSE_K),
+        "hybrid_pipeline": hybrid_pipeline,
+        "hybrid_pipeline_config": _search_pipeline(aos_client, hybrid_pipeline)
+    }
+    meta.update(run_params or {})
+    return meta
+
+def run_strategies(aos_client, aos_endpoint, index_name, queries, strategies, search_kwargs, run_dir, concurrency=1, msearch_size=0,
+                   recorder=None, run_params=None, reuse=True):
+    '''
+    Usage : runs = run_strategies(aos_client, aos_endpoint, index_name, {"q1": "what is ..."}, ["bm25", "dense"], search_kwargs, "runs/fiqa")
+
+    Runs every strategy over `queries` ({query_id: text}), all strategies at the same time, and writes
+    <run_dir>/<strategy>.trec next to a <strategy>.json describing the run (index generation, queries, topk, models,
+    hybrid pipeline, run_params).
+    With reuse, a run whose description matches is read back from disk instead of querying the cluster again.
+    Returns {strategy: {query_id: {doc_id: score}}}, docs in rank order.
+    '''
+    os.makedirs(run_dir, exist_ok=True)
+    query_ids = list(queries.keys())
+    query_texts = [queries[query_id] for query_id in query_ids]
+    meta = _run_meta(aos_client, index_name, queries, search_kwargs, run_params)
+
+    def run_strategy(position, strategy):
+        run_path = os.path.join(run_dir, f"{strategy}.trec")
+        meta_path = os.path.join(run_dir, f"{strategy}.json")
+        if reuse and os.path.exists(run_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    print(f"[{strategy}] reusing {run_path}")
+                    return load_run(run_path)
+        if strategy not in STRATEGY_RUNNERS:
+            raise ValueError(f"unknown strategy: {strategy}, expected one of {list(STRATEGY_RUNNERS)}")
+        hits_list = STRATEGY_RUNNERS[strategy](aos_client, aos_endpoint, index_name, query_texts, search_kwargs, concurrency, msearch_size, recorder, position)
+        write_run(run_path, dict(zip(query_ids, hits_list)), strategy)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        return load_run(run_path)
+
+    with ThreadPoolExecutor(max_workers=max(len(strategies), 1)) as executor:
+        runs = list(executor.map(run_strategy, range(len(strategies)), strategies))
+    return dict(zip(strategies, runs))